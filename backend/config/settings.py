@@ -162,15 +162,97 @@ CSRF_TRUSTED_ORIGINS = [
 ]
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+# Where Yjs update logs and snapshots live: "sqlite" (the YJS_STORE_PATH file,
+# local to this node) or "orm" (the main database, for more than one instance).
+YJS_STORE_BACKEND = os.environ.get("YJS_STORE_BACKEND", "sqlite")
 YJS_STORE_PATH = os.environ.get("YJS_STORE_PATH", str(BASE_DIR / "yjs.sqlite3"))
 YJS_DOCUMENT_TTL = int(os.environ.get("YJS_DOCUMENT_TTL", "604800"))
+# `manage.py gc_yjs` (run it from cron, or with --every) moves rooms idle for
+# YJS_ARCHIVE_AFTER seconds out of the update log; 0 turns archiving off.
+YJS_ARCHIVE_AFTER = int(os.environ.get("YJS_ARCHIVE_AFTER", str(YJS_DOCUMENT_TTL)))
+# Compression of stored updates and snapshots: "" (off), "zlib" or "lzma".
+# Blobs under YJS_COMPRESSION_MIN_BYTES (most single edits) stay raw; rows
+# written with any setting stay readable, so it can be switched at any time.
+YJS_COMPRESSION = os.environ.get("YJS_COMPRESSION", "")
+YJS_COMPRESSION_MIN_BYTES = int(os.environ.get("YJS_COMPRESSION_MIN_BYTES", "256"))
+
+# Shared in-memory Yjs rooms: seconds an unused room stays loaded, and the
+# byte budget for the encoded state of evicted rooms (LRU, then the store).
+YJS_ROOM_IDLE_GRACE = float(os.environ.get("YJS_ROOM_IDLE_GRACE", "30"))
+YJS_ROOM_CACHE_BYTES = int(os.environ.get("YJS_ROOM_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Yjs updates are coalesced per room and written at most this many seconds late.
+YJS_FLUSH_INTERVAL = float(os.environ.get("YJS_FLUSH_INTERVAL", "0.2"))
+# Persistence shards per process, and pending rooms per shard before
+# receiving consumers are made to wait for a flush.
+YJS_PERSISTENCE_SHARDS = int(os.environ.get("YJS_PERSISTENCE_SHARDS", "4"))
+YJS_WORKER_MAX_PENDING = int(os.environ.get("YJS_WORKER_MAX_PENDING", "1000"))
+# A room's update log is squashed automatically once it has grown by this
+# many rows or bytes since its last compaction (0 disables either limit).
+YJS_COMPACT_MAX_ROWS = int(os.environ.get("YJS_COMPACT_MAX_ROWS", "500"))
+YJS_COMPACT_MAX_BYTES = int(os.environ.get("YJS_COMPACT_MAX_BYTES", str(1024 * 1024)))
+# Edited rooms get a restore point at most every YJS_SNAPSHOT_INTERVAL
+# seconds (0 disables); compact_yjs prunes restore points older than
+# YJS_SNAPSHOT_RETENTION seconds, always keeping each room's newest one.
+YJS_SNAPSHOT_INTERVAL = float(os.environ.get("YJS_SNAPSHOT_INTERVAL", "600"))
+YJS_SNAPSHOT_RETENTION = int(os.environ.get("YJS_SNAPSHOT_RETENTION", str(30 * 24 * 60 * 60)))
+# Page rooms are copied to TiptapDocument.content after this many quiet
+# seconds (0 disables).
+YJS_MATERIALIZE_DELAY = float(os.environ.get("YJS_MATERIALIZE_DELAY", "2"))
+# Minimum seconds between awareness (cursor/selection) fan-outs per connection.
+YJS_AWARENESS_INTERVAL = float(os.environ.get("YJS_AWARENESS_INTERVAL", "0.1"))
+# Lifetime in seconds of the signed tickets that let WebSocket connects skip
+# the token and page-access queries (the token stays accepted as a fallback).
+WS_TICKET_TTL = int(os.environ.get("WS_TICKET_TTL", "60"))
+# WebSocket admission control: connects in progress per process and per room,
+# connects allowed to wait for a slot and for how long, and the base of the
+# jittered retry delay sent to shed clients (close code 4029).
+WS_CONNECT_MAX_CONCURRENT = int(os.environ.get("WS_CONNECT_MAX_CONCURRENT", "64"))
+WS_CONNECT_MAX_PER_ROOM = int(os.environ.get("WS_CONNECT_MAX_PER_ROOM", "16"))
+WS_CONNECT_MAX_QUEUE = int(os.environ.get("WS_CONNECT_MAX_QUEUE", "1000"))
+WS_CONNECT_QUEUE_TIMEOUT = float(os.environ.get("WS_CONNECT_QUEUE_TIMEOUT", "5"))
+WS_CONNECT_RETRY_AFTER = float(os.environ.get("WS_CONNECT_RETRY_AFTER", "2"))
+# Per-connection limits on incoming Yjs frames (0 disables each): frames
+# larger than YJS_MAX_FRAME_BYTES close the socket; beyond the message and
+# byte token buckets (rate per second, burst) a client is slowed down, and
+# disconnected once it would have to wait more than YJS_RATE_MAX_DELAY seconds.
+YJS_MAX_FRAME_BYTES = int(os.environ.get("YJS_MAX_FRAME_BYTES", str(4 * 1024 * 1024)))
+YJS_RATE_MESSAGES = float(os.environ.get("YJS_RATE_MESSAGES", "50"))
+YJS_RATE_MESSAGES_BURST = float(os.environ.get("YJS_RATE_MESSAGES_BURST", "200"))
+YJS_RATE_BYTES = float(os.environ.get("YJS_RATE_BYTES", str(1024 * 1024)))
+YJS_RATE_BYTES_BURST = float(os.environ.get("YJS_RATE_BYTES_BURST", str(8 * 1024 * 1024)))
+YJS_RATE_MAX_DELAY = float(os.environ.get("YJS_RATE_MAX_DELAY", "2"))
+# Each process logs its realtime counters (persistence queues, connects,
+# clients over the frame limits) every WS_STATS_LOG_INTERVAL seconds; 0 turns
+# the log off. Staff can also read them at /api/realtime-stats/.
+WS_STATS_LOG_INTERVAL = float(os.environ.get("WS_STATS_LOG_INTERVAL", "60"))
+
+# Seconds to keep resolved page roles in the default cache (0 disables it).
+# With more than one process, point CACHES at a shared backend such as Redis
+# so invalidations reach every worker.
+PAGE_ROLE_CACHE_TIMEOUT = int(os.environ.get("PAGE_ROLE_CACHE_TIMEOUT", "0"))
+
+# `manage.py prune_page_changes` (run it from cron, or with --every) deletes
+# page change log rows older than PAGE_CHANGE_RETENTION seconds; clients
+# whose /api/pages/changes/ cursor is older get a full resync.
+PAGE_CHANGE_RETENTION = int(os.environ.get("PAGE_CHANGE_RETENTION", str(60 * 60 * 24 * 30)))
+
+# Fractional-index keys longer than this trigger a background rebalance of
+# their sibling set (the position columns hold 32 characters).
+POSITION_REBALANCE_LENGTH = int(os.environ.get("POSITION_REBALANCE_LENGTH", "24"))
+
+# Messages a process's room fan-out channel (core.fanout) holds before the
+# layer drops new ones. Every room's cross-process traffic shares that one
+# channel, so it needs far more room than the per-consumer default of 100;
+# lost messages are counted and repaired with a resync, not retried.
+FANOUT_CHANNEL_CAPACITY = int(os.environ.get("FANOUT_CHANNEL_CAPACITY", "10000"))
 
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [REDIS_URL],
+            "group_expiry": 60,
+            "channel_capacity": {"fanout.*": FANOUT_CHANNEL_CAPACITY},
         },
-        "GROUP_EXPIRY": 60,
     }
 }
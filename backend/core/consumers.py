@@ -1,5 +1,10 @@
 import asyncio
 import logging
+import random
+import time
+import zlib
+from collections import OrderedDict, deque
+from functools import partial
 from urllib.parse import parse_qs
 
 from asgiref.sync import sync_to_async
@@ -8,7 +13,30 @@ import y_py as Y
 from ypy_websocket.django_channels_consumer import YjsConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from ypy_websocket.ystore import SQLiteYStore
-from ypy_websocket.yutils import sync, YMessageType, process_sync_message
+from ypy_websocket.yutils import (
+    YMessageType,
+    YSyncMessageType,
+    create_sync_step1_message,
+    create_sync_step2_message,
+    create_update_message,
+    read_message,
+)
+
+from .fanout import _fanout
+from .models import CollaborationRole
+from .utils import yjs_compact, yjs_orm
+from .utils.yjs_codec import decode_update
+from .utils.yjs_store import (
+    append_updates,
+    compact_room,
+    last_reset,
+    last_update_at,
+    load_room,
+    snapshot_if_due,
+)
+from .utils.ratelimit import TokenBucket
+from .utils.ws_tickets import read_ticket
+from .utils.awareness import AWARENESS_TIMEOUT, decode_awareness, encode_awareness
 
 logger = logging.getLogger("core.yjs")
 
@@ -17,41 +45,861 @@ class YjsSQLiteStore(SQLiteYStore):
     db_path = getattr(settings, "YJS_STORE_PATH", str(settings.BASE_DIR / "yjs.sqlite3"))
     document_ttl = getattr(settings, "YJS_DOCUMENT_TTL", 60 * 60 * 24 * 7)
 
+    # rows may be compressed (YJS_COMPRESSION): decode on read, and write
+    # through yjs_compact, whose TTL squash understands compressed rows
+    async def read(self):
+        async for update, metadata, timestamp in super().read():
+            yield decode_update(update), metadata, timestamp
+
+    async def write(self, data: bytes) -> None:
+        await self.db_initialized.wait()
+        await sync_to_async(yjs_compact.append_updates)(self.db_path, [(self.path, data)], self.document_ttl)
+
+
+# First pause after a failed Yjs flush, doubled per failure up to the flush
+# interval, and seconds between two logged flush errors (the ones in between
+# are counted in the next log line).
+FLUSH_RETRY_DELAY = 0.01
+FLUSH_ERROR_LOG_INTERVAL = 60
+
 
 class YjsPersistenceWorker:
-    def __init__(self):
-        self._queue: asyncio.Queue[tuple[str, str, bytes]] = asyncio.Queue()
+    """
+    Persists room docs in batches instead of one store write per update.
+
+    A room is marked dirty with the state vector it had before its first
+    unsaved transaction; every YJS_FLUSH_INTERVAL seconds the worker encodes
+    each dirty doc against that state vector (one merged update per room) and
+    appends all of them to the store in a single transaction.
+
+    Overflow policy: updates to a room that is already pending merge into its
+    entry, so depth only grows with distinct rooms. Once YJS_WORKER_MAX_PENDING
+    rooms are pending, producers awaiting `wait_for_capacity` block and the
+    worker flushes without waiting for the interval.
+
+    The worker also counts the rows and bytes each room's update log has
+    grown by since it was last squashed, and compacts the room after a flush
+    once YJS_COMPACT_MAX_ROWS or YJS_COMPACT_MAX_BYTES is crossed. Every write
+    for a room goes through its worker, so compaction never overlaps a write
+    from this process; compact_room only deletes the rows it has merged.
+    """
+
+    def __init__(self, index: int = 0):
+        self.index = index
+        # id(ydoc) -> (room, ydoc, state vector already persisted)
+        self._dirty: dict[int, tuple[str, Y.YDoc, bytes]] = {}
+        self._dirty_since: float | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._full: asyncio.Event | None = None
+        self._drained: asyncio.Event | None = None
         self._task: asyncio.Task | None = None
-        self._stores: dict[str, SQLiteYStore] = {}
+        # room -> [rows, bytes] in the update log since the last compaction
+        self._log_sizes: dict[str, list[int]] = {}
+        self._snapshot_checked: dict[str, float] = {}
+        self.flushes = 0
+        self.compactions = 0
+        self.failures = 0
+        self.blocked = 0
+        self.last_flush_seconds = 0.0
+        # pause before retrying after a failed flush, doubled per failure
+        self._retry_delay = 0.0
+        self._error_logged_at: float | None = None
+        self._errors_suppressed = 0
+
+    @staticmethod
+    def flush_interval() -> float:
+        return getattr(settings, "YJS_FLUSH_INTERVAL", 0.2)
+
+    @staticmethod
+    def max_pending() -> int:
+        return getattr(settings, "YJS_WORKER_MAX_PENDING", 1000)
+
+    @staticmethod
+    def compact_thresholds() -> tuple[int, int]:
+        return (
+            getattr(settings, "YJS_COMPACT_MAX_ROWS", 500),
+            getattr(settings, "YJS_COMPACT_MAX_BYTES", 1024 * 1024),
+        )
+
+    @staticmethod
+    def snapshot_interval() -> float:
+        return getattr(settings, "YJS_SNAPSHOT_INTERVAL", 600)
+
+    def track_room(self, room_name: str, rows: int, size: int):
+        """Seed the log size of a room loaded from the store."""
+        self._log_sizes[room_name] = [rows, size]
 
     def ensure_started(self):
         if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._drained = asyncio.Event()
             self._task = asyncio.create_task(self._run())
 
-    async def enqueue_update(self, room_name: str, update: bytes):
-        await self._queue.put(("write", room_name, update))
+    def enqueue_update(self, room_name: str, ydoc: Y.YDoc, before_state: bytes):
+        """Mark `ydoc` dirty; called from the doc observer, so it must not block."""
+        key = id(ydoc)
+        if key in self._dirty:
+            return
+        if not self._dirty:
+            self._dirty_since = time.monotonic()
+        self._dirty[key] = (room_name, ydoc, before_state)
+        self._wakeup.set()
+        if len(self._dirty) >= self.max_pending():
+            self._full.set()
+
+    def discard(self, room_name: str):
+        self._dirty = {key: entry for key, entry in self._dirty.items() if entry[0] != room_name}
+        self._log_sizes.pop(room_name, None)
+
+    async def wait_for_capacity(self, room_name: str | None = None):
+        """Block the caller while this worker holds YJS_WORKER_MAX_PENDING rooms."""
+        while len(self._dirty) >= self.max_pending():
+            self.blocked += 1
+            self._full.set()
+            self._wakeup.set()
+            await self._drained.wait()
+
+    def stats(self) -> dict:
+        lag = time.monotonic() - self._dirty_since if self._dirty else 0.0
+        return {
+            "shard": self.index,
+            "depth": len(self._dirty),
+            "lag_seconds": round(lag, 3),
+            "flushes": self.flushes,
+            "compactions": self.compactions,
+            "failures": self.failures,
+            "blocked": self.blocked,
+            "last_flush_seconds": round(self.last_flush_seconds, 3),
+        }
+
+    async def flush(self) -> int:
+        batch, self._dirty = self._dirty, {}
+        since, self._dirty_since = self._dirty_since, None
+        if not batch:
+            return 0
+        rows = [(room, Y.encode_state_as_update(ydoc, sv)) for room, ydoc, sv in batch.values()]
+        started = time.monotonic()
+        try:
+            await sync_to_async(append_updates, thread_sensitive=False)(
+                rows, YjsSQLiteStore.document_ttl
+            )
+        except Exception:
+            # requeue with the older state vector, so nothing is lost
+            self.failures += 1
+            self._dirty.update(batch)
+            self._dirty_since = since
+            raise
+        finally:
+            self.last_flush_seconds = time.monotonic() - started
+        self.flushes += 1
+        for room, update in rows:
+            log = self._log_sizes.setdefault(room, [0, 0])
+            log[0] += 1
+            log[1] += len(update)
+        await self._snapshot_due_rooms(batch.values())
+        return len(rows)
+
+    async def _snapshot_due_rooms(self, entries):
+        interval = self.snapshot_interval()
+        if not interval:
+            return
+        now = time.monotonic()
+        states = []
+        for room, ydoc, _ in entries:
+            # at most one encode (and one store check) per room per interval
+            if now - self._snapshot_checked.get(room, -interval) >= interval:
+                self._snapshot_checked[room] = now
+                states.append((room, Y.encode_state_as_update(ydoc)))
+        if states:
+            try:
+                await sync_to_async(snapshot_if_due, thread_sensitive=False)(states, interval)
+            except Exception:
+                logger.exception("Yjs periodic snapshot error", extra={"shard": self.index})
+
+    def _rooms_to_compact(self) -> list[str]:
+        max_rows, max_bytes = self.compact_thresholds()
+        return [
+            room
+            for room, (rows, size) in self._log_sizes.items()
+            if (max_rows and rows > max_rows) or (max_bytes and size > max_bytes)
+        ]
+
+    async def compact_due_rooms(self) -> int:
+        compacted = 0
+        for room in self._rooms_to_compact():
+            await sync_to_async(compact_room, thread_sensitive=False)(room)
+            self._log_sizes[room] = [1, 0]
+            self.compactions += 1
+            compacted += 1
+        return compacted
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self._log_flush_error()
+                self._retry_delay = min(max(self._retry_delay * 2, FLUSH_RETRY_DELAY), self.flush_interval())
+            else:
+                self._retry_delay = 0.0
+            drained, self._drained = self._drained, asyncio.Event()
+            drained.set()
+            try:
+                await self.compact_due_rooms()
+            except Exception:
+                logger.exception("Yjs online compaction error", extra={"shard": self.index})
+            if self._retry_delay:
+                # producers keep setting _full while the store is failing
+                await asyncio.sleep(self._retry_delay)
+            if self._dirty:
+                self._wakeup.set()
+
+    def _log_flush_error(self):
+        """Log a failed flush with its traceback at most once per FLUSH_ERROR_LOG_INTERVAL."""
+        now = time.monotonic()
+        if self._error_logged_at is not None and now - self._error_logged_at < FLUSH_ERROR_LOG_INTERVAL:
+            self._errors_suppressed += 1
+            return
+        logger.exception(
+            "Yjs persistence worker error",
+            extra={"shard": self.index, "suppressed": self._errors_suppressed},
+        )
+        self._error_logged_at = now
+        self._errors_suppressed = 0
+
+
+class YjsPersistencePool:
+    """
+    Rooms hashed over independent persistence workers, so a slow room or a
+    long write only delays the rooms sharing its shard.
+    """
+
+    def __init__(self, shards: int | None = None):
+        count = shards or getattr(settings, "YJS_PERSISTENCE_SHARDS", 4)
+        self.shards = [YjsPersistenceWorker(index) for index in range(max(1, count))]
+
+    def shard_for(self, room_name: str) -> YjsPersistenceWorker:
+        return self.shards[zlib.crc32(room_name.encode("utf-8")) % len(self.shards)]
+
+    @property
+    def flushes(self) -> int:
+        return sum(shard.flushes for shard in self.shards)
+
+    def ensure_started(self):
+        for shard in self.shards:
+            shard.ensure_started()
+
+    def track_room(self, room_name: str, rows: int, size: int):
+        self.shard_for(room_name).track_room(room_name, rows, size)
+
+    def discard(self, room_name: str):
+        self.shard_for(room_name).discard(room_name)
+
+    def enqueue_update(self, room_name: str, ydoc: Y.YDoc, before_state: bytes):
+        self.shard_for(room_name).enqueue_update(room_name, ydoc, before_state)
+
+    async def wait_for_capacity(self, room_name: str):
+        await self.shard_for(room_name).wait_for_capacity(room_name)
+
+    async def flush(self) -> int:
+        return sum(await asyncio.gather(*(shard.flush() for shard in self.shards)))
+
+    def stats(self) -> list[dict]:
+        return [shard.stats() for shard in self.shards]
+
+
+_yjs_worker = YjsPersistencePool()
+
+
+class YjsMaterializer:
+    """
+    Debounced copy of page rooms into TiptapDocument.content.
+
+    Once a page room has had no update for YJS_MATERIALIZE_DELAY seconds its
+    ProseMirror fragment is converted to Tiptap JSON and stored with a new
+    version, so REST reads are a single row fetch with no Yjs decoding.
+    Writes for the same room run in order.
+    """
+
+    def __init__(self):
+        self._timers: dict[str, tuple[asyncio.TimerHandle, Y.YDoc]] = {}
+        self._writes: dict[str, asyncio.Task] = {}
+        self.materialized = 0
+
+    @staticmethod
+    def delay() -> float:
+        return getattr(settings, "YJS_MATERIALIZE_DELAY", 2.0)
+
+    def touch(self, room_name: str, ydoc: Y.YDoc):
+        delay = self.delay()
+        if delay <= 0 or not room_name.startswith("page:"):
+            return
+        self.cancel(room_name)
+        handle = asyncio.get_running_loop().call_later(delay, self.flush_room, room_name)
+        self._timers[room_name] = (handle, ydoc)
+
+    def cancel(self, room_name: str):
+        pending = self._timers.pop(room_name, None)
+        if pending is not None:
+            pending[0].cancel()
+
+    def flush_room(self, room_name: str):
+        """Materialize now if a write is pending (the room is being evicted)."""
+        pending = self._timers.pop(room_name, None)
+        if pending is None:
+            return
+        handle, ydoc = pending
+        handle.cancel()
+        state = Y.encode_state_as_update(ydoc)
+        previous = self._writes.get(room_name)
+        task = asyncio.create_task(self._write(room_name, state, previous))
+        self._writes[room_name] = task
+        task.add_done_callback(partial(self._forget, room_name))
+
+    def _forget(self, room_name: str, task: asyncio.Task):
+        if self._writes.get(room_name) is task:
+            del self._writes[room_name]
+
+    async def _write(self, room_name: str, state: bytes, previous: asyncio.Task | None):
+        from .utils.tiptap import materialize_page_doc
+
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            if await sync_to_async(materialize_page_doc, thread_sensitive=False)(room_name.split(":", 1)[1], state):
+                self.materialized += 1
+        except Exception:
+            logger.exception("Yjs materialize error", extra={"room": room_name})
+
+
+_yjs_materializer = YjsMaterializer()
+
+
+class YjsRoom:
+    def __init__(self, name: str):
+        self.name = name
+        self.ydoc: Y.YDoc | None = None
+        self.refs = 0
+        self.ready: asyncio.Future | None = None
+        self.evict_handle: asyncio.TimerHandle | None = None
+        self.loaded_at = 0.0
+        # awareness relayed by this process: client id -> (clock, state, loop time)
+        self.awareness: dict[int, tuple[int, str, float]] = {}
+        # update produced by the last transaction on the doc (set by the observer)
+        self.last_update: bytes | None = None
+        # applying an update persisted by another process: don't write it again
+        self.remote = False
+        # when the last local consumer left (the room stops hearing other processes)
+        self.idle_since: float | None = None
+
+
+class YjsRoomRegistry:
+    """
+    One YDoc per room for the whole process, shared by every local consumer.
+
+    The doc is hydrated from the store on first join and persisted by a single
+    observer, so memory per room does not grow with connections. When the last
+    consumer leaves, the doc is kept for YJS_ROOM_IDLE_GRACE seconds and then
+    evicted to its encoded state; encoded rooms are kept in an LRU capped at
+    YJS_ROOM_CACHE_BYTES and fall back to the store once dropped.
+
+    Updates relayed by other processes are applied to the doc too, without
+    persisting them again, so it stays complete while anyone here is in the
+    room; when another process is found in the room, the two exchange what
+    the other is missing (see attach()), which covers updates sent before
+    they knew of each other and not flushed to the store yet. Idle and cached copies stop hearing other processes: they are
+    dropped if the room was restored from a snapshot after they were loaded,
+    and refreshed from the store if it was written to since they went idle.
+    """
+
+    def __init__(self):
+        self._rooms: dict[str, YjsRoom] = {}
+        # room -> (encoded state, time it was loaded from the store, idle since)
+        self._evicted: OrderedDict[str, tuple[bytes, float, float | None]] = OrderedDict()
+        self._evicted_bytes = 0
+
+    @staticmethod
+    def idle_grace() -> float:
+        return getattr(settings, "YJS_ROOM_IDLE_GRACE", 30)
+
+    @staticmethod
+    def cache_bytes() -> int:
+        return getattr(settings, "YJS_ROOM_CACHE_BYTES", 64 * 1024 * 1024)
+
+    def active_rooms(self) -> int:
+        return len(self._rooms)
+
+    def awareness_states(self, room_name: str) -> dict:
+        room = self._rooms.get(room_name)
+        return room.awareness if room is not None else {}
+
+    def apply_update(self, room_name: str, ydoc: Y.YDoc, update: bytes) -> bytes | None:
+        """Apply `update` to a room doc; returns what it actually changed, or None."""
+        room = self._rooms.get(room_name)
+        if room is None or room.ydoc is not ydoc:
+            Y.apply_update(ydoc, update)
+            return None
+        room.last_update = None
+        Y.apply_update(ydoc, update)
+        changed, room.last_update = room.last_update, None
+        return changed
+
+    def apply_remote(self, room_name: str, update: bytes) -> bytes | None:
+        """
+        Apply an update another process persists to the local room doc, if
+        loaded; returns what it actually changed, or None.
+        """
+        room = self._rooms.get(room_name)
+        if room is None or room.ydoc is None:
+            return None
+        # A local edit still waiting for its flush is written as a diff from
+        # before it, so that write may carry this update too; applying an
+        # update twice is a no-op, so the copy is harmless.
+        room.remote = True
+        room.last_update = None
+        try:
+            Y.apply_update(room.ydoc, update)
+        finally:
+            room.remote = False
+        changed, room.last_update = room.last_update, None
+        return changed
+
+    def attach(self, fanout):
+        """
+        Keep the rooms of this registry in step with the other processes of
+        `fanout`: relayed updates are applied to the room docs, and when a
+        process is found in a room or its messages were lost, the two trade
+        state vectors and send each other what the other is missing (the
+        STEP1/STEP2 exchange clients do, between processes).
+        """
+        fanout.on_remote("send_message", self._on_remote_message)
+        fanout.on_remote("yjs.state_vector", partial(self._on_state_vector, fanout))
+        fanout.on_remote("yjs.missing", partial(self._on_missing, fanout))
+        fanout.on_peer(partial(self._send_state_vector, fanout))
+
+    def _group_room(self, group: str) -> YjsRoom | None:
+        for room in self._rooms.values():
+            if room.ydoc is not None and room_group_name(room.name) == group:
+                return room
+        return None
+
+    async def _on_remote_message(self, group: str, event: dict, origin: str | None):
+        room_name, message = event.get("room"), event.get("message")
+        if not room_name or not message or message[0] != YMessageType.SYNC:
+            return
+        if message[1] in (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE):
+            self.apply_remote(room_name, read_message(message[2:]))
+
+    async def _send_state_vector(self, fanout, group: str, origin: str):
+        room = self._group_room(group)
+        if room is None:
+            return
+        state_vector = Y.encode_state_vector(room.ydoc)
+        await fanout.send_to(origin, group, {"type": "yjs.state_vector", "room": room.name, "state": state_vector})
+
+    async def _on_state_vector(self, fanout, group: str, event: dict, origin: str):
+        room = self._rooms.get(event.get("room"))
+        if room is None or room.ydoc is None:
+            return
+        missing = Y.encode_state_as_update(room.ydoc, event["state"])
+        if missing != b"\x00\x00":
+            await fanout.send_to(origin, group, {"type": "yjs.missing", "room": room.name, "update": missing})
+
+    async def _on_missing(self, fanout, group: str, event: dict, origin: str):
+        changed = self.apply_remote(event.get("room"), event["update"])
+        if changed:
+            # local clients never saw it either
+            await fanout.deliver_local(group, {"type": "send_message", "message": create_update_message(changed)})
+
+    async def acquire(self, room_name: str) -> Y.YDoc:
+        room = self._rooms.get(room_name)
+        if room is not None and room.refs == 0 and room.ydoc is not None:
+            reset, changed = await self._store_changes(room_name, room.loaded_at, room.idle_since)
+            if self._rooms.get(room_name) is room and room.refs == 0:
+                if reset:
+                    self.discard(room_name)
+                elif changed:
+                    await self._refresh(room)
+            room = self._rooms.get(room_name)
+        if room is None:
+            room = self._rooms[room_name] = YjsRoom(room_name)
+            room.ready = asyncio.get_running_loop().create_future()
+            room.refs += 1
+            try:
+                await self._hydrate(room)
+            finally:
+                if room.ydoc is None:
+                    room.refs -= 1
+                    if self._rooms.get(room_name) is room:
+                        del self._rooms[room_name]
+                room.ready.set_result(None)
+            return room.ydoc
+
+        room.refs += 1
+        if room.evict_handle is not None:
+            room.evict_handle.cancel()
+            room.evict_handle = None
+        try:
+            await asyncio.shield(room.ready)
+        except BaseException:
+            self.release(room_name)
+            raise
+        if room.ydoc is None:
+            # l'idratazione del primo client è fallita
+            room.refs -= 1
+            raise RuntimeError(f"Yjs room {room_name} could not be loaded")
+        return room.ydoc
+
+    def release(self, room_name: str):
+        room = self._rooms.get(room_name)
+        if room is None or room.refs <= 0:
+            return
+        room.refs -= 1
+        if room.refs:
+            return
+        room.idle_since = time.time()
+        grace = self.idle_grace()
+        if grace <= 0:
+            self._evict(room_name)
+        else:
+            room.evict_handle = asyncio.get_running_loop().call_later(grace, self._evict, room_name)
+
+    def discard(self, room_name: str, ydoc: Y.YDoc | None = None):
+        """
+        Forget a room without persisting its pending changes (after a restore).
+        With `ydoc`, only if that is still the room's doc, so a room already
+        reloaded by a reconnecting client is left alone.
+        """
+        room = self._rooms.get(room_name)
+        if ydoc is not None and (room is None or room.ydoc is not ydoc):
+            return
+        self._rooms.pop(room_name, None)
+        if room is not None:
+            if room.evict_handle is not None:
+                room.evict_handle.cancel()
+            room.ydoc = None
+        _yjs_materializer.cancel(room_name)
+        cached = self._evicted.pop(room_name, None)
+        if cached is not None:
+            self._evicted_bytes -= len(cached[0])
+        _yjs_worker.discard(room_name)
+
+    async def _store_changes(self, room_name: str, loaded_at: float, idle_since: float | None) -> tuple[bool, bool]:
+        """(restored since `loaded_at`, written to since `idle_since`) for a local copy."""
+
+        def read():
+            return last_reset(room_name), last_update_at(room_name)
+
+        reset_at, updated_at = await sync_to_async(read, thread_sensitive=False)()
+        reset = reset_at is not None and reset_at >= loaded_at
+        changed = idle_since is not None and updated_at is not None and updated_at >= idle_since
+        return reset, changed
+
+    async def _refresh(self, room: YjsRoom):
+        # edited through another process while no one here was in the room
+        state, rows, size = await sync_to_async(load_room, thread_sensitive=False)(room.name)
+        _yjs_worker.track_room(room.name, rows, size)
+        if state:
+            self.apply_remote(room.name, state)
+
+    async def _hydrate(self, room: YjsRoom):
+        room_name = room.name
+        state = None
+        cached = self._evicted.pop(room_name, None)
+        if cached is not None:
+            self._evicted_bytes -= len(cached[0])
+            reset, changed = await self._store_changes(room_name, cached[1], cached[2])
+            if not (reset or changed):
+                state, room.loaded_at = cached[0], cached[1]
+        if state is None:
+            room.loaded_at = time.time()
+            state, rows, size = await sync_to_async(load_room, thread_sensitive=False)(room_name)
+            _yjs_worker.track_room(room_name, rows, size)
+
+        ydoc = Y.YDoc()
+        if state:
+            Y.apply_update(ydoc, state)
+        _yjs_worker.ensure_started()
+
+        # Registered after hydration so the stored state is not written back;
+        # a discarded doc still held by a closing consumer is never persisted.
+        def _on_update(event):
+            if room.ydoc is not ydoc:
+                return
+            update = event.get_update()
+            if update != b"\x00\x00":
+                room.last_update = update
+                if room.remote:
+                    return
+                _yjs_worker.enqueue_update(room_name, ydoc, event.before_state)
+                _yjs_materializer.touch(room_name, ydoc)
+
+        ydoc.observe_after_transaction(_on_update)
+        room.ydoc = ydoc
+
+    def _evict(self, room_name: str):
+        room = self._rooms.get(room_name)
+        if room is None or room.refs > 0 or room.ydoc is None:
+            return
+        del self._rooms[room_name]
+        _yjs_materializer.flush_room(room_name)
+        state = Y.encode_state_as_update(room.ydoc)
+        room.ydoc = None
+        limit = self.cache_bytes()
+        if len(state) > limit:
+            return
+        self._evicted[room_name] = (state, room.loaded_at, room.idle_since)
+        self._evicted_bytes += len(state)
+        while self._evicted_bytes > limit:
+            _, (dropped, _, _) = self._evicted.popitem(last=False)
+            self._evicted_bytes -= len(dropped)
+
+
+_yjs_rooms = YjsRoomRegistry()
+_yjs_rooms.attach(_fanout)
+
+# Close code sent to editors of a room restored from a snapshot: their local
+# doc is ahead of the server and must be dropped before reconnecting.
+ROOM_RESET_CLOSE_CODE = 4009
+# Close code for connects shed by admission control; the close reason is
+# "retry-after=<seconds>".
+CONNECT_SHED_CLOSE_CODE = 4029
+
+
+class ConnectAdmission:
+    """
+    Bounds concurrent WebSocket connects (auth, room load, group join and
+    first sync) per process and per room.
+
+    A connect over WS_CONNECT_MAX_CONCURRENT or WS_CONNECT_MAX_PER_ROOM waits
+    in a FIFO queue for at most WS_CONNECT_QUEUE_TIMEOUT seconds. It is shed
+    when the deadline passes or WS_CONNECT_MAX_QUEUE connects are already
+    waiting: the socket is closed with CONNECT_SHED_CLOSE_CODE and a jittered
+    retry delay that grows with the queue, so a reconnect storm spreads out
+    instead of retrying in lockstep.
+    """
 
-    async def _get_store(self, room_name: str) -> SQLiteYStore:
-        store = self._stores.get(room_name)
-        if store:
-            return store
-        store = YjsSQLiteStore(room_name)
-        await store.__aenter__()
-        self._stores[room_name] = store
-        return store
+    def __init__(self):
+        self._active = 0
+        self._rooms: dict[str, int] = {}
+        self._waiters: deque[tuple[str, asyncio.Future]] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    @staticmethod
+    def limits() -> tuple[int, int, int, float]:
+        return (
+            getattr(settings, "WS_CONNECT_MAX_CONCURRENT", 64),
+            getattr(settings, "WS_CONNECT_MAX_PER_ROOM", 16),
+            getattr(settings, "WS_CONNECT_MAX_QUEUE", 1000),
+            getattr(settings, "WS_CONNECT_QUEUE_TIMEOUT", 5.0),
+        )
+
+    def _fits(self, room_name: str, max_total: int, max_room: int) -> bool:
+        return self._active < max_total and self._rooms.get(room_name, 0) < max_room
+
+    def _take(self, room_name: str):
+        self._active += 1
+        self._rooms[room_name] = self._rooms.get(room_name, 0) + 1
+
+    async def acquire(self, room_name: str) -> bool:
+        """Wait for a connect slot; False if the connect must be shed."""
+        max_total, max_room, max_queue, timeout = self.limits()
+        if self._fits(room_name, max_total, max_room):
+            self._take(room_name)
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= max_queue:
+            self.shed += 1
+            return False
+        entry = (room_name, asyncio.get_running_loop().create_future())
+        self._waiters.append(entry)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(entry[1], timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            self._drop(entry)
+            if entry[1].done() and not entry[1].cancelled():
+                # release() gave us a slot just before we stopped waiting
+                self.release(room_name)
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            self.shed += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def _drop(self, entry):
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            pass
+
+    def release(self, room_name: str):
+        self._active -= 1
+        left = self._rooms.get(room_name, 1) - 1
+        if left > 0:
+            self._rooms[room_name] = left
+        else:
+            self._rooms.pop(room_name, None)
+        max_total, max_room, _, _ = self.limits()
+        # hand the slot to the oldest waiter that fits (its room may be full)
+        for entry in list(self._waiters):
+            if self._active >= max_total:
+                break
+            room, future = entry
+            if future.done():
+                self._waiters.remove(entry)
+            elif self._rooms.get(room, 0) < max_room:
+                self._waiters.remove(entry)
+                self._take(room)
+                future.set_result(True)
+
+    def retry_after(self) -> float:
+        max_total, _, _, _ = self.limits()
+        base = getattr(settings, "WS_CONNECT_RETRY_AFTER", 2.0)
+        load = 1 + len(self._waiters) / max(max_total, 1)
+        return round(min(base * load * random.uniform(1, 2), 60), 1)
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+        }
+
+
+_connect_admission = ConnectAdmission()
+
+
+async def _shed_connect(consumer, room_name: str, accepted: bool = False):
+    # the close code only reaches the client on an accepted socket
+    retry = _connect_admission.retry_after()
+    logger.warning(
+        "WS connect shed",
+        extra={"room": room_name, "retry_after": retry, **_connect_admission.stats()},
+    )
+    if not accepted:
+        await consumer.accept()
+    await consumer.close(code=CONNECT_SHED_CLOSE_CODE, reason=f"retry-after={retry}")
+
+
+# Close codes for clients over the per-connection limits (RFC 6455).
+FRAME_TOO_BIG_CLOSE_CODE = 1009
+RATE_LIMIT_CLOSE_CODE = 1008
+
+
+class ClientLimitStats:
+    """
+    Counters of connections hitting the per-connection frame limits: totals,
+    plus per (user id, room) counts for the most recent offenders.
+    """
+
+    keep = 200
+
+    def __init__(self):
+        self.totals = self._counters()
+        self._offenders: OrderedDict[tuple[str | None, str], dict] = OrderedDict()
+
+    @staticmethod
+    def _counters() -> dict:
+        return {"throttled": 0, "throttled_seconds": 0.0, "oversize": 0, "disconnected": 0}
+
+    def record(self, user_id, room_name: str, kind: str, delay: float = 0.0):
+        key = (user_id, room_name)
+        entry = self._offenders.pop(key, None) or self._counters()
+        for counters in (self.totals, entry):
+            counters[kind] += 1
+            counters["throttled_seconds"] += delay
+        self._offenders[key] = entry
+        while len(self._offenders) > self.keep:
+            self._offenders.popitem(last=False)
+
+    def stats(self, top: int = 10) -> dict:
+        worst = sorted(
+            self._offenders.items(),
+            key=lambda item: (item[1]["disconnected"] + item[1]["oversize"], item[1]["throttled_seconds"]),
+            reverse=True,
+        )[:top]
+        return {
+            **self.totals,
+            "offenders": [{"user_id": user, "room": room, **counters} for (user, room), counters in worst],
+        }
+
+
+_client_limits = ClientLimitStats()
+
+
+def realtime_stats() -> dict:
+    """Counters of this process's realtime stack, for alerting."""
+    return {
+        "persistence": _yjs_worker.stats(),
+        "connects": _connect_admission.stats(),
+        "client_limits": _client_limits.stats(),
+        "fanout": dict(_fanout.stats),
+    }
+
+
+class RealtimeStatsLog:
+    """
+    Logs realtime_stats() every WS_STATS_LOG_INTERVAL seconds as one
+    structured line ("Realtime stats", counters in `stats`), so every
+    process reports its own queues even with no one polling the endpoint.
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def interval() -> float:
+        return getattr(settings, "WS_STATS_LOG_INTERVAL", 60.0)
+
+    def ensure_started(self):
+        if self.interval() <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
 
     async def _run(self):
         while True:
-            kind, room_name, update = await self._queue.get()
+            await asyncio.sleep(self.interval())
             try:
-                if kind == "write":
-                    store = await self._get_store(room_name)
-                    await store.write(update)
+                logger.info("Realtime stats", extra={"stats": realtime_stats()})
             except Exception:
-                logger.exception("Yjs persistence worker error", extra={"room": room_name})
+                logger.exception("Realtime stats log failed")
+
+
+_stats_log = RealtimeStatsLog()
 
 
-_yjs_worker = YjsPersistenceWorker()
+def room_group_name(raw_room: str) -> str:
+    safe = (
+        raw_room.replace(":", "_")
+        .replace("/", "_")
+        .replace(" ", "_")
+    )
+    return safe[:95]
+
+
+def _query_params(scope) -> tuple[str | None, str | None]:
+    """(token, ticket) from the connect URL's query string."""
+    try:
+        params = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+    except Exception:
+        return None, None
+    return params.get("token", [None])[0], params.get("ticket", [None])[0]
 
 
 @sync_to_async
@@ -69,81 +917,163 @@ def _get_user_from_token(token_key: str | None):
         return None
 
 
-@sync_to_async
-def _user_has_page_access(page_id: str, user) -> bool:
+def _page_role(page_id: str, user) -> str | None:
     if not user or not user.is_authenticated:
-        return False
+        return None
     from .models import Page, PageCollaborator
     if Page.objects.filter(pk=page_id, owner=user).exists():
-        return True
-    return PageCollaborator.objects.filter(page_id=page_id, user=user).exists()
+        return CollaborationRole.OWNER
+    return PageCollaborator.objects.filter(page_id=page_id, user=user).values_list("role", flat=True).first()
+
+
+@sync_to_async
+def _user_has_page_access(page_id: str, user) -> bool:
+    return _page_role(page_id, user) is not None
+
+
+_user_page_role = sync_to_async(_page_role)
 
 
 class YjsDocumentConsumer(YjsConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._raw_room = None
+        self.page_role = None
+        self.user_id = None
         self._closing = False
+        # per-connection token buckets (messages/s, bytes/s), made on first frame
+        self._rate_buckets: tuple[TokenBucket, TokenBucket] | None = None
+        self._room_acquired = False
+        # awareness waiting for fan-out: client id -> (clock, state)
+        self._awareness: dict[int, tuple[int, str]] = {}
+        self._awareness_seen: dict = {}
+        self._awareness_sent_at = 0.0
+        self._awareness_timer: asyncio.TimerHandle | None = None
+        self._awareness_task: asyncio.Task | None = None
 
     def make_room_name(self) -> str:
         raw = self.scope["url_route"]["kwargs"]["room"]
         self._raw_room = raw
-        safe = (
-            raw.replace(":", "_")
-            .replace("/", "_")
-            .replace(" ", "_")
-        )
-        return safe[:95]
+        return room_group_name(raw)
 
     async def make_ydoc(self) -> Y.YDoc:
-        ydoc = Y.YDoc()
         raw_room = self._raw_room or self.scope["url_route"]["kwargs"]["room"]
-        _yjs_worker.ensure_started()
+        ydoc = await _yjs_rooms.acquire(raw_room)
+        self._room_acquired = True
+        self._awareness_seen = _yjs_rooms.awareness_states(raw_room)
+        return ydoc
 
-        def _on_update(event):
-            update = event.get_update()
-            asyncio.create_task(_yjs_worker.enqueue_update(raw_room, update))
+    @staticmethod
+    def awareness_interval() -> float:
+        return getattr(settings, "YJS_AWARENESS_INTERVAL", 0.1)
 
-        ydoc.observe_after_transaction(_on_update)
-        return ydoc
+    async def _relay_awareness(self, message: bytes):
+        """
+        Coalesce awareness per client id before fan-out.
+
+        Clients re-broadcast every awareness change they receive, so the same
+        (client, clock) comes back from each member of the room; states not
+        newer than the last one relayed by this process are dropped, and the
+        rest is sent at most once per YJS_AWARENESS_INTERVAL per connection.
+        """
+        try:
+            entries = decode_awareness(message)
+        except Exception:
+            await self.group_send_message(message)
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        for client, clock, state in entries:
+            known = self._awareness_seen.get(client)
+            if known is not None and clock <= known[0]:
+                continue
+            self._awareness_seen[client] = (clock, state, now)
+            self._awareness[client] = (clock, state)
+        if not self._awareness or self._awareness_timer is not None:
+            return
+        wait = self._awareness_sent_at + self.awareness_interval() - now
+        if wait <= 0:
+            await self._flush_awareness()
+        else:
+            self._awareness_timer = loop.call_later(wait, self._awareness_due)
+
+    def _awareness_due(self):
+        self._awareness_task = asyncio.create_task(self._flush_awareness())
+
+    async def _flush_awareness(self):
+        if self._awareness_timer is not None:
+            self._awareness_timer.cancel()
+            self._awareness_timer = None
+        if not self._awareness:
+            return
+        pending, self._awareness = self._awareness, {}
+        self._awareness_sent_at = asyncio.get_running_loop().time()
+        await self.group_send_message(
+            encode_awareness([(client, clock, state) for client, (clock, state) in pending.items()])
+        )
+
+    async def _send_known_awareness(self):
+        # i nuovi client vedono subito i cursori, senza aspettare il rinnovo a 15s
+        now = asyncio.get_running_loop().time()
+        states = []
+        for client, (clock, state, seen_at) in list(self._awareness_seen.items()):
+            if now - seen_at > AWARENESS_TIMEOUT:
+                del self._awareness_seen[client]
+            elif state != "null":
+                states.append((client, clock, state))
+        if states:
+            await self.send(bytes_data=encode_awareness(states))
 
     async def connect(self):
         self._closing = False
         raw_room = self.scope["url_route"]["kwargs"]["room"]
-        token_key = None
+        _stats_log.ensure_started()
+        if not await _connect_admission.acquire(raw_room):
+            await _shed_connect(self, raw_room)
+            return
         try:
-            raw_qs = self.scope.get("query_string", b"").decode("utf-8")
-            token_key = parse_qs(raw_qs).get("token", [None])[0]
-        except Exception:
-            token_key = None
+            await self._connect(raw_room)
+        finally:
+            _connect_admission.release(raw_room)
+
+    async def _connect(self, raw_room: str):
+        token_key, ticket = _query_params(self.scope)
 
         logger.info(
             "WS connect attempt",
-            extra={"room": raw_room, "token_present": bool(token_key)},
+            extra={"room": raw_room, "token_present": bool(token_key), "ticket_present": bool(ticket)},
         )
        # logger.info("room:", raw_room)
 
-        user = await _get_user_from_token(token_key)
-        if not user:
-            user = self.scope.get("user")
-
-        if not user or not getattr(user, "is_authenticated", False):
-            logger.warning(
-                "WS auth failed", extra={"room": raw_room, "token_present": bool(token_key)}
-            )
-            await self.close(code=4001)
-            return
+        grant = read_ticket(ticket, raw_room)
+        if grant:
+            # signed ticket: user and access checked when it was issued
+            user_id, self.page_role = grant["u"], grant["role"]
+        else:
+            user = await _get_user_from_token(token_key)
+            if not user:
+                user = self.scope.get("user")
 
-        if raw_room.startswith("page:"):
-            page_id = raw_room.split(":", 1)[1]
-            allowed = await _user_has_page_access(page_id, user)
-            if not allowed:
+            if not user or not getattr(user, "is_authenticated", False):
                 logger.warning(
-                    "WS access denied", extra={"room": raw_room, "user_id": str(user.id)}
+                    "WS auth failed", extra={"room": raw_room, "token_present": bool(token_key)}
                 )
-                await self.close(code=4003)
+                await self.close(code=4001)
                 return
+            user_id = str(user.id)
 
+            if raw_room.startswith("page:"):
+                page_id = raw_room.split(":", 1)[1]
+                self.page_role = await _user_page_role(page_id, user)
+                if self.page_role is None:
+                    logger.warning(
+                        "WS access denied", extra={"room": raw_room, "user_id": user_id}
+                    )
+                    await self.close(code=4003)
+                    return
+
+        self.user_id = user_id
+        accepted = False
         try:
             self.room_name = self.make_room_name()
             logger.info("WS make_ydoc start", extra={"room": raw_room})
@@ -152,20 +1082,23 @@ class YjsDocumentConsumer(YjsConsumer):
             self._websocket_shim = self._make_websocket_shim(self.scope["path"])
 
             logger.info("WS group_add start", extra={"room": raw_room})
-            await asyncio.wait_for(
-                self.channel_layer.group_add(self.room_name, self.channel_name),
-                timeout=1.0,
-            )
+            await asyncio.wait_for(_fanout.join(self.room_name, self), timeout=1.0)
             logger.info("WS group_add done", extra={"room": raw_room})
 
             await self.accept()
-            logger.info("WS accepted", extra={"room": raw_room, "user_id": str(user.id)})
+            accepted = True
+            logger.info("WS accepted", extra={"room": raw_room, "user_id": user_id})
 
-            await asyncio.wait_for(sync(self.ydoc, self._websocket_shim, logger), timeout=1.0)
+            await asyncio.wait_for(
+                self.send(bytes_data=create_sync_step1_message(Y.encode_state_vector(self.ydoc))),
+                timeout=1.0,
+            )
             logger.info("WS synced", extra={"room": raw_room})
+            await self._send_known_awareness()
         except asyncio.TimeoutError:
+            # overloaded rather than broken: ask the client to back off
             logger.warning("WS connect timeout", extra={"room": raw_room})
-            await self.close(code=1011)
+            await _shed_connect(self, raw_room, accepted=accepted)
             return
         except Exception:
             logger.exception("WS connect error", extra={"room": raw_room})
@@ -176,58 +1109,184 @@ class YjsDocumentConsumer(YjsConsumer):
         self._closing = True
         raw_room = self._raw_room or self.scope["url_route"]["kwargs"]["room"]
         logger.info("WS disconnect", extra={"room": raw_room, "code": code})
-        await super().disconnect(code)
-        self.ydoc = None
+        try:
+            # last awareness (usually the removal of this client's cursor)
+            await self._flush_awareness()
+        except Exception:
+            logger.warning("WS awareness flush failed", extra={"room": raw_room})
+        try:
+            if getattr(self, "room_name", None):
+                await _fanout.leave(self.room_name, self)
+        finally:
+            self.ydoc = None
+            if self._room_acquired:
+                self._room_acquired = False
+                _yjs_rooms.release(raw_room)
 
     async def receive(self, text_data=None, bytes_data=None):
         if self._closing or bytes_data is None or self.ydoc is None:
             return
         if not self._websocket_shim:
             return
+        if not await self._within_limits(len(bytes_data)):
+            return
         try:
-            await self.group_send_message(bytes_data)
+            if bytes_data[0] == YMessageType.AWARENESS:
+                await self._relay_awareness(bytes_data)
+                return
             if bytes_data[0] != YMessageType.SYNC:
+                await self.group_send_message(bytes_data)
                 return
-            await process_sync_message(
-                bytes_data[1:], self.ydoc, self._websocket_shim, logger
-            )
+            await self._handle_sync(bytes_data)
         except RuntimeError:
             raw_room = self._raw_room or self.scope["url_route"]["kwargs"]["room"]
             logger.warning("WS receive ignored (ydoc closed)", extra={"room": raw_room})
 
+    @staticmethod
+    def frame_limits() -> tuple[int, float, float, float, float, float]:
+        return (
+            getattr(settings, "YJS_MAX_FRAME_BYTES", 4 * 1024 * 1024),
+            getattr(settings, "YJS_RATE_MESSAGES", 50),
+            getattr(settings, "YJS_RATE_MESSAGES_BURST", 200),
+            getattr(settings, "YJS_RATE_BYTES", 1024 * 1024),
+            getattr(settings, "YJS_RATE_BYTES_BURST", 8 * 1024 * 1024),
+            getattr(settings, "YJS_RATE_MAX_DELAY", 2.0),
+        )
+
+    async def _within_limits(self, size: int) -> bool:
+        """
+        Apply the per-connection limits to an incoming frame.
+
+        Frames over YJS_MAX_FRAME_BYTES close the socket (1009). Otherwise the
+        frame is charged to a messages/s and a bytes/s token bucket; a client
+        in debt is throttled by delaying its frame (which also stops reading
+        from its socket), and one that would have to wait more than
+        YJS_RATE_MAX_DELAY seconds is disconnected (1008).
+        """
+        max_frame, msg_rate, msg_burst, byte_rate, byte_burst, max_delay = self.frame_limits()
+        room_name = self._raw_room or self.scope["url_route"]["kwargs"]["room"]
+        if max_frame and size > max_frame:
+            _client_limits.record(self.user_id, room_name, "oversize")
+            logger.warning(
+                "WS frame too big", extra={"room": room_name, "user_id": self.user_id, "size": size}
+            )
+            await self._close_over_limit(FRAME_TOO_BIG_CLOSE_CODE)
+            return False
+        if self._rate_buckets is None:
+            # the byte burst always fits one maximum-size frame
+            self._rate_buckets = (
+                TokenBucket(msg_rate, msg_burst),
+                TokenBucket(byte_rate, max(byte_burst, max_frame)),
+            )
+        messages, bytes_ = self._rate_buckets
+        wait = max(messages.take(1), bytes_.take(size))
+        if not wait:
+            return True
+        if wait > max_delay:
+            _client_limits.record(self.user_id, room_name, "disconnected")
+            logger.warning(
+                "WS rate limit exceeded", extra={"room": room_name, "user_id": self.user_id, "wait": wait}
+            )
+            await self._close_over_limit(RATE_LIMIT_CLOSE_CODE)
+            return False
+        _client_limits.record(self.user_id, room_name, "throttled", wait)
+        await asyncio.sleep(wait)
+        return not self._closing and self.ydoc is not None
+
+    async def _close_over_limit(self, code: int):
+        self._closing = True
+        await self.close(code=code)
+
+    async def group_send_message(self, message: bytes):
+        # local members directly, other processes through the channel layer
+        await _fanout.send(
+            self.room_name, {"type": "send_message", "message": message, "room": self._raw_room}, self.channel_layer
+        )
+
+    async def _handle_sync(self, message: bytes):
+        """
+        Answer handshakes from the server doc and fan out only new content.
+
+        SYNC_STEP1 is answered to the requester alone. For SYNC_STEP2 and
+        SYNC_UPDATE the doc is updated first, and only what it actually
+        changed is relayed, so a reconnecting client costs the room its
+        delta instead of its full state. Viewers only sync down: their
+        SYNC_STEP2/SYNC_UPDATE frames are dropped.
+        """
+        kind = message[1]
+        payload = read_message(message[2:])
+        if kind == YSyncMessageType.SYNC_STEP1:
+            await self.send(bytes_data=create_sync_step2_message(Y.encode_state_as_update(self.ydoc, payload)))
+            return
+        if kind not in (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE):
+            return
+        if self.page_role == CollaborationRole.VIEWER:
+            return
+        if payload == b"\x00\x00":
+            return
+        # backpressure: apply no further updates while the shard is full
+        await _yjs_worker.wait_for_capacity(self._raw_room)
+        changed = _yjs_rooms.apply_update(self._raw_room, self.ydoc, payload)
+        if not changed:
+            return
+        if kind == YSyncMessageType.SYNC_UPDATE and changed == payload:
+            await self.group_send_message(message)
+        else:
+            await self.group_send_message(create_update_message(changed))
+
+    async def room_reset(self, event):
+        """The room was restored from a snapshot: drop our copy and the client."""
+        self._closing = True
+        if self._awareness_timer is not None:
+            self._awareness_timer.cancel()
+            self._awareness_timer = None
+        self._awareness.clear()
+        if self._room_acquired:
+            self._room_acquired = False
+            _yjs_rooms.discard(self._raw_room, self.ydoc)
+        self.ydoc = None
+        await self.close(code=ROOM_RESET_CLOSE_CODE)
+
 
 class CommentsConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         page_id = self.scope["url_route"]["kwargs"].get("page_id")
-        token_key = None
+        room_name = f"comments:{page_id}"
+        _stats_log.ensure_started()
+        if not await _connect_admission.acquire(room_name):
+            await _shed_connect(self, room_name)
+            return
         try:
-            raw_qs = self.scope.get("query_string", b"").decode("utf-8")
-            token_key = parse_qs(raw_qs).get("token", [None])[0]
-        except Exception:
-            token_key = None
+            await self._connect(page_id)
+        finally:
+            _connect_admission.release(room_name)
 
-        user = await _get_user_from_token(token_key)
-        if not user:
-            user = self.scope.get("user")
+    async def _connect(self, page_id):
+        token_key, ticket = _query_params(self.scope)
 
-        if not user or not getattr(user, "is_authenticated", False):
-            await self.close(code=4001)
-            return
+        if not read_ticket(ticket, f"page:{page_id}"):
+            user = await _get_user_from_token(token_key)
+            if not user:
+                user = self.scope.get("user")
 
-        allowed = await _user_has_page_access(page_id, user)
-        if not allowed:
-            await self.close(code=4003)
-            return
+            if not user or not getattr(user, "is_authenticated", False):
+                await self.close(code=4001)
+                return
+
+            allowed = await _user_has_page_access(page_id, user)
+            if not allowed:
+                await self.close(code=4003)
+                return
 
         self.page_id = str(page_id)
         self.group_name = f"comments_page_{self.page_id}"
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await _fanout.join(self.group_name, self)
         await self.accept()
 
     async def disconnect(self, code):
         group = getattr(self, "group_name", None)
         if group:
-            await self.channel_layer.group_discard(group, self.channel_name)
+            await _fanout.leave(group, self)
 
     async def receive_json(self, content, **kwargs):
         return
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+from collections import deque
+
+from asgiref.sync import async_to_sync
+from channels.consumer import get_handler_name
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger("core.yjs")
+
+
+class RoomFanout:
+    """
+    Group messaging that delivers to local members in-process.
+
+    Instead of one channel-layer membership per connection, each process
+    joins a group once, with its own channel, and calls the handlers of its
+    local consumers directly. A message goes through the layer (Redis) only
+    when another process is known to have members of the group.
+
+    Processes find each other per group: the first local member makes the
+    process announce itself ("fanout.join"), processes already in the group
+    answer "fanout.here", and the last member leaving sends "fanout.leave".
+    A process that dies without leaving only costs extra publishes. Senders
+    with no local member of the group (the HTTP views) always publish.
+
+    Process-level hooks registered with on_remote() see every event that
+    arrives from another process, before it is handed to local consumers.
+    Hooks registered with on_peer() run when another process is found in a
+    group and when messages it published were lost: the layer drops
+    messages to a full channel without telling the sender, so published
+    messages carry a per-group sequence number and a gap counts as a drop.
+    Peers can then catch up with messages sent to them alone (send_to()).
+
+    Incoming messages are handled in order within a group, but each group
+    has its own queue, so a slow room does not hold up the others.
+    """
+
+    channel_prefix = "fanout"
+
+    def __init__(self):
+        self._loop = None
+        self._layer = None
+        # event type -> callbacks for events published by other processes
+        self._hooks: dict[str, list] = {}
+        self._peer_hooks: list = []
+        self._reset()
+        self.stats = {
+            "local_deliveries": 0,
+            "published": 0,
+            "publish_skipped": 0,
+            "remote_received": 0,
+            "layer_ops": 0,
+            "dropped": 0,
+            "resyncs": 0,
+        }
+
+    def _reset(self):
+        # group -> local consumers; group -> channels of other member processes
+        self._members: dict[str, set] = {}
+        self._remote: dict[str, set[str]] = {}
+        self._channel: str | None = None
+        self._opening: asyncio.Future | None = None
+        self._tasks: list[asyncio.Task] = []
+        # group -> last sequence number published; (group, origin) -> last one seen
+        self._sequence: dict[str, int] = {}
+        self._seen: dict[tuple[str, str], int] = {}
+        # group -> incoming messages waiting for that group's handler task
+        self._inbox: dict[str, deque] = {}
+        self._handlers: set[asyncio.Task] = set()
+
+    def _bind(self, layer):
+        loop = asyncio.get_running_loop()
+        if loop is self._loop and layer is self._layer:
+            return
+        for task in [*self._tasks, *self._handlers]:
+            if not task.get_loop().is_closed():
+                task.cancel()
+        self._loop, self._layer = loop, layer
+        self._reset()
+
+    def stop(self):
+        for task in [*self._tasks, *self._handlers]:
+            task.cancel()
+        self._tasks = []
+        self._handlers = set()
+
+    @property
+    def channel_name(self) -> str | None:
+        return self._channel
+
+    def on_remote(self, event_type: str, callback):
+        """Await `callback(group, event, origin)` for each `event_type` event from another process."""
+        self._hooks.setdefault(event_type, []).append(callback)
+
+    def on_peer(self, callback):
+        """Await `callback(group, origin)` when a process joins a group or its messages were lost."""
+        self._peer_hooks.append(callback)
+
+    async def _run_hooks(self, group: str, event: dict, origin: str | None):
+        for callback in self._hooks.get(event.get("type"), ()):
+            try:
+                await callback(group, event, origin)
+            except Exception:
+                logger.exception("Fan-out remote hook failed", extra={"group": group})
+
+    async def _resync(self, group: str, origin: str):
+        self.stats["resyncs"] += 1
+        for callback in self._peer_hooks:
+            try:
+                await callback(group, origin)
+            except Exception:
+                logger.exception("Fan-out peer hook failed", extra={"group": group})
+
+    def remote_processes(self, group: str) -> int:
+        return len(self._remote.get(group, ()))
+
+    async def _call(self, method: str, *args):
+        self.stats["layer_ops"] += 1
+        return await getattr(self._layer, method)(*args)
+
+    async def _open(self) -> str:
+        self._channel = await self._layer.new_channel(self.channel_prefix)
+        self._tasks = [asyncio.create_task(self._read()), asyncio.create_task(self._refresh())]
+        return self._channel
+
+    async def _channel_name(self) -> str:
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open())
+        return await self._opening
+
+    async def join(self, group: str, consumer):
+        self._bind(consumer.channel_layer)
+        members = self._members.setdefault(group, set())
+        first = not members
+        members.add(consumer)
+        if not first:
+            return
+        channel = await self._channel_name()
+        await self._call("group_add", group, channel)
+        await self._call(
+            "group_send",
+            group,
+            {"type": "fanout.join", "group": group, "origin": channel, "seq": self._sequence.get(group, 0)},
+        )
+
+    async def leave(self, group: str, consumer):
+        members = self._members.get(group)
+        if not members or consumer not in members:
+            return
+        members.discard(consumer)
+        if members:
+            return
+        del self._members[group]
+        remote = self._remote.pop(group, None)
+        self._forget(group)
+        channel = self._channel
+        await self._call("group_discard", group, channel)
+        if group in self._members:
+            # someone joined again while we were leaving
+            await self._call("group_add", group, channel)
+        elif remote:
+            await self._call("group_send", group, {"type": "fanout.leave", "group": group, "origin": channel})
+
+    async def send(self, group: str, event: dict, layer=None):
+        """Deliver `event` to every member of `group`, like group_send."""
+        self._bind(layer or get_channel_layer())
+        if group in self._members:
+            await self._deliver(group, event)
+            if not self._remote.get(group):
+                self.stats["publish_skipped"] += 1
+                return
+        sequence = self._sequence[group] = self._sequence.get(group, 0) + 1
+        await self._call(
+            "group_send",
+            group,
+            {"type": "fanout.message", "group": group, "origin": self._channel, "seq": sequence, "event": event},
+        )
+        self.stats["published"] += 1
+
+    async def send_to(self, channel: str, group: str, event: dict):
+        """Send `event` to the process behind `channel` only; its members don't receive it."""
+        await self._call(
+            "send",
+            channel,
+            {"type": "fanout.direct", "group": group, "origin": await self._channel_name(), "event": event},
+        )
+
+    async def deliver_local(self, group: str, event: dict):
+        """Deliver `event` to the local members of `group` only."""
+        await self._deliver(group, event)
+
+    async def _deliver(self, group: str, event: dict):
+        name = get_handler_name(event)
+        for consumer in list(self._members.get(group, ())):
+            handler = getattr(consumer, name, None)
+            if handler is None:
+                continue
+            try:
+                await handler(event)
+            except Exception:
+                logger.exception("Local fan-out delivery failed", extra={"group": group})
+            self.stats["local_deliveries"] += 1
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._layer.receive(self._channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Fan-out channel receive failed")
+                await asyncio.sleep(1)
+                continue
+            origin = message.get("origin")
+            if origin is not None and origin == self._channel:
+                continue
+            group = message.get("group")
+            inbox = self._inbox.get(group)
+            if inbox is None:
+                inbox = self._inbox[group] = deque()
+                task = asyncio.create_task(self._drain(group, inbox))
+                self._handlers.add(task)
+                task.add_done_callback(self._handlers.discard)
+            inbox.append(message)
+
+    async def _drain(self, group: str, inbox: deque):
+        try:
+            while inbox:
+                try:
+                    await self._handle(group, inbox.popleft())
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Fan-out message handling failed", extra={"group": group})
+        finally:
+            if self._inbox.get(group) is inbox:
+                del self._inbox[group]
+
+    async def _handle(self, group: str, message: dict):
+        kind, origin = message.get("type"), message.get("origin")
+        if kind == "fanout.message":
+            self.stats["remote_received"] += 1
+            if origin and group in self._members:
+                self._remote.setdefault(group, set()).add(origin)
+            lost = self._track_sequence(group, origin, message.get("seq"))
+            await self._run_hooks(group, message["event"], origin)
+            await self._deliver(group, message["event"])
+            if lost and group in self._members:
+                await self._resync(group, origin)
+        elif kind == "fanout.direct" and group in self._members:
+            await self._run_hooks(group, message["event"], origin)
+        elif kind == "fanout.join" and group in self._members:
+            self._remote.setdefault(group, set()).add(origin)
+            self._seen.setdefault((group, origin), message.get("seq", 0))
+            here = {"type": "fanout.here", "group": group, "origin": self._channel, "seq": self._sequence.get(group, 0)}
+            await self._call("send", origin, here)
+            await self._resync(group, origin)
+        elif kind == "fanout.here" and group in self._members:
+            self._remote.setdefault(group, set()).add(origin)
+            self._seen.setdefault((group, origin), message.get("seq", 0))
+            await self._resync(group, origin)
+        elif kind == "fanout.leave":
+            self._remote.get(group, set()).discard(origin)
+            self._seen.pop((group, origin), None)
+
+    def _track_sequence(self, group: str, origin: str | None, sequence: int | None) -> bool:
+        """Record the sequence number of a message; True if messages before it were lost."""
+        if origin is None or sequence is None:
+            return False
+        last = self._seen.get((group, origin))
+        self._seen[(group, origin)] = sequence
+        if last is None or sequence <= last + 1:
+            return False
+        self.stats["dropped"] += sequence - last - 1
+        logger.warning("Fan-out messages lost", extra={"group": group, "lost": sequence - last - 1})
+        return True
+
+    def _forget(self, group: str):
+        for key in [key for key in self._seen if key[0] == group]:
+            del self._seen[key]
+
+    async def _refresh(self):
+        # channels_redis drops group members older than group_expiry
+        interval = max(getattr(self._layer, "group_expiry", 86400) / 2, 1)
+        while True:
+            await asyncio.sleep(interval)
+            for group in list(self._members):
+                try:
+                    await self._call("group_add", group, self._channel)
+                except Exception:
+                    logger.warning("Fan-out group refresh failed", extra={"group": group})
+
+
+_fanout = RoomFanout()
+
+
+def broadcast(group: str, event: dict):
+    """Send `event` to `group` from sync code (views)."""
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    async_to_sync(_fanout.send)(group, event, layer)
@@ -0,0 +1,135 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from channels.layers import InMemoryChannelLayer, channel_layers, get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from core.fanout import RoomFanout
+
+
+class _CountingLayer:
+    """Channel layer proxy counting the calls that reach the backend (Redis)."""
+
+    def __init__(self, layer):
+        self._layer = layer
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._layer, name)
+        if name not in {"send", "receive", "group_send", "group_add", "group_discard", "new_channel"}:
+            return attr
+
+        async def counted(*args, **kwargs):
+            self.calls += 1
+            return await attr(*args, **kwargs)
+
+        return counted
+
+
+class _Member:
+    def __init__(self, layer, received):
+        self.channel_layer = layer
+        self._received = received
+
+    async def send_message(self, event):
+        self._received(event)
+
+
+def _layers(alias: str, processes: int) -> list:
+    base = get_channel_layer(alias)
+    if base is None:
+        raise CommandError(f"no channel layer {alias!r}")
+    if isinstance(base, InMemoryChannelLayer):
+        # in-memory layers do not talk to each other: share one as the "Redis"
+        return [base] * processes
+    return [channel_layers.make_backend(alias) for _ in range(processes)]
+
+
+async def _run(mode: str, alias: str, processes: int, members: int, messages: int, size: int):
+    layers = [_CountingLayer(layer) for layer in _layers(alias, processes)]
+    group = f"bench_{uuid.uuid4().hex}"
+    pending = {"left": 0, "done": None}
+    latencies = []
+
+    def received(event):
+        pending["left"] -= 1
+        if pending["left"] == 0:
+            pending["done"].set()
+
+    tasks, cleanup = [], []
+    fanouts = [RoomFanout() for _ in layers]
+    for i in range(members):
+        layer = layers[i % processes]
+        member = _Member(layer, received)
+        if mode == "hybrid":
+            fanout = fanouts[i % processes]
+            await fanout.join(group, member)
+            cleanup.append(fanout.leave(group, member))
+        else:
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+
+            async def read(layer=layer, channel=channel, member=member):
+                while True:
+                    await member.send_message(await layer.receive(channel))
+
+            tasks.append(asyncio.create_task(read()))
+            cleanup.append(layer.group_discard(group, channel))
+    # let the fan-outs find each other
+    await asyncio.sleep(0.2)
+
+    calls_before = sum(layer.calls for layer in layers)
+    payload = b"\x00" * size
+    for _ in range(messages):
+        pending["left"], pending["done"] = members, asyncio.Event()
+        event = {"type": "send_message", "message": payload}
+        started = time.perf_counter()
+        if mode == "hybrid":
+            await fanouts[0].send(group, event, layers[0])
+        else:
+            await layers[0].group_send(group, event)
+        await asyncio.wait_for(pending["done"].wait(), 5)
+        latencies.append(time.perf_counter() - started)
+    calls = sum(layer.calls for layer in layers) - calls_before
+
+    for step in cleanup:
+        await step
+    for task in tasks:
+        task.cancel()
+    for fanout in fanouts:
+        fanout.stop()
+    latencies.sort()
+    return {
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "ops_per_message": calls / messages,
+    }
+
+
+class Command(BaseCommand):
+    help = "Benchmark Yjs/comment fan-out: channel-layer group_send vs in-process delivery."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--layer", default="default", help="CHANNEL_LAYERS alias to measure")
+        parser.add_argument("--members", type=int, default=8, help="Connections per room")
+        parser.add_argument("--processes", default="1,2,4", help="Comma separated process counts")
+        parser.add_argument("--messages", type=int, default=300)
+        parser.add_argument("--size", type=int, default=64, help="Message size in bytes")
+
+    def handle(self, *args, **options):
+        processes = [int(p) for p in options["processes"].split(",") if p]
+        self.stdout.write(
+            f"{options['members']} members per room, {options['messages']} messages of {options['size']} bytes"
+        )
+        self.stdout.write(f"{'processes':>9} {'mode':<10} {'mean ms':>8} {'p95 ms':>8} {'layer ops/msg':>14}")
+        for count in processes:
+            for mode in ("group_send", "hybrid"):
+                result = asyncio.run(
+                    _run(mode, options["layer"], count, options["members"], options["messages"], options["size"])
+                )
+                self.stdout.write(
+                    f"{count:>9} {mode:<10} {result['mean_ms']:>8.3f} {result['p95_ms']:>8.3f} "
+                    f"{result['ops_per_message']:>14.2f}"
+                )
@@ -0,0 +1,83 @@
+import time
+
+from django.core.management.base import BaseCommand
+from fractional_indexing import generate_key_between
+
+from core.utils.positions import POSITION_MAX_LENGTH, evenly_spaced_keys, keys_between
+
+
+def _insert_index(pattern: str, keys: list[str], step: int) -> int:
+    """Index at which the next key is inserted (between keys[i-1] and keys[i])."""
+    if pattern == "append":
+        return len(keys)
+    if pattern == "prepend":
+        return 0
+    if pattern == "same-spot":
+        return 1  # always right after the first sibling
+    if pattern == "alternate":
+        # zig-zag around the newest key so both neighbours keep shrinking
+        return 1 + (step % 2)
+    raise ValueError(pattern)
+
+
+def simulate(pattern: str, inserts: int, threshold: int | None):
+    keys = evenly_spaced_keys(2)
+    max_len = 0
+    first_overflow = None
+    rebalances = 0
+    for step in range(inserts):
+        i = min(_insert_index(pattern, keys, step), len(keys))
+        prev = keys[i - 1] if i > 0 else None
+        nxt = keys[i] if i < len(keys) else None
+        key = generate_key_between(prev, nxt)
+        keys.insert(i, key)
+        max_len = max(max_len, len(key))
+        if first_overflow is None and len(key) > POSITION_MAX_LENGTH:
+            first_overflow = step + 1
+        if threshold is not None and len(key) > threshold:
+            keys = evenly_spaced_keys(len(keys))
+            rebalances += 1
+    return max_len, first_overflow, rebalances
+
+
+class Command(BaseCommand):
+    help = "Benchmark fractional-index key growth under adversarial insertion patterns."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--inserts", type=int, default=2000)
+        parser.add_argument("--threshold", type=int, default=24, help="Rebalance length threshold")
+
+    def handle(self, *args, **options):
+        inserts = options["inserts"]
+        threshold = options["threshold"]
+
+        self.stdout.write(f"{inserts} inserts per pattern, column limit {POSITION_MAX_LENGTH}")
+        self.stdout.write(f"{'pattern':<10} {'max len':>8} {'overflow at':>12} {'max len (rebal.)':>17} {'rebalances':>11}")
+        for pattern in ("append", "prepend", "same-spot", "alternate"):
+            max_len, overflow, _ = simulate(pattern, inserts, None)
+            rb_len, _, rebalances = simulate(pattern, inserts, threshold)
+            self.stdout.write(
+                f"{pattern:<10} {max_len:>8} {overflow or '-':>12} {rb_len:>17} {rebalances:>11}"
+            )
+
+        n = inserts
+        start = time.perf_counter()
+        prev = None
+        one_by_one = []
+        for _ in range(n):
+            prev = generate_key_between(prev, None)
+            one_by_one.append(prev)
+        loop_s = time.perf_counter() - start
+        start = time.perf_counter()
+        bulk = keys_between(None, None, n)
+        bulk_s = time.perf_counter() - start
+        self.stdout.write(
+            f"{n} keys: one at a time {loop_s * 1000:.1f} ms (max len {max(map(len, one_by_one))}), "
+            f"bulk {bulk_s * 1000:.1f} ms (max len {max(map(len, bulk))})"
+        )
+        start = time.perf_counter()
+        between = keys_between("a0", "a1", n)
+        self.stdout.write(
+            f"{n} keys between two neighbours: {(time.perf_counter() - start) * 1000:.1f} ms "
+            f"(max len {max(map(len, between))})"
+        )
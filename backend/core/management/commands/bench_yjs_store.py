@@ -0,0 +1,114 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import y_py as Y
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from core.utils import yjs_compact
+from core.utils.yjs_codec import CODECS
+
+WORDS = (
+    "the page note editor draft meeting project review team update plan idea list task "
+    "document section summary comment shared link owner change version room sync and of to "
+    "in for with on is are was be this that from by an it at as our your next week"
+).split()
+
+# name -> (edits, characters per edit)
+DOCUMENTS = {
+    "note": (40, 50),
+    "article": (500, 200),
+    "paste": (1, 500_000),
+}
+
+
+def _prose(rng: random.Random, size: int) -> str:
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def _updates(edits: int, size: int, scale: float) -> list[bytes]:
+    """The update log of a text document typed in `edits` edits."""
+    rng = random.Random(edits)
+    ydoc = Y.YDoc()
+    ytext = ydoc.get_text("t")
+    updates = []
+    for _ in range(edits):
+        before = Y.encode_state_vector(ydoc)
+        with ydoc.begin_transaction() as txn:
+            ytext.extend(txn, _prose(rng, max(1, int(size * scale))))
+        updates.append(Y.encode_state_as_update(ydoc, before))
+    return updates
+
+
+def _stored_bytes(db_path: str) -> int:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT coalesce(sum(length(yupdate)), 0) FROM yupdates").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _load_ms(db_path: str, room: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        yjs_compact.load_room(room, db_path)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def _run(tmp: str, codec: str, updates: list[bytes], repeat: int) -> dict:
+    db_path = os.path.join(tmp, f"{codec or 'raw'}-{len(updates)}.sqlite3")
+    room = "page:bench"
+    with override_settings(YJS_COMPRESSION=codec):
+        started = time.perf_counter()
+        yjs_compact.append_updates(db_path, [(room, update) for update in updates])
+        write_ms = (time.perf_counter() - started) * 1000
+        log_bytes = _stored_bytes(db_path)
+        log_load_ms = _load_ms(db_path, room, repeat)
+        started = time.perf_counter()
+        yjs_compact.compact_room(room, db_path)
+        compact_ms = (time.perf_counter() - started) * 1000
+    return {
+        "write_ms": write_ms,
+        "log_bytes": log_bytes,
+        "log_load_ms": log_load_ms,
+        "compact_ms": compact_ms,
+        "compacted_bytes": _stored_bytes(db_path),
+        "compacted_load_ms": _load_ms(db_path, room, repeat),
+    }
+
+
+class Command(BaseCommand):
+    help = "Benchmark stored size and write/load latency of Yjs updates per YJS_COMPRESSION codec."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", type=float, default=1.0, help="Multiply document sizes")
+        parser.add_argument("--repeat", type=int, default=5, help="Loads per measurement (median)")
+
+    def handle(self, *args, **options):
+        codecs = ["", *CODECS]
+        self.stdout.write(
+            f"{'document':<8} {'codec':<5} {'log bytes':>10} {'write ms':>9} {'load ms':>8} "
+            f"{'compact ms':>11} {'compacted':>10} {'load ms':>8}"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, (edits, size) in DOCUMENTS.items():
+                updates = _updates(edits, size, options["scale"])
+                for codec in codecs:
+                    r = _run(tmp, codec, updates, max(1, options["repeat"]))
+                    self.stdout.write(
+                        f"{name:<8} {codec or 'raw':<5} {r['log_bytes']:>10} {r['write_ms']:>9.2f} "
+                        f"{r['log_load_ms']:>8.2f} {r['compact_ms']:>11.2f} {r['compacted_bytes']:>10} "
+                        f"{r['compacted_load_ms']:>8.2f}"
+                    )
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Page
+from core.utils.tree import compute_paths
+
+
+class Command(BaseCommand):
+    help = "Verify Page.path against parent links, optionally rewriting wrong paths."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Rewrite mismatched paths")
+
+    def handle(self, *args, **options):
+        rows = Page.objects.values_list("id", "parent_id", "path")
+        stored = {}
+        links = []
+        for pid, parent_id, path in rows.iterator():
+            stored[pid] = path
+            links.append((pid, parent_id))
+
+        expected, unreachable = compute_paths(links)
+        wrong = [pid for pid, path in expected.items() if stored[pid] != path]
+
+        for pid in unreachable:
+            self.stdout.write(self.style.ERROR(f"Parent cycle: {pid}"))
+        for pid in wrong[:50]:
+            self.stdout.write(f"Mismatch {pid}: {stored[pid]!r} != {expected[pid]!r}")
+
+        if wrong and options["fix"]:
+            Page.objects.bulk_update(
+                [Page(id=pid, path=expected[pid]) for pid in wrong],
+                ["path"],
+                batch_size=500,
+            )
+            self.stdout.write(self.style.SUCCESS(f"Fixed paths: {len(wrong)}"))
+            return
+
+        msg = f"Checked {len(stored)} pages, mismatched: {len(wrong)}, in cycles: {len(unreachable)}"
+        self.stdout.write(self.style.SUCCESS(msg) if not (wrong or unreachable) else msg)
@@ -1,7 +1,8 @@
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from core.utils.yjs_compact import compact_all_rooms, compact_room
+from core.utils import yjs_compact, yjs_orm, yjs_snapshots
+from core.utils.yjs_store import BACKENDS, backend
 
 
 class Command(BaseCommand):
@@ -9,16 +10,61 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--room", type=str, help="Room name to compact (e.g., page:<uuid>)")
+        parser.add_argument(
+            "--backend",
+            choices=BACKENDS,
+            default=None,
+            help="Store to compact (default: YJS_STORE_BACKEND)",
+        )
         parser.add_argument(
             "--db", type=str, default=str(settings.YJS_STORE_PATH), help="Path to yjs sqlite store"
         )
+        parser.add_argument("--jobs", type=int, default=1, help="Worker processes (threads for the orm backend)")
+        parser.add_argument(
+            "--min-updates", type=int, default=2, help="Only rooms with at least this many updates"
+        )
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=None,
+            help="Only rooms whose last update is older than this many seconds",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Report the selected rooms without compacting"
+        )
 
     def handle(self, *args, **options):
+        use_orm = (options["backend"] or backend()) == "orm"
         db_path = options["db"]
         room = options.get("room")
         if room:
-            ok = compact_room(room, db_path)
+            ok = yjs_orm.compact_room(room) if use_orm else yjs_compact.compact_room(room, db_path)
             self.stdout.write(self.style.SUCCESS("Compacted") if ok else "No updates")
             return
-        count = compact_all_rooms(db_path)
-        self.stdout.write(self.style.SUCCESS(f"Compacted rooms: {count}"))
+        selection = dict(
+            jobs=max(1, options["jobs"]),
+            min_updates=options["min_updates"],
+            older_than=options["older_than"],
+            dry_run=options["dry_run"],
+        )
+        if use_orm:
+            report = yjs_orm.compact_all_rooms(**selection)
+        else:
+            report = yjs_compact.compact_all_rooms(db_path, **selection)
+        if options["dry_run"]:
+            self.stdout.write(
+                f"Would compact rooms: {report['rooms']} ({report['bytes_before']} bytes)"
+            )
+            return
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Compacted rooms: {report['compacted']}/{report['rooms']}, "
+                f"bytes {report['bytes_before']} -> {report['bytes_after']}"
+            )
+        )
+        retention = getattr(settings, "YJS_SNAPSHOT_RETENTION", 30 * 24 * 60 * 60)
+        if use_orm:
+            pruned = yjs_orm.prune_snapshots(retention)
+        else:
+            pruned = yjs_snapshots.prune_snapshots(db_path, retention)
+        self.stdout.write(f"Pruned snapshots: {pruned}")
@@ -0,0 +1,74 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.utils.yjs_gc import collect_garbage
+from core.utils.yjs_store import BACKENDS, backend
+
+logger = logging.getLogger("core.yjs")
+
+
+class Command(BaseCommand):
+    help = "Delete Yjs rooms of missing pages, archive idle rooms and reclaim store space."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backend",
+            choices=BACKENDS,
+            default=None,
+            help="Store to clean (default: YJS_STORE_BACKEND)",
+        )
+        parser.add_argument(
+            "--db", type=str, default=str(settings.YJS_STORE_PATH), help="Path to yjs sqlite store"
+        )
+        parser.add_argument(
+            "--idle-ttl",
+            type=float,
+            default=getattr(settings, "YJS_ARCHIVE_AFTER", 60 * 60 * 24 * 7),
+            help="Archive rooms whose last update is older than this many seconds (0: don't archive)",
+        )
+        parser.add_argument("--no-vacuum", action="store_true", help="Skip VACUUM of the sqlite store")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be removed")
+        parser.add_argument(
+            "--every",
+            type=float,
+            default=None,
+            help="Keep running, one pass every this many seconds (for a worker/cron-less deploy)",
+        )
+
+    def handle(self, *args, **options):
+        if not options["every"]:
+            self._run(options)
+            return
+        while True:
+            try:
+                self._run(options)
+            except Exception:
+                # nothing restarts the loop: log the pass (e.g. a locked VACUUM) and keep going
+                logger.exception("Yjs garbage collection pass failed")
+            time.sleep(options["every"])
+
+    def _run(self, options):
+        use_orm = (options["backend"] or backend()) == "orm"
+        report = collect_garbage(
+            use_orm,
+            options["db"],
+            idle_ttl=options["idle_ttl"] or None,
+            dry_run=options["dry_run"],
+            vacuum=not options["no_vacuum"],
+        )
+        if options["dry_run"]:
+            self.stdout.write(
+                f"Rooms: {report['rooms']}, would delete orphaned: {report['orphaned']} "
+                f"({report['orphaned_bytes']} bytes), would archive: {report['archived']}"
+            )
+            return
+        summary = (
+            f"Rooms: {report['rooms']}, deleted orphaned: {report['orphaned']}, "
+            f"archived: {report['archived']}, bytes freed: {report['bytes_freed']}"
+        )
+        if report["file_bytes_before"] is not None:
+            summary += f", file {report['file_bytes_before']} -> {report['file_bytes_after']} bytes"
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,46 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.utils.changes import prune_page_changes
+
+logger = logging.getLogger("core.changes")
+
+
+class Command(BaseCommand):
+    help = "Delete old rows of the page change log; clients with older cursors get a full resync."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=getattr(settings, "PAGE_CHANGE_RETENTION", 60 * 60 * 24 * 30),
+            help="Prune changes older than this many seconds",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be removed")
+        parser.add_argument(
+            "--every",
+            type=float,
+            default=None,
+            help="Keep running, one pass every this many seconds (for a worker/cron-less deploy)",
+        )
+
+    def handle(self, *args, **options):
+        if not options["every"]:
+            self._run(options)
+            return
+        while True:
+            try:
+                self._run(options)
+            except Exception:
+                logger.exception("Page change pruning pass failed")
+            time.sleep(options["every"])
+
+    def _run(self, options):
+        pruned = prune_page_changes(options["max_age"], dry_run=options["dry_run"])
+        if options["dry_run"]:
+            self.stdout.write(f"Would prune {pruned} page changes")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Pruned {pruned} page changes"))
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0018_comment_threads"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="page",
+            index=models.Index(fields=["created_at", "id"], name="core_page_created_id_idx"),
+        ),
+    ]
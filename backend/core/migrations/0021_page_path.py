@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+
+def backfill_page_paths(apps, schema_editor):
+    Page = apps.get_model("core", "Page")
+
+    children = {}
+    for pid, parent_id in Page.objects.values_list("id", "parent_id").iterator():
+        children.setdefault(parent_id, []).append(pid)
+
+    batch = []
+    stack = [(pid, "/") for pid in children.get(None, [])]
+    while stack:
+        pid, base = stack.pop()
+        path = f"{base}{pid.hex}/"
+        batch.append(Page(id=pid, path=path))
+        stack.extend((ch, path) for ch in children.get(pid, []))
+        if len(batch) >= 500:
+            Page.objects.bulk_update(batch, ["path"])
+            batch = []
+    if batch:
+        Page.objects.bulk_update(batch, ["path"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0020_pagechange"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="path",
+            field=models.TextField(blank=True, default="", editable=False),
+        ),
+        migrations.RunPython(backfill_page_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="page",
+            index=models.Index(fields=["path"], name="core_page_path_idx", opclasses=["text_pattern_ops"]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0021_page_path"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="YjsUpdate",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("room", models.CharField(max_length=255)),
+                ("update", models.BinaryField()),
+                ("metadata", models.BinaryField(blank=True, default=b"")),
+                ("timestamp", models.FloatField()),
+            ],
+            options={
+                "indexes": [models.Index(fields=["room", "id"], name="core_yjsupdate_room_seq_idx")],
+            },
+        ),
+        migrations.CreateModel(
+            name="YjsSnapshot",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("room", models.CharField(max_length=255)),
+                ("state", models.BinaryField()),
+                ("created_at", models.FloatField()),
+                ("reason", models.CharField(blank=True, default="", max_length=32)),
+            ],
+            options={
+                "indexes": [models.Index(fields=["room", "created_at"], name="core_yjssnapshot_room_idx")],
+            },
+        ),
+        migrations.CreateModel(
+            name="YjsRoomReset",
+            fields=[
+                ("room", models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ("reset_at", models.FloatField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0022_yjs_store"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="YjsArchivedRoom",
+            fields=[
+                ("room", models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ("state", models.BinaryField()),
+                ("archived_at", models.FloatField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0023_yjsarchivedroom"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PageChangeHorizon",
+            fields=[
+                ("user", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name="page_change_horizon", serialize=False, to=settings.AUTH_USER_MODEL)),
+                ("pruned_through", models.BigIntegerField()),
+            ],
+        ),
+    ]
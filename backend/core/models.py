@@ -1,8 +1,11 @@
 from django.db import models
 import uuid
 from django.conf import settings
+from django.db.models.functions import Concat, Substr
 from django.utils import timezone
 
+from .utils.tree import page_path, path_ancestor_hexes
+
 
 class CollaborationRole(models.TextChoices):
     OWNER = "owner", "Owner"
@@ -35,6 +38,8 @@ class Page(models.Model):
         related_name="children",
     )
     position = models.CharField(max_length=32, default="")
+    # Materialized ancestry, see core.utils.tree. Maintained by save() and sync_paths().
+    path = models.TextField(default="", blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     favorite = models.BooleanField(default=False)
@@ -59,9 +64,170 @@ class Page(models.Model):
     trashed_favorite = models.BooleanField(default=False)
     trashed_favorite_position = models.CharField(max_length=32, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="core_page_created_id_idx"),
+            models.Index(fields=["path"], name="core_page_path_idx", opclasses=["text_pattern_ops"]),
+        ]
+
     def __str__(self):
         return f"{self.title} ({self.owner.username})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_parent_id = instance.__dict__.get("parent_id")
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not {"parent", "parent_id"} & set(update_fields):
+            return super().save(*args, **kwargs)
+
+        moved = not self._state.adding and self.parent_id != getattr(self, "_loaded_parent_id", None)
+        old_path = (
+            Page.objects.filter(pk=self.pk).values_list("path", flat=True).first()
+            if moved
+            else None
+        )
+        base = (
+            Page.objects.filter(pk=self.parent_id).values_list("path", flat=True).first()
+            if self.parent_id
+            else None
+        )
+        self.path = page_path(base, self.id)
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "path"}
+        super().save(*args, **kwargs)
+        self._loaded_parent_id = self.parent_id
+
+        if old_path and old_path != self.path:
+            Page.rebase_paths(old_path, self.path)
+
+    @classmethod
+    def rebase_paths(cls, old_prefix: str, new_prefix: str) -> int:
+        """Move every path under `old_prefix` to `new_prefix` in one UPDATE."""
+        return cls.objects.filter(path__startswith=old_prefix).update(
+            path=Concat(
+                models.Value(new_prefix),
+                Substr("path", len(old_prefix) + 1),
+                output_field=models.TextField(),
+            )
+        )
+
+    @classmethod
+    def sync_paths(cls, pages) -> int:
+        """
+        Recompute paths for pages whose parent was changed with bulk_update.
+
+        Parents inside `pages` are resolved in memory; subtrees hanging below
+        the batch are rebased with one UPDATE per affected page.
+        """
+        by_id = {p.id: p for p in pages}
+        external = {p.parent_id for p in pages if p.parent_id and p.parent_id not in by_id}
+        base_paths = dict(cls.objects.filter(id__in=external).values_list("id", "path"))
+
+        new_paths = {}
+        for page in pages:
+            chain = []
+            cur = page
+            while cur.id not in new_paths and cur not in chain:
+                chain.append(cur)
+                cur = by_id.get(cur.parent_id)
+                if cur is None:
+                    break
+            for node in reversed(chain):
+                parent = node.parent_id
+                base = new_paths.get(parent) or base_paths.get(parent)
+                new_paths[node.id] = page_path(base, node.id)
+
+        old_paths = {}
+        changed = []
+        for page in pages:
+            if page.path != new_paths[page.id]:
+                old_paths[page.id] = page.path
+                page.path = new_paths[page.id]
+                changed.append(page)
+        if not changed:
+            return 0
+
+        cls.objects.bulk_update(changed, ["path"], batch_size=500)
+        outside_parents = set(
+            cls.objects.filter(parent_id__in=old_paths)
+            .exclude(id__in=by_id)
+            .values_list("parent_id", flat=True)
+        )
+        # deepest first: a shallower rebase also fixes paths computed from a
+        # stale base inside the batch, but not the other way round
+        for pid in sorted(outside_parents, key=lambda pid: -len(by_id[pid].path)):
+            if old_paths[pid]:
+                cls.rebase_paths(old_paths[pid], by_id[pid].path)
+        return len(changed)
+
+    def subtree(self):
+        """This page and all of its descendants."""
+        if self.path:
+            return Page.objects.filter(path__startswith=self.path)
+        # no path (the backfill skips pages caught in a parent cycle): an
+        # empty prefix would match every page, so follow parent links instead
+        ids, frontier = {self.pk}, [self.pk]
+        while frontier:
+            children = set(Page.objects.filter(parent_id__in=frontier).values_list("id", flat=True)) - ids
+            ids |= children
+            frontier = list(children)
+        return Page.objects.filter(id__in=ids)
+
+    def ancestor_ids(self):
+        """Ancestor ids read from the path, root first."""
+        return [uuid.UUID(h) for h in path_ancestor_hexes(self.path)]
+
+    def ancestors(self):
+        """Ancestors of this page, root first."""
+        ids = self.ancestor_ids()
+        found = Page.objects.in_bulk(ids)
+        return [found[pid] for pid in ids if pid in found]
+
+
+class PageChange(models.Model):
+    """
+    Append-only per-user change log for the page tree.
+
+    The auto-increment id is the sync sequence handed to clients as a cursor;
+    page_id is not a foreign key so rows survive purges as tombstones.
+    """
+
+    page_id = models.UUIDField(db_index=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="page_changes",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "id"], name="core_pagechange_user_seq_idx")]
+
+    def __str__(self):
+        return f"PageChange({self.id}:{self.page_id}:{self.user_id})"
+
+
+class PageChangeHorizon(models.Model):
+    """
+    Newest PageChange id pruned from a user's log; a cursor older than it
+    may have missed changes, so the client gets a full resync instead.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="page_change_horizon",
+    )
+    pruned_through = models.BigIntegerField()
+
+    def __str__(self):
+        return f"PageChangeHorizon({self.user_id}:{self.pruned_through})"
+
 
 class TiptapDocument(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -79,6 +245,58 @@ class TiptapDocument(models.Model):
         return f"TiptapDocument({self.page_id})"
 
 
+class YjsUpdate(models.Model):
+    """
+    One entry of a Yjs room's update log, used instead of the local
+    yjs.sqlite3 file when YJS_STORE_BACKEND is "orm" so that every app
+    instance reads and writes the same history. Rows replay in id order.
+    """
+
+    room = models.CharField(max_length=255)
+    update = models.BinaryField()
+    metadata = models.BinaryField(default=b"", blank=True)
+    timestamp = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=["room", "id"], name="core_yjsupdate_room_seq_idx")]
+
+    def __str__(self):
+        return f"YjsUpdate({self.id}:{self.room})"
+
+
+class YjsSnapshot(models.Model):
+    room = models.CharField(max_length=255)
+    state = models.BinaryField()
+    created_at = models.FloatField()
+    reason = models.CharField(max_length=32, blank=True, default="")
+
+    class Meta:
+        indexes = [models.Index(fields=["room", "created_at"], name="core_yjssnapshot_room_idx")]
+
+    def __str__(self):
+        return f"YjsSnapshot({self.id}:{self.room})"
+
+
+class YjsArchivedRoom(models.Model):
+    """Squashed state of a room idle past the GC TTL, moved out of YjsUpdate."""
+
+    room = models.CharField(max_length=255, primary_key=True)
+    state = models.BinaryField()
+    archived_at = models.FloatField()
+
+    def __str__(self):
+        return f"YjsArchivedRoom({self.room})"
+
+
+class YjsRoomReset(models.Model):
+    # last restore of each room, so processes can tell their cached copy is stale
+    room = models.CharField(max_length=255, primary_key=True)
+    reset_at = models.FloatField()
+
+    def __str__(self):
+        return f"YjsRoomReset({self.room})"
+
+
 class PageCollaborator(models.Model):
     page = models.ForeignKey(
         Page,
@@ -0,0 +1,172 @@
+import base64
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class PageKeysetPagination(BasePagination):
+    """
+    Keyset pagination on (created_at, id), newest first.
+
+    The cursor is the (created_at, id) of the last row returned, so pages
+    inserted while a client is walking the list never shift or duplicate rows.
+    """
+
+    page_size = 200
+    max_page_size = 1000
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def is_requested(self, request) -> bool:
+        params = request.query_params
+        return self.cursor_query_param in params or self.page_size_query_param in params
+
+    def get_page_size(self, request) -> int:
+        raw = request.query_params.get(self.page_size_query_param)
+        if not raw:
+            return self.page_size
+        try:
+            size = int(raw)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "invalid page size"})
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, page) -> str:
+        raw = json.dumps([page.created_at.isoformat(), str(page.id)])
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, cursor: str):
+        try:
+            created_at, page_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            created_at = parse_datetime(created_at)
+            page_id = uuid.UUID(page_id)
+        except (ValueError, TypeError, AttributeError, UnicodeError):
+            created_at = None
+        if created_at is None:
+            raise ValidationError({self.cursor_query_param: "invalid cursor"})
+        return created_at, page_id
+
+    def filter_queryset(self, queryset, request):
+        queryset = queryset.order_by("-created_at", "-id")
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            created_at, page_id = self.decode_cursor(cursor)
+            queryset = keyset_after(queryset, created_at, page_id)
+        return queryset
+
+    def paginate_queryset(self, queryset, request, view=None):
+        size = self.get_page_size(request)
+        rows = list(self.filter_queryset(queryset, request)[: size + 1])
+        self.next_cursor = self.encode_cursor(rows[size - 1]) if len(rows) > size else None
+        return rows[:size]
+
+    def get_paginated_response(self, data):
+        return Response({"results": data, "next_cursor": self.next_cursor})
+
+    def stream_paginated(self, queryset, request, serialize, chunk_size=200, asynchronous=False):
+        """
+        Return a generator of the paginated JSON body, `chunk_size` rows at a
+        time; an async generator if `asynchronous` (see stream_json_list).
+        """
+        # Validate params up front so bad cursors fail before the response starts.
+        size = self.get_page_size(request)
+        rows = self.filter_queryset(queryset, request)
+        encoder = JSONEncoder()
+
+        def tail(last, has_more):
+            next_cursor = self.encode_cursor(last) if has_more else None
+            return '], "next_cursor": ' + encoder.encode(next_cursor) + "}"
+
+        def body():
+            yield '{"results": ['
+            last, emitted = None, 0
+            while emitted < size:
+                chunk, items = _encode_chunk(rows, last, min(chunk_size, size - emitted), serialize, encoder)
+                if not chunk:
+                    break
+                yield ("" if emitted == 0 else ", ") + items
+                emitted += len(chunk)
+                last = chunk[-1]
+            yield tail(last, emitted == size and _has_rows_after(rows, last))
+
+        async def abody():
+            yield '{"results": ['
+            last, emitted = None, 0
+            while emitted < size:
+                chunk, items = await sync_to_async(_encode_chunk)(
+                    rows, last, min(chunk_size, size - emitted), serialize, encoder
+                )
+                if not chunk:
+                    break
+                yield ("" if emitted == 0 else ", ") + items
+                emitted += len(chunk)
+                last = chunk[-1]
+            yield tail(last, emitted == size and await sync_to_async(_has_rows_after)(rows, last))
+
+        return abody() if asynchronous else body()
+
+
+def keyset_after(queryset, created_at, page_id):
+    """Rows of a (-created_at, -id) ordered `queryset` that come after (created_at, page_id)."""
+    return queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=page_id))
+
+
+def _encode_chunk(queryset, last, count, serialize, encoder):
+    # One keyset query per chunk, so no cursor stays open between chunks.
+    if last is not None:
+        queryset = keyset_after(queryset, last.created_at, last.id)
+    rows = list(queryset[:count])
+    return rows, ", ".join(encoder.encode(item) for item in serialize(rows))
+
+
+def _has_rows_after(queryset, last) -> bool:
+    return last is not None and keyset_after(queryset, last.created_at, last.id).exists()
+
+
+def serves_async(request) -> bool:
+    """Whether `request` came in through the ASGI handler."""
+    return isinstance(getattr(request, "_request", request), ASGIRequest)
+
+
+def stream_json_list(queryset, serialize, chunk_size=200, asynchronous=False):
+    """
+    Return a generator of a JSON array for a (-created_at, -id) ordered
+    `queryset`, serializing `chunk_size` rows at a time.
+
+    Under ASGI, Django buffers a sync iterator whole before sending it, so
+    pass `asynchronous=True` there: the async generator fetches each chunk
+    with sync_to_async and the body goes out as it is produced.
+    """
+    encoder = JSONEncoder()
+
+    def body():
+        yield "["
+        last = None
+        while True:
+            chunk, items = _encode_chunk(queryset, last, chunk_size, serialize, encoder)
+            if not chunk:
+                break
+            yield ("" if last is None else ", ") + items
+            last = chunk[-1]
+        yield "]"
+
+    async def abody():
+        yield "["
+        last = None
+        while True:
+            chunk, items = await sync_to_async(_encode_chunk)(queryset, last, chunk_size, serialize, encoder)
+            if not chunk:
+                break
+            yield ("" if last is None else ", ") + items
+            last = chunk[-1]
+        yield "]"
+
+    return abody() if asynchronous else body()
@@ -44,7 +44,18 @@ class PageSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
 
+    def validate_parent(self, value):
+        page = self.instance
+        if value and page is not None and page.path and value.path.startswith(page.path):
+            raise serializers.ValidationError("a page cannot be moved under itself")
+        return value
+
+    # PageViewSet annotates these via annotate_page_user_fields; the per-row
+    # queries below are only used when the serializer runs on a plain instance.
+
     def get_role(self, obj):
+        if hasattr(obj, "user_role"):
+            return obj.user_role
         request = self.context.get("request")
         if not request or not getattr(request, "user", None):
             return None
@@ -55,6 +66,8 @@ class PageSerializer(serializers.ModelSerializer):
         return collab.role if collab else None
 
     def get_is_shared(self, obj):
+        if hasattr(obj, "user_is_shared"):
+            return obj.user_is_shared
         return PageCollaborator.objects.filter(page=obj).exists()
 
     def _get_user(self):
@@ -67,12 +80,16 @@ class PageSerializer(serializers.ModelSerializer):
         return user
 
     def get_favorite(self, obj):
+        if hasattr(obj, "user_favorite"):
+            return obj.user_favorite
         user = self._get_user()
         if not user:
             return False
         return obj.favorites.filter(user=user).exists()
 
     def get_favorite_position(self, obj):
+        if hasattr(obj, "user_favorite_position"):
+            return obj.user_favorite_position
         user = self._get_user()
         if not user:
             return None
@@ -234,3 +251,18 @@ class RestorePageSerializer(serializers.Serializer):
 
 class PurgePageSerializer(serializers.Serializer):
     include_children = serializers.BooleanField(required=False, default=True)
+
+class BulkMoveItemSerializer(serializers.Serializer):
+    id = serializers.UUIDField()
+    parent = serializers.UUIDField(allow_null=True)
+    position = serializers.CharField(max_length=32)
+
+class BulkMovePagesSerializer(serializers.Serializer):
+    items = BulkMoveItemSerializer(many=True, allow_empty=False, max_length=1000)
+
+class FavoriteReorderItemSerializer(serializers.Serializer):
+    id = serializers.UUIDField()
+    favorite_position = serializers.CharField(max_length=32)
+
+class FavoriteReorderSerializer(serializers.Serializer):
+    items = FavoriteReorderItemSerializer(many=True, allow_empty=False, max_length=1000)
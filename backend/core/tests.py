@@ -1,3 +1,1866 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import pycrdt
+import y_py as Y
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from fractional_indexing import generate_key_between
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+from ypy_websocket.yutils import (
+    YSyncMessageType,
+    create_sync_step1_message,
+    create_sync_step2_message,
+    create_update_message,
+    read_message,
+)
+
+from .models import (
+    CollaborationRole,
+    Page,
+    PageChange,
+    PageCollaborator,
+    PageFavorite,
+    PageInvite,
+    TiptapDocument,
+    YjsArchivedRoom,
+    YjsUpdate,
+)
+from . import consumers
+from .fanout import RoomFanout
+from .management.commands import gc_yjs
+from .utils.ratelimit import TokenBucket
+from .utils import (
+    awareness,
+    positions,
+    tiptap,
+    ws_tickets,
+    yjs_codec,
+    yjs_compact,
+    yjs_gc,
+    yjs_orm,
+    yjs_snapshots,
+    yjs_store,
+)
+
+User = get_user_model()
+
+
+class PageListQueryCountTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.other = User.objects.create_user(username="other", password="pw")
+        self.client.force_authenticate(self.user)
+
+    def _make_pages(self, n):
+        for i in range(n):
+            page = Page.objects.create(owner=self.user, title=f"p{i}", position=f"a{i}")
+            TiptapDocument.objects.create(page=page)
+            if i % 2:
+                PageFavorite.objects.create(page=page, user=self.user, position=f"a{i}")
+            if i % 3 == 0:
+                PageCollaborator.objects.create(page=page, user=self.other, role=CollaborationRole.VIEWER)
+        shared = Page.objects.create(owner=self.other, title="shared")
+        PageCollaborator.objects.create(page=shared, user=self.user, role=CollaborationRole.EDITOR)
+
+    def _count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        return len(ctx.captured_queries), res.data
+
+    def test_list_query_count_is_constant(self):
+        self._make_pages(3)
+        small, _ = self._count_list_queries("/api/pages/")
+        self._make_pages(30)
+        large, data = self._count_list_queries("/api/pages/")
+        self.assertEqual(small, large)
+
+        by_title = {row["title"]: row for row in data}
+        self.assertEqual(by_title["shared"]["role"], CollaborationRole.EDITOR)
+        self.assertTrue(by_title["shared"]["is_shared"])
+        self.assertEqual(by_title["p1"]["role"], CollaborationRole.OWNER)
+        self.assertTrue(by_title["p1"]["favorite"])
+        self.assertEqual(by_title["p1"]["favorite_position"], "a1")
+        self.assertFalse(by_title["p2"]["favorite"])
+        self.assertIsNone(by_title["p2"]["favorite_position"])
+        self.assertFalse(by_title["p2"]["is_shared"])
+        self.assertIsNotNone(by_title["p2"]["tiptap_doc_id"])
+
+    def test_trash_query_count_is_constant(self):
+        self._make_pages(3)
+        Page.objects.filter(owner=self.user).update(deleted_at="2026-01-01T00:00:00Z")
+        small, _ = self._count_list_queries("/api/pages/trash/")
+        self._make_pages(30)
+        Page.objects.filter(owner=self.user).update(deleted_at="2026-01-01T00:00:00Z")
+        large, data = self._count_list_queries("/api/pages/trash/")
+        self.assertEqual(small, large)
+        self.assertEqual(len(data), 33)
+
+    def test_serializer_standalone_fallback(self):
+        from .serializers import PageSerializer
+
+        page = Page.objects.create(owner=self.user, title="solo")
+        PageFavorite.objects.create(page=page, user=self.user, position="a0")
+        request = type("Req", (), {"user": self.user})()
+        data = PageSerializer(page, context={"request": request}).data
+        self.assertEqual(data["role"], CollaborationRole.OWNER)
+        self.assertTrue(data["favorite"])
+        self.assertEqual(data["favorite_position"], "a0")
+        self.assertFalse(data["is_shared"])
+
+
+class PageListPaginationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.client.force_authenticate(self.user)
+        for i in range(7):
+            Page.objects.create(owner=self.user, title=f"p{i}")
+
+    def _walk(self, extra=""):
+        seen = []
+        url = f"/api/pages/?page_size=3{extra}"
+        while True:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            body = json.loads(b"".join(res.streaming_content)) if res.streaming else res.data
+            seen.extend(row["title"] for row in body["results"])
+            if not body["next_cursor"]:
+                return seen
+            url = f"/api/pages/?page_size=3&cursor={body['next_cursor']}{extra}"
+            Page.objects.create(owner=self.user, title="late")
+
+    def test_cursor_walk_is_stable_under_inserts(self):
+        self.assertEqual(self._walk(), [f"p{i}" for i in reversed(range(7))])
+
+    def test_streamed_cursor_walk_matches(self):
+        self.assertEqual(self._walk("&stream=1"), [f"p{i}" for i in reversed(range(7))])
+
+    def test_streamed_list_matches_plain_list(self):
+        plain = self.client.get("/api/pages/").data
+        res = self.client.get("/api/pages/?stream=1")
+        streamed = json.loads(b"".join(res.streaming_content))
+        self.assertEqual([r["id"] for r in streamed], [str(r["id"]) for r in plain])
+
+    async def test_streams_through_the_asgi_handler(self):
+        token = await Token.objects.acreate(user=self.user)
+        headers = {"Authorization": f"Token {token.key}"}
+        plain = [f"p{i}" for i in reversed(range(7))]
+        bodies = []
+        for url in ("/api/pages/?stream=1", "/api/pages/?stream=1&page_size=5"):
+            res = await self.async_client.get(url, headers=headers)
+            # an async iterator is sent chunk by chunk instead of being buffered
+            self.assertTrue(res.is_async)
+            bodies.append(json.loads(b"".join([chunk async for chunk in res.streaming_content])))
+        self.assertEqual([row["title"] for row in bodies[0]], plain)
+        self.assertEqual([row["title"] for row in bodies[1]["results"]], plain[:5])
+        self.assertIsNotNone(bodies[1]["next_cursor"])
+
+    def test_invalid_cursor(self):
+        res = self.client.get("/api/pages/?cursor=nope")
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get("/api/pages/?cursor=nope&stream=1")
+        self.assertEqual(res.status_code, 400)
+
+    def test_tampered_cursor_id(self):
+        for page_id in ("not-a-uuid", 5):
+            raw = json.dumps([timezone.now().isoformat(), page_id]).encode("utf-8")
+            cursor = base64.urlsafe_b64encode(raw).decode("ascii")
+            for extra in ("", "&stream=1"):
+                res = self.client.get(f"/api/pages/?cursor={cursor}{extra}")
+                self.assertEqual(res.status_code, 400)
+
+
+class PageChangesSyncTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.other = User.objects.create_user(username="other", password="pw")
+        self.client.force_authenticate(self.user)
+
+    def _changes(self, since=None, user=None):
+        if user:
+            self.client.force_authenticate(user)
+        url = "/api/pages/changes/" + (f"?since={since}" if since is not None else "")
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        return res.data
+
+    def test_changes_since_cursor(self):
+        keep = self.client.post("/api/pages/", {"title": "keep"}).data["id"]
+        gone = self.client.post("/api/pages/", {"title": "gone"}).data["id"]
+        snapshot = self._changes()
+        self.assertEqual({p["title"] for p in snapshot["pages"]}, {"keep", "gone"})
+
+        empty = self._changes(snapshot["cursor"])
+        self.assertEqual((empty["pages"], empty["deleted"]), ([], []))
+
+        self.client.patch(f"/api/pages/{keep}/", {"title": "renamed"})
+        self.client.post(f"/api/pages/{gone}/trash/", {})
+        delta = self._changes(snapshot["cursor"])
+        self.assertEqual([p["title"] for p in delta["pages"]], ["renamed"])
+        self.assertEqual(delta["deleted"], [{"id": gone, "reason": "trashed"}])
+
+        self.client.delete(f"/api/pages/{gone}/purge/")
+        delta = self._changes(delta["cursor"])
+        self.assertEqual(delta["deleted"], [{"id": gone, "reason": "removed"}])
+
+    def test_cursor_older_than_pruned_log_gets_full_resync(self):
+        old = self.client.post("/api/pages/", {"title": "old"}).data["id"]
+        stale = self._changes()["cursor"]
+        self.client.patch(f"/api/pages/{old}/", {"title": "renamed"})
+        current = self._changes()["cursor"]
+        PageChange.objects.update(created_at=timezone.now() - timedelta(days=60))
+        fresh = self.client.post("/api/pages/", {"title": "fresh"}).data["id"]
+
+        out = StringIO()
+        call_command("prune_page_changes", max_age=60 * 60 * 24 * 30, stdout=out)
+        self.assertIn("Pruned 2 page changes", out.getvalue())
+        self.assertEqual(list(PageChange.objects.values_list("page_id", flat=True)), [uuid.UUID(fresh)])
+
+        delta = self._changes(stale)
+        self.assertTrue(delta["full"])
+        self.assertEqual({p["title"] for p in delta["pages"]}, {"renamed", "fresh"})
+        # a cursor at the horizon missed nothing
+        delta = self._changes(current)
+        self.assertFalse(delta["full"])
+        self.assertEqual([p["title"] for p in delta["pages"]], ["fresh"])
+        self.assertEqual(self._changes(delta["cursor"])["pages"], [])
+
+    def test_unshare_is_tombstoned_for_collaborator(self):
+        page = Page.objects.create(owner=self.user, title="shared")
+        PageCollaborator.objects.create(page=page, user=self.other, role=CollaborationRole.EDITOR)
+        cursor = self._changes(user=self.other)["cursor"]
+
+        self.client.force_authenticate(self.user)
+        self.client.delete(f"/api/pages/{page.id}/collaborators/{self.other.id}/")
+        delta = self._changes(cursor, user=self.other)
+        self.assertEqual(delta["deleted"], [{"id": str(page.id), "reason": "removed"}])
+
+    def test_sharing_changes_reach_the_owner(self):
+        page = Page.objects.create(owner=self.user, title="shared")
+        invite = PageInvite.objects.create(page=page, inviter=self.user, invitee=self.other)
+        cursor = self._changes()["cursor"]
+
+        self.client.force_authenticate(self.other)
+        self.client.post(f"/api/invites/{invite.id}/accept/")
+        delta = self._changes(cursor, user=self.user)
+        self.assertEqual([(p["id"], p["is_shared"]) for p in delta["pages"]], [(str(page.id), True)])
+
+        self.client.patch(
+            f"/api/pages/{page.id}/collaborators/", {"user_id": self.other.id, "role": "viewer"}, format="json"
+        )
+        delta = self._changes(delta["cursor"])
+        self.assertEqual([p["id"] for p in delta["pages"]], [str(page.id)])
+
+        self.client.delete(f"/api/pages/{page.id}/collaborators/{self.other.id}/")
+        delta = self._changes(delta["cursor"])
+        self.assertEqual([(p["id"], p["is_shared"]) for p in delta["pages"]], [(str(page.id), False)])
+
+
+class PagePathTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.client.force_authenticate(self.user)
+        self.root = Page.objects.create(owner=self.user, title="root")
+        self.child = Page.objects.create(owner=self.user, title="child", parent=self.root)
+        self.leaf = Page.objects.create(owner=self.user, title="leaf", parent=self.child)
+        self.other = Page.objects.create(owner=self.user, title="other")
+
+    def _path(self, page):
+        return Page.objects.get(pk=page.pk).path
+
+    def test_move_rebases_subtree(self):
+        res = self.client.patch(f"/api/pages/{self.child.id}/", {"parent": str(self.other.id)})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self._path(self.child), f"/{self.other.id.hex}/{self.child.id.hex}/")
+        self.assertEqual(self._path(self.leaf), f"{self._path(self.child)}{self.leaf.id.hex}/")
+        self.assertEqual(self.root.subtree().count(), 1)
+
+    def test_move_under_own_descendant_is_rejected(self):
+        res = self.client.patch(f"/api/pages/{self.root.id}/", {"parent": str(self.leaf.id)})
+        self.assertEqual(res.status_code, 400)
+
+    def test_trash_and_restore_keep_paths_consistent(self):
+        self.client.post(f"/api/pages/{self.child.id}/trash/", {})
+        self.assertEqual(self._path(self.child), f"/{self.child.id.hex}/")
+        self.client.post(f"/api/pages/{self.child.id}/restore/", {})
+        self.assertEqual(self._path(self.child), f"{self.root.path}{self.child.id.hex}/")
+
+        out = StringIO()
+        call_command("check_page_paths", stdout=out)
+        self.assertIn("mismatched: 0", out.getvalue())
+
+    def test_breadcrumbs(self):
+        res = self.client.get(f"/api/pages/{self.leaf.id}/breadcrumbs/")
+        self.assertEqual([p["title"] for p in res.data["ancestors"]], ["root", "child"])
+        res = self.client.get(f"/api/pages/{self.root.id}/breadcrumbs/")
+        self.assertEqual(res.data["descendant_count"], 2)
+
+    def test_trash_of_page_without_path_stays_in_its_subtree(self):
+        Page.objects.filter(pk=self.child.pk).update(path="")
+        child = Page.objects.get(pk=self.child.pk)
+        self.assertEqual(set(child.subtree().values_list("id", flat=True)), {self.child.id, self.leaf.id})
+        self.client.post(f"/api/pages/{self.child.id}/trash/", {})
+        self.assertFalse(Page.objects.filter(pk__in=[self.root.pk, self.other.pk], deleted_at__isnull=False).exists())
+
+    def test_check_command_fixes_paths(self):
+        Page.objects.filter(pk=self.leaf.pk).update(path="")
+        call_command("check_page_paths", "--fix", stdout=StringIO())
+        self.assertEqual(self._path(self.leaf), f"{self.child.path}{self.leaf.id.hex}/")
+
+
+def _make_yjs_store(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE yupdates (path TEXT NOT NULL, yupdate BLOB, metadata BLOB, timestamp REAL NOT NULL)")
+    conn.commit()
+    conn.close()
+
+
+def _text_update(text, ydoc=None):
+    ydoc = ydoc or Y.YDoc()
+    before = Y.encode_state_vector(ydoc)
+    ytext = ydoc.get_text("t")
+    with ydoc.begin_transaction() as txn:
+        ytext.extend(txn, text)
+    return ydoc, Y.encode_state_as_update(ydoc, before)
+
+
+def _room_text(path, room):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT yupdate FROM yupdates WHERE path = ?", (room,)).fetchall()
+    conn.close()
+    ydoc = Y.YDoc()
+    for (update,) in rows:
+        Y.apply_update(ydoc, update)
+    return str(ydoc.get_text("t")), len(rows)
+
+
+class DuplicateDeepTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.client.force_authenticate(self.user)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+        _make_yjs_store(self.store)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_duplicates_subtree_docs_and_rooms(self):
+        root = Page.objects.create(owner=self.user, title="root", position="a0")
+        child = Page.objects.create(owner=self.user, title="child", parent=root, position="a0")
+        leaf = Page.objects.create(owner=self.user, title="leaf", parent=child, position="a1")
+        TiptapDocument.objects.create(page=root, content={"type": "doc"}, version=3)
+        TiptapDocument.objects.create(page=leaf, content={"type": "doc", "leaf": True})
+
+        ydoc, first = _text_update("hello")
+        _, second = _text_update(" world", ydoc)
+        conn = sqlite3.connect(self.store)
+        conn.executemany(
+            "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
+            [(f"page:{leaf.id}", first, b"", 1.0), (f"page:{leaf.id}", second, b"", 2.0)],
+        )
+        conn.commit()
+        conn.close()
+
+        with self.settings(YJS_STORE_PATH=self.store), self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(
+                f"/api/pages/{root.id}/duplicate-deep/", {"include_children": True}, format="json"
+            )
+        self.assertEqual(res.status_code, 201)
+
+        new_root = Page.objects.get(pk=res.data["new_page_id"])
+        copies = {p.title: p for p in new_root.subtree()}
+        self.assertEqual(set(copies), {"Copy of root", "child", "leaf"})
+        self.assertEqual(copies["leaf"].parent_id, copies["child"].id)
+        self.assertEqual(new_root.tiptap_doc.version, 3)
+        self.assertEqual(copies["leaf"].tiptap_doc.content, {"type": "doc", "leaf": True})
+        self.assertFalse(TiptapDocument.objects.filter(page=copies["child"]).exists())
+
+        self.assertEqual(_room_text(self.store, f"page:{copies['leaf'].id}"), ("hello world", 1))
+        self.assertEqual(_room_text(self.store, f"page:{leaf.id}"), ("hello world", 2))
+
+
+class PageRoleCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.editor = User.objects.create_user(username="editor", password="pw")
+        self.page = Page.objects.create(owner=self.owner, title="shared")
+        PageCollaborator.objects.create(page=self.page, user=self.editor, role=CollaborationRole.EDITOR)
+
+    def _collab_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url)
+        return res.status_code, [q["sql"] for q in ctx.captured_queries if "core_pagecollaborator" in q["sql"]]
+
+    def test_page_actions_resolve_role_once(self):
+        self.client.force_authenticate(self.editor)
+        code, queries = self._collab_queries(f"/api/pages/{self.page.id}/doc/")
+        self.assertEqual(code, 200)
+        # only the annotated page fetch touches the collaborator table
+        self.assertEqual(len(queries), 1)
+
+    @override_settings(PAGE_ROLE_CACHE_TIMEOUT=60)
+    def test_shared_cache_hit_and_invalidation(self):
+        self.client.force_authenticate(self.editor)
+        url = f"/api/invites/?page={self.page.id}"
+        code, queries = self._collab_queries(url)
+        self.assertEqual((code, len(queries)), (200, 1))
+        code, queries = self._collab_queries(url)
+        self.assertEqual((code, len(queries)), (200, 0))
+
+        self.client.force_authenticate(self.owner)
+        self.client.patch(
+            f"/api/pages/{self.page.id}/collaborators/",
+            {"user_id": self.editor.id, "role": CollaborationRole.VIEWER},
+        )
+        self.client.force_authenticate(self.editor)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_authenticate(self.owner)
+        self.client.delete(f"/api/pages/{self.page.id}/collaborators/{self.editor.id}/")
+        self.client.force_authenticate(self.editor)
+        self.assertEqual(self.client.get(f"/api/pages/{self.page.id}/").status_code, 403)
+
+
+class BulkMoveTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.client.force_authenticate(self.user)
+        self.a = Page.objects.create(owner=self.user, title="a")
+        self.b = Page.objects.create(owner=self.user, title="b", parent=self.a)
+        self.c = Page.objects.create(owner=self.user, title="c")
+
+    def _move(self, items):
+        return self.client.post("/api/pages/bulk-move/", {"items": items}, format="json")
+
+    def test_moves_many_pages_at_once(self):
+        res = self._move([
+            {"id": str(self.a.id), "parent": str(self.c.id), "position": "a1"},
+            {"id": str(self.b.id), "parent": None, "position": "a0"},
+        ])
+        self.assertEqual(res.status_code, 200)
+        a, b = Page.objects.get(pk=self.a.pk), Page.objects.get(pk=self.b.pk)
+        self.assertEqual((a.parent_id, a.position), (self.c.id, "a1"))
+        self.assertEqual(a.path, f"{self.c.path}{a.id.hex}/")
+        self.assertEqual((b.parent_id, b.path), (None, f"/{b.id.hex}/"))
+
+    def test_rejects_cycles_across_the_batch(self):
+        res = self._move([
+            {"id": str(self.a.id), "parent": str(self.c.id), "position": "a0"},
+            {"id": str(self.c.id), "parent": str(self.b.id), "position": "a0"},
+        ])
+        self.assertEqual(res.status_code, 400)
+        self.assertIsNone(Page.objects.get(pk=self.a.pk).parent_id)
+
+    def test_rejects_pages_without_edit_rights(self):
+        other = User.objects.create_user(username="other", password="pw")
+        foreign = Page.objects.create(owner=other, title="foreign")
+        PageCollaborator.objects.create(page=foreign, user=self.user, role=CollaborationRole.VIEWER)
+        res = self._move([{"id": str(foreign.id), "parent": None, "position": "a0"}])
+        self.assertEqual(res.status_code, 403)
+
+    def test_query_count_is_constant(self):
+        def count(n):
+            pages = [Page.objects.create(owner=self.user, title=f"m{i}") for i in range(n)]
+            items = [{"id": str(p.id), "parent": str(self.c.id), "position": f"a{i}"} for i, p in enumerate(pages)]
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self._move(items).status_code, 200)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(count(2), count(20))
+
+    def test_reorders_favorites(self):
+        PageFavorite.objects.create(page=self.a, user=self.user, position="a0")
+        PageFavorite.objects.create(page=self.c, user=self.user, position="a1")
+        res = self.client.post(
+            "/api/pages/favorites/reorder/",
+            {"items": [
+                {"id": str(self.a.id), "favorite_position": "a2"},
+                {"id": str(self.c.id), "favorite_position": "a1V"},
+            ]},
+            format="json",
+        )
+        self.assertEqual(res.status_code, 200)
+        order = list(PageFavorite.objects.filter(user=self.user).order_by("position").values_list("page_id", flat=True))
+        self.assertEqual(order, [self.c.id, self.a.id])
+
+
+class PositionRebalanceTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.client.force_authenticate(self.user)
+
+    def test_rebalance_keeps_order_and_shortens_keys(self):
+        keys = ["a0"]
+        for _ in range(40):
+            keys.insert(1, generate_key_between(keys[0], keys[1] if len(keys) > 1 else None))
+        pages = [Page.objects.create(owner=self.user, title=str(i), position=k) for i, k in enumerate(keys)]
+        expected = [p.id for p in sorted(pages, key=lambda p: p.position)]
+
+        positions.rebalance_page_siblings(self.user.id, None)
+        rows = list(Page.objects.filter(owner=self.user).order_by("position").values_list("id", "position"))
+        self.assertEqual([pid for pid, _ in rows], expected)
+        self.assertLessEqual(max(len(pos) for _, pos in rows), 3)
+
+    def test_long_key_schedules_background_rebalance(self):
+        long_key = "a0" + "V" * 26
+        with mock.patch.object(positions, "_executor") as executor, self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/pages/", {"title": "deep", "position": long_key})
+        executor.submit.assert_called_once_with(positions._run_rebalance, ("pages", self.user.id, None))
+        positions._pending.clear()
+
+    def test_legacy_favorite_positions_are_rebalanced(self):
+        keys = ["a0"]
+        for _ in range(40):
+            keys.insert(1, generate_key_between(keys[0], keys[1] if len(keys) > 1 else None))
+        pages = [Page.objects.create(owner=self.user, title=str(i), favorite_position=k) for i, k in enumerate(keys)]
+        expected = [p.id for p in sorted(pages, key=lambda p: p.favorite_position)]
+        # a favorite trashed with its overlong key comes back with it
+        Page.objects.filter(pk=pages[1].pk).update(
+            favorite_position=None, trashed_favorite=True, trashed_favorite_position=keys[1],
+            deleted_at=timezone.now(),
+        )
+        with self.settings(POSITION_REBALANCE_LENGTH=8), mock.patch.object(positions, "_executor") as executor, \
+                self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(f"/api/pages/{pages[1].id}/restore/", {}, format="json")
+        self.assertEqual(res.status_code, 200)
+        executor.submit.assert_called_once_with(positions._run_rebalance, ("legacy_favorites", self.user.id))
+        positions._pending.clear()
+
+        positions.rebalance_legacy_favorites(self.user.id)
+        rows = list(
+            Page.objects.filter(owner=self.user).order_by("favorite_position").values_list("id", "favorite_position")
+        )
+        self.assertEqual([pid for pid, _ in rows], expected)
+        self.assertLessEqual(max(len(pos) for _, pos in rows), 3)
+
+    def test_restore_generates_missing_favorite_keys_in_bulk(self):
+        pages = [
+            Page.objects.create(
+                owner=self.user, title=str(i), deleted_at=timezone.now(), trashed_favorite=True
+            )
+            for i in range(3)
+        ]
+        parent = pages[0]
+        Page.objects.filter(pk__in=[p.pk for p in pages[1:]]).update(parent=parent)
+        PageFavorite.objects.create(page=Page.objects.create(owner=self.user), user=self.user, position="a5")
+        res = self.client.post(f"/api/pages/{parent.id}/restore/", {"include_children": False}, format="json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Page.objects.get(pk=parent.pk).favorite_position, "a6")
+
+
+class ConditionalRequestTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.client.force_authenticate(self.user)
+        self.page = Page.objects.create(owner=self.user, title="Page")
+
+    def test_list_revalidates_until_a_page_changes(self):
+        res = self.client.get("/api/pages/")
+        etag = res["ETag"]
+        res = self.client.get("/api/pages/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res["ETag"], etag)
+
+        self.client.post(f"/api/pages/{self.page.id}/favorite/")
+        res = self.client.get("/api/pages/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+
+    def test_owner_list_revalidates_after_sharing(self):
+        other = User.objects.create_user(username="other", password="pw")
+        invite = PageInvite.objects.create(page=self.page, inviter=self.user, invitee=other)
+        etag = self.client.get("/api/pages/")["ETag"]
+
+        self.client.force_authenticate(other)
+        self.client.post(f"/api/invites/{invite.id}/accept/")
+        self.client.force_authenticate(self.user)
+        res = self.client.get("/api/pages/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        shared_etag = res["ETag"]
+
+        self.client.delete(f"/api/pages/{self.page.id}/collaborators/{other.id}/")
+        res = self.client.get("/api/pages/", HTTP_IF_NONE_MATCH=shared_etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], shared_etag)
+
+    def test_detail_not_modified(self):
+        etag = self.client.get(f"/api/pages/{self.page.id}/")["ETag"]
+        res = self.client.get(f"/api/pages/{self.page.id}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.client.patch(f"/api/pages/{self.page.id}/", {"title": "Renamed"}, format="json")
+        res = self.client.get(f"/api/pages/{self.page.id}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+
+    def test_doc_write_requires_matching_etag(self):
+        url = f"/api/pages/{self.page.id}/doc/"
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        res = self.client.patch(url, {"version": 2}, format="json", HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+
+        res = self.client.patch(url, {"version": 3}, format="json", HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(TiptapDocument.objects.get(page=self.page).version, 2)
+
+
+class YjsRoomRegistryTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+        _make_yjs_store(self.store)
+        self.worker = consumers.YjsPersistenceWorker()
+        patcher = mock.patch.object(consumers, "_yjs_worker", self.worker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rooms = consumers.YjsRoomRegistry()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _store_text(self, room, text):
+        _, update = _text_update(text)
+        conn = sqlite3.connect(self.store)
+        conn.execute("INSERT INTO yupdates VALUES (?, ?, ?, ?)", (room, update, b"", 1.0))
+        conn.commit()
+        conn.close()
+
+    def test_joiners_share_one_doc_hydrated_from_store(self):
+        self._store_text("page:a", "hello")
+
+        async def scenario():
+            first, second = await asyncio.gather(
+                self.rooms.acquire("page:a"), self.rooms.acquire("page:a")
+            )
+            return first is second, str(first.get_text("t")), self.rooms.active_rooms()
+
+        with self.settings(YJS_STORE_PATH=self.store):
+            same, text, active = asyncio.run(scenario())
+        self.assertTrue(same)
+        self.assertEqual(text, "hello")
+        self.assertEqual(active, 1)
+
+    def test_room_survives_grace_period_then_evicts_to_bytes(self):
+        self._store_text("page:a", "hello")
+
+        async def scenario():
+            doc = await self.rooms.acquire("page:a")
+            self.rooms.release("page:a")
+            again = await self.rooms.acquire("page:a")
+            kept = again is doc
+            self.rooms.release("page:a")
+            self.rooms._evict("page:a")
+            with mock.patch.object(consumers, "load_room") as load:
+                restored = await self.rooms.acquire("page:a")
+            return kept, restored is doc, load.called, str(restored.get_text("t"))
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_ROOM_IDLE_GRACE=60):
+            kept, same, loaded, text = asyncio.run(scenario())
+        self.assertTrue(kept)
+        self.assertFalse(same)
+        self.assertFalse(loaded)
+        self.assertEqual(text, "hello")
+
+    def test_idle_and_cached_rooms_pick_up_writes_from_other_processes(self):
+        self._store_text("page:a", "hello")
+
+        def written_elsewhere(text):
+            _, update = _text_update(text, Y.YDoc())
+            conn = sqlite3.connect(self.store)
+            conn.execute("INSERT INTO yupdates VALUES (?, ?, ?, ?)", ("page:a", update, b"", time.time() + 1))
+            conn.commit()
+            conn.close()
+
+        async def scenario():
+            doc = await self.rooms.acquire("page:a")
+            self.rooms.release("page:a")
+            written_elsewhere("idle")
+            idle = await self.rooms.acquire("page:a")
+            idle_text = str(idle.get_text("t"))
+            self.rooms.release("page:a")
+            self.rooms._evict("page:a")
+            written_elsewhere("cached")
+            cached = await self.rooms.acquire("page:a")
+            return idle is doc, idle_text, str(cached.get_text("t"))
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_ROOM_IDLE_GRACE=60):
+            same, idle_text, cached_text = asyncio.run(scenario())
+        self.assertTrue(same)
+        self.assertEqual(sorted(idle_text), sorted("helloidle"))
+        self.assertEqual(sorted(cached_text), sorted("helloidlecached"))
+
+    def test_evicted_rooms_are_capped_lru(self):
+        self._store_text("page:a", "a" * 100)
+        self._store_text("page:b", "b" * 100)
+
+        async def scenario():
+            for room in ("page:a", "page:b"):
+                await self.rooms.acquire(room)
+                self.rooms.release(room)
+            return list(self.rooms._evicted)
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_ROOM_IDLE_GRACE=0, YJS_ROOM_CACHE_BYTES=200):
+            evicted = asyncio.run(scenario())
+        self.assertEqual(evicted, ["page:b"])
+
+    def test_typing_is_coalesced_into_one_write_per_flush(self):
+        self._store_text("page:a", "hello")
+
+        async def scenario():
+            doc = await self.rooms.acquire("page:a")
+            other = await self.rooms.acquire("page:b")
+            text = doc.get_text("t")
+            for ch in " world":
+                with doc.begin_transaction() as txn:
+                    text.extend(txn, ch)
+                await asyncio.sleep(0)
+            with other.begin_transaction() as txn:
+                other.get_text("t").extend(txn, "b")
+            await asyncio.sleep(0.05)
+            return self.worker.flushes
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=0.01):
+            flushes = asyncio.run(scenario())
+        self.assertEqual(flushes, 1)
+        self.assertEqual(_room_text(self.store, "page:a"), ("hello world", 2))
+        self.assertEqual(_room_text(self.store, "page:b"), ("b", 1))
+        self.assertEqual(
+            [snap["reason"] for snap in yjs_snapshots.list_snapshots(self.store, "page:a")], ["periodic"]
+        )
+
+
+class YjsPersistencePoolTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _dirty_doc(self, worker, room, text="x"):
+        ydoc = Y.YDoc()
+        before = Y.encode_state_vector(ydoc)
+        with ydoc.begin_transaction() as txn:
+            ydoc.get_text("t").extend(txn, text)
+        worker.enqueue_update(room, ydoc, before)
+        return ydoc
+
+    def test_failed_flush_keeps_pending_rooms(self):
+        pool = consumers.YjsPersistencePool(shards=2)
+
+        async def scenario():
+            pool.ensure_started()
+            shard = pool.shard_for("page:a")
+            doc = self._dirty_doc(pool, "page:a", "hello")
+            with mock.patch.object(consumers, "append_updates", side_effect=sqlite3.OperationalError("locked")):
+                with self.assertRaises(sqlite3.OperationalError):
+                    await shard.flush()
+            failed = shard.stats()
+            await pool.flush()
+            return doc, failed, shard.stats()
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=60):
+            _, failed, after = asyncio.run(scenario())
+        self.assertEqual((failed["depth"], failed["failures"]), (1, 1))
+        self.assertEqual((after["depth"], after["flushes"]), (0, 1))
+        self.assertEqual(_room_text(self.store, "page:a"), ("hello", 1))
+
+    def test_failing_store_is_retried_with_backoff(self):
+        worker = consumers.YjsPersistenceWorker()
+
+        async def scenario():
+            worker.ensure_started()
+            self._dirty_doc(worker, "page:a")
+            with mock.patch.object(consumers, "append_updates", side_effect=sqlite3.OperationalError("locked")):
+                # a blocked producer keeps asking for an early flush
+                waiter = asyncio.create_task(worker.wait_for_capacity())
+                await asyncio.sleep(0.3)
+                waiter.cancel()
+            await asyncio.sleep(0.2)
+            worker._task.cancel()
+            return worker.stats()
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=0.05, YJS_WORKER_MAX_PENDING=1), \
+                self.assertLogs("core.yjs", "ERROR") as logs:
+            stats = asyncio.run(scenario())
+        # 10, 20, 40, 50, 50... ms apart rather than back to back
+        self.assertLess(stats["failures"], 12)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual((stats["depth"], stats["flushes"]), (0, 1))
+
+    def test_full_shard_blocks_producers_and_flushes_early(self):
+        worker = consumers.YjsPersistenceWorker()
+
+        async def scenario():
+            worker.ensure_started()
+            docs = [self._dirty_doc(worker, f"page:{i}") for i in range(2)]
+            waiter = asyncio.create_task(worker.wait_for_capacity())
+            await asyncio.wait_for(waiter, 5)
+            return docs, worker.stats()
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=60, YJS_WORKER_MAX_PENDING=2):
+            _, stats = asyncio.run(scenario())
+        self.assertEqual(stats["blocked"], 1)
+        self.assertEqual((stats["depth"], stats["flushes"]), (0, 1))
+
+    def test_room_is_compacted_once_its_log_crosses_the_threshold(self):
+        worker = consumers.YjsPersistenceWorker()
+        _make_yjs_store(self.store)
+        ydoc, first = _text_update("hello")
+        conn = sqlite3.connect(self.store)
+        conn.execute("INSERT INTO yupdates VALUES (?, ?, ?, ?)", ("page:a", first, b"", 1.0))
+        conn.commit()
+        conn.close()
+
+        async def scenario():
+            worker.ensure_started()
+            worker.track_room("page:a", 1, len(first))
+            compacted = []
+            for ch in " you":
+                before = Y.encode_state_vector(ydoc)
+                with ydoc.begin_transaction() as txn:
+                    ydoc.get_text("t").extend(txn, ch)
+                worker.enqueue_update("page:a", ydoc, before)
+                await worker.flush()
+                compacted.append(await worker.compact_due_rooms())
+            return compacted
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=60, YJS_COMPACT_MAX_ROWS=3):
+            compacted = asyncio.run(scenario())
+        self.assertEqual(compacted, [0, 0, 1, 0])
+        self.assertEqual(_room_text(self.store, "page:a"), ("hello you", 2))
+        self.assertEqual(worker.stats()["compactions"], 1)
+
+    def test_stats_endpoint_is_staff_only(self):
+        user = User.objects.create_user(username="u", password="pw")
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.get("/api/realtime-stats/").status_code, 403)
+        user.is_staff = True
+        user.save()
+        res = self.client.get("/api/realtime-stats/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data["persistence"]), len(consumers._yjs_worker.shards))
+        self.assertIn("lag_seconds", res.data["persistence"][0])
+        self.assertEqual(set(res.data["connects"]), {"active", "waiting", "admitted", "queued", "shed"})
+        self.assertIn("offenders", res.data["client_limits"])
+        self.assertIn("dropped", res.data["fanout"])
+
+    def test_stats_are_logged_periodically(self):
+        stats_log = consumers.RealtimeStatsLog()
+
+        async def scenario():
+            stats_log.ensure_started()
+            await asyncio.sleep(0.05)
+            stats_log._task.cancel()
+
+        with self.settings(WS_STATS_LOG_INTERVAL=0.01), self.assertLogs("core.yjs", "INFO") as logs:
+            asyncio.run(scenario())
+        record = next(r for r in logs.records if r.getMessage() == "Realtime stats")
+        self.assertIn("persistence", record.stats)
+
+
+class CompactYjsCommandTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+        _make_yjs_store(self.store)
+        now = time.time()
+        rows = []
+        for i in range(6):
+            ydoc = None
+            for n, word in enumerate(("hello", " big", " world")):
+                ydoc, update = _text_update(word, ydoc)
+                # page:0 is still being edited, the others went idle an hour ago
+                rows.append((f"page:{i}", update, b"", now - (0 if i == 0 else 3600) + n))
+        rows.append(("page:single", _text_update("x")[1], b"", now - 3600))
+        conn = sqlite3.connect(self.store)
+        conn.executemany("INSERT INTO yupdates VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_dry_run_reports_without_writing(self):
+        out = StringIO()
+        call_command("compact_yjs", db=self.store, dry_run=True, older_than=600, stdout=out)
+        self.assertIn("Would compact rooms: 5", out.getvalue())
+        self.assertEqual(_room_text(self.store, "page:1"), ("hello big world", 3))
+
+    def test_parallel_compaction_of_idle_rooms(self):
+        report = yjs_compact.compact_all_rooms(self.store, jobs=2, older_than=600, chunk_size=2)
+        self.assertEqual((report["rooms"], report["compacted"]), (5, 5))
+        self.assertLess(report["bytes_after"], report["bytes_before"])
+        for i in range(1, 6):
+            self.assertEqual(_room_text(self.store, f"page:{i}"), ("hello big world", 1))
+        self.assertEqual(_room_text(self.store, "page:0"), ("hello big world", 3))
+        self.assertEqual(_room_text(self.store, "page:single"), ("x", 1))
+
+    def test_compaction_keeps_updates_appended_after_the_read(self):
+        conn = sqlite3.connect(self.store)
+        real_execute = conn.execute
+
+        class Conn:
+            def execute(self, sql, *args):
+                if sql == "BEGIN IMMEDIATE":
+                    late = _text_update("late")[1]
+                    real_execute("INSERT INTO yupdates VALUES (?, ?, ?, ?)", ("page:1", late, b"", time.time()))
+                    conn.commit()
+                return real_execute(sql, *args)
+
+            def __getattr__(self, name):
+                return getattr(conn, name)
+
+        rows, _, _ = yjs_compact._compact(Conn(), "page:1")
+        conn.close()
+        self.assertEqual(rows, 3)
+        text, count = _room_text(self.store, "page:1")
+        self.assertEqual(count, 2)
+        self.assertIn("late", text)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class DocSnapshotTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.viewer = User.objects.create_user(username="viewer", password="pw")
+        self.client.force_authenticate(self.user)
+        self.page = Page.objects.create(owner=self.user, title="Page")
+        PageCollaborator.objects.create(page=self.page, user=self.viewer, role=CollaborationRole.VIEWER)
+        self.room = f"page:{self.page.id}"
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+        _make_yjs_store(self.store)
+        self.ydoc, first = _text_update("hello")
+        self._append(first)
+        override = self.settings(YJS_STORE_PATH=self.store)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _append(self, update):
+        conn = sqlite3.connect(self.store)
+        conn.execute("INSERT INTO yupdates VALUES (?, ?, ?, ?)", (self.room, update, b"", time.time()))
+        conn.commit()
+        conn.close()
+
+    def test_snapshot_list_preview_and_restore(self):
+        url = f"/api/pages/{self.page.id}/doc/snapshots/"
+        res = self.client.post(url)
+        self.assertEqual(res.status_code, 201)
+        snapshot_id = res.data["id"]
+        self._append(_text_update(" world", self.ydoc)[1])
+
+        listed = self.client.get(url).data
+        self.assertEqual([s["id"] for s in listed], [snapshot_id])
+        self.assertEqual(listed[0]["reason"], "manual")
+
+        preview = self.client.get(f"{url}{snapshot_id}/").data
+        ydoc = Y.YDoc()
+        Y.apply_update(ydoc, base64.b64decode(preview["state"]))
+        self.assertEqual(str(ydoc.get_text("t")), "hello")
+
+        res = self.client.post(f"{url}{snapshot_id}/restore/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(_room_text(self.store, self.room), ("hello", 1))
+        self.assertEqual([s["reason"] for s in self.client.get(url).data], ["pre-restore", "manual"])
+        self.assertIsNotNone(yjs_snapshots.last_reset(self.store, self.room))
+
+    def test_viewer_can_list_but_not_restore(self):
+        snapshot_id = yjs_snapshots.take_snapshot(self.store, self.room)
+        self.client.force_authenticate(self.viewer)
+        url = f"/api/pages/{self.page.id}/doc/snapshots/"
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.post(f"{url}{snapshot_id}/restore/").status_code, 403)
+        self.assertEqual(self.client.get(f"{url}999/").status_code, 404)
+
+    def test_idle_room_reloads_after_restore(self):
+        snapshot_id = yjs_snapshots.take_snapshot(self.store, self.room)
+        self._append(_text_update(" world", self.ydoc)[1])
+        rooms = consumers.YjsRoomRegistry()
+
+        async def scenario():
+            with mock.patch.object(consumers, "_yjs_worker", consumers.YjsPersistenceWorker()):
+                doc = await rooms.acquire(self.room)
+                before = str(doc.get_text("t"))
+                rooms.release(self.room)
+                await asyncio.sleep(0.01)
+                yjs_snapshots.restore_snapshot(self.store, self.room, snapshot_id)
+                after = str((await rooms.acquire(self.room)).get_text("t"))
+                return before, after
+
+        with self.settings(YJS_ROOM_IDLE_GRACE=60):
+            before, after = asyncio.run(scenario())
+        self.assertEqual((before, after), ("hello world", "hello"))
+
+    def test_prune_keeps_newest_snapshot_per_room(self):
+        old = yjs_snapshots.take_snapshot(self.store, self.room)
+        newest = yjs_snapshots.take_snapshot(self.store, self.room)
+        conn = sqlite3.connect(self.store)
+        conn.execute("UPDATE ysnapshots SET created_at = created_at - 1000")
+        conn.execute("UPDATE ysnapshots SET created_at = created_at + 1 WHERE id = ?", (newest,))
+        conn.commit()
+        conn.close()
+        self.assertEqual(yjs_snapshots.prune_snapshots(self.store, 100), 1)
+        self.assertEqual([s["id"] for s in yjs_snapshots.list_snapshots(self.store, self.room)], [newest])
+        self.assertNotEqual(old, newest)
+
+
+def _tiptap_state():
+    doc = pycrdt.Doc()
+    frag = doc.get("prosemirror", type=pycrdt.XmlFragment)
+    heading = pycrdt.XmlElement("heading", {"level": 2})
+    frag.children.append(heading)
+    heading.children.append(pycrdt.XmlText("Title"))
+    para = pycrdt.XmlElement("paragraph")
+    frag.children.append(para)
+    text = pycrdt.XmlText()
+    para.children.append(text)
+    text.insert(0, "plain ")
+    text.insert(6, "bold", {"bold": {}})
+    text.insert(10, " link", {"link--a1": {"href": "https://example.com"}})
+    return doc.get_update()
+
+
+class TiptapMaterializeTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.page = Page.objects.create(owner=self.user, title="Page")
+
+    def test_converts_prosemirror_fragment_to_tiptap_json(self):
+        self.assertEqual(
+            tiptap.yjs_to_tiptap(_tiptap_state()),
+            {
+                "type": "doc",
+                "content": [
+                    {"type": "heading", "attrs": {"level": 2}, "content": [{"type": "text", "text": "Title"}]},
+                    {
+                        "type": "paragraph",
+                        "content": [
+                            {"type": "text", "text": "plain "},
+                            {"type": "text", "text": "bold", "marks": [{"type": "bold"}]},
+                            {
+                                "type": "text",
+                                "text": " link",
+                                "marks": [{"type": "link", "attrs": {"href": "https://example.com"}}],
+                            },
+                        ],
+                    },
+                ],
+            },
+        )
+
+    def test_materialize_bumps_version_only_on_change(self):
+        TiptapDocument.objects.create(page=self.page, content={"type": "doc"}, version=4)
+        self.assertTrue(tiptap.materialize_page_doc(self.page.id, _tiptap_state()))
+        self.assertFalse(tiptap.materialize_page_doc(self.page.id, _tiptap_state()))
+        self.assertFalse(tiptap.materialize_page_doc(self.page.id, Y.encode_state_as_update(Y.YDoc())))
+        doc = TiptapDocument.objects.get(page=self.page)
+        self.assertEqual(doc.version, 5)
+        self.assertEqual(doc.content["content"][0]["type"], "heading")
+
+    def test_room_is_materialized_once_after_it_goes_quiet(self):
+        materializer = consumers.YjsMaterializer()
+
+        async def scenario():
+            ydoc = Y.YDoc()
+            for word in ("a", "b", "c"):
+                _text_update(word, ydoc)
+                materializer.touch(f"page:{self.page.id}", ydoc)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            return str(ydoc.get_text("t"))
+
+        with self.settings(YJS_MATERIALIZE_DELAY=0.05), mock.patch.object(
+            tiptap, "materialize_page_doc", return_value=True
+        ) as write:
+            text = asyncio.run(scenario())
+        write.assert_called_once()
+        page_id, state = write.call_args.args
+        ydoc = Y.YDoc()
+        Y.apply_update(ydoc, state)
+        self.assertEqual((page_id, str(ydoc.get_text("t"))), (str(self.page.id), text))
+        self.assertEqual(materializer.materialized, 1)
+
+
+class AwarenessRelayTests(APITestCase):
+    def _consumer(self, seen):
+        consumer = consumers.YjsDocumentConsumer()
+        consumer._awareness_seen = seen
+        consumer.group_send_message = mock.AsyncMock()
+        return consumer
+
+    def _sent(self, consumer):
+        return [awareness.decode_awareness(c.args[0]) for c in consumer.group_send_message.await_args_list]
+
+    def test_frames_are_coalesced_per_client_and_echoes_dropped(self):
+        seen = {}
+        alice, bob = self._consumer(seen), self._consumer(seen)
+
+        async def scenario():
+            for clock in range(1, 6):
+                await alice._relay_awareness(
+                    awareness.encode_awareness([(1, clock, json.dumps({"cursor": clock}))])
+                )
+            # bob's client re-broadcasts what it received from alice
+            await bob._relay_awareness(awareness.encode_awareness([(1, 1, '{"cursor": 1}')]))
+            await asyncio.sleep(0.08)
+
+        with self.settings(YJS_AWARENESS_INTERVAL=0.05):
+            asyncio.run(scenario())
+        self.assertEqual(
+            self._sent(alice), [[(1, 1, '{"cursor": 1}')], [(1, 5, '{"cursor": 5}')]]
+        )
+        bob.group_send_message.assert_not_awaited()
+        self.assertEqual(seen[1][:2], (5, '{"cursor": 5}'))
+
+    def test_new_connection_receives_known_states(self):
+        seen = {}
+        consumer = self._consumer(seen)
+        consumer.send = mock.AsyncMock()
+
+        async def scenario():
+            now = asyncio.get_running_loop().time()
+            seen.update({1: (3, '{"u": 1}', now), 2: (4, "null", now), 3: (1, '{"u": 3}', now - 60)})
+            await consumer._send_known_awareness()
+
+        asyncio.run(scenario())
+        frame = consumer.send.await_args.kwargs["bytes_data"]
+        self.assertEqual(awareness.decode_awareness(frame), [(1, 3, '{"u": 1}')])
+        self.assertNotIn(3, seen)
+
+
+class YjsSyncRoutingTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+        _make_yjs_store(self.store)
+        _, update = _text_update("server")
+        conn = sqlite3.connect(self.store)
+        conn.execute("INSERT INTO yupdates VALUES (?, ?, ?, ?)", ("page:a", update, b"", 1.0))
+        conn.commit()
+        conn.close()
+        patcher = mock.patch.object(consumers, "_yjs_worker", consumers.YjsPersistenceWorker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        rooms = mock.patch.object(consumers, "_yjs_rooms", consumers.YjsRoomRegistry())
+        rooms.start()
+        self.addCleanup(rooms.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def _consumer(self):
+        consumer = consumers.YjsDocumentConsumer()
+        consumer._raw_room = "page:a"
+        consumer.ydoc = await consumers._yjs_rooms.acquire("page:a")
+        consumer.send = mock.AsyncMock()
+        consumer.group_send_message = mock.AsyncMock()
+        return consumer
+
+    def test_handshake_is_answered_locally(self):
+        async def scenario():
+            consumer = await self._consumer()
+            client = Y.YDoc()
+            await consumer._handle_sync(create_sync_step1_message(Y.encode_state_vector(client)))
+            reply = consumer.send.await_args.kwargs["bytes_data"]
+            Y.apply_update(client, read_message(reply[2:]))
+            # the client answers with its full state, which the server already has
+            await consumer._handle_sync(create_sync_step2_message(Y.encode_state_as_update(client)))
+            return consumer, str(client.get_text("t")), reply[1]
+
+        with self.settings(YJS_STORE_PATH=self.store):
+            consumer, text, kind = asyncio.run(scenario())
+        self.assertEqual((text, kind), ("server", YSyncMessageType.SYNC_STEP2))
+        consumer.group_send_message.assert_not_awaited()
+
+    def test_only_new_content_is_fanned_out(self):
+        async def scenario():
+            consumer = await self._consumer()
+            offline = Y.YDoc()
+            Y.apply_update(offline, Y.encode_state_as_update(consumer.ydoc))
+            before = Y.encode_state_vector(offline)
+            _text_update(" + offline", offline)
+            await consumer._handle_sync(create_sync_step2_message(Y.encode_state_as_update(offline)))
+            delta = Y.encode_state_as_update(offline, before)
+            await consumer._handle_sync(create_update_message(delta))
+            return consumer, str(consumer.ydoc.get_text("t")), delta
+
+        with self.settings(YJS_STORE_PATH=self.store):
+            consumer, text, delta = asyncio.run(scenario())
+        self.assertEqual(text, "server + offline")
+        # the duplicate update is not relayed again
+        consumer.group_send_message.assert_awaited_once()
+        fanned = consumer.group_send_message.await_args.args[0]
+        self.assertEqual(fanned[1], YSyncMessageType.SYNC_UPDATE)
+        # peers already in the room get the delta, not the whole document
+        self.assertEqual(read_message(fanned[2:]), delta)
+
+    def test_viewer_updates_are_dropped(self):
+        async def scenario():
+            consumer = await self._consumer()
+            consumer.page_role = CollaborationRole.VIEWER
+            client = Y.YDoc()
+            await consumer._handle_sync(create_sync_step1_message(Y.encode_state_vector(client)))
+            _, update = _text_update("viewer edit", client)
+            await consumer._handle_sync(create_update_message(update))
+            return consumer, str(consumer.ydoc.get_text("t"))
+
+        with self.settings(YJS_STORE_PATH=self.store):
+            consumer, text = asyncio.run(scenario())
+        self.assertEqual(text, "server")
+        consumer.send.assert_awaited_once()
+        consumer.group_send_message.assert_not_awaited()
+
+    def test_lost_relays_are_caught_up(self):
+        layer = InMemoryChannelLayer()
+        one, two = RoomFanout(), RoomFanout()
+        other_rooms = consumers.YjsRoomRegistry()
+        consumers._yjs_rooms.attach(one)
+        other_rooms.attach(two)
+        group = consumers.room_group_name("page:a")
+
+        async def scenario():
+            here = await self._consumer()
+            here.room_name, here.channel_layer = group, layer
+            del here.group_send_message
+            await one.join(group, here)
+            there = consumers.YjsDocumentConsumer()
+            there._raw_room, there.room_name, there.channel_layer = "page:a", group, layer
+            there.ydoc = await other_rooms.acquire("page:a")
+            there.send = mock.AsyncMock()
+            await two.join(group, there)
+            await asyncio.sleep(0.05)
+
+            client = Y.YDoc()
+            Y.apply_update(client, Y.encode_state_as_update(here.ydoc))
+            base = Y.encode_state_as_update(client)
+            _, lost = _text_update(" lost", client)
+            _, kept = _text_update(" kept", client)
+            # published, then dropped by the layer on its way to the other process
+            consumers._yjs_rooms.apply_update("page:a", here.ydoc, lost)
+            one._sequence[group] = one._sequence.get(group, 0) + 1
+            with mock.patch.object(consumers, "_fanout", one):
+                await here._handle_sync(create_update_message(kept))
+            await asyncio.sleep(0.1)
+            one.stop()
+            two.stop()
+            return there, str(there.ydoc.get_text("t")), base
+
+        with self.settings(YJS_STORE_PATH=self.store), self.assertLogs("core.yjs", "WARNING"):
+            there, text, base = asyncio.run(scenario())
+        self.assertEqual(text, "server lost kept")
+        self.assertEqual(two.stats["dropped"], 1)
+        # the relayed update, then the catch-up with what was lost
+        self.assertEqual(there.send.await_count, 2)
+        caught_up = Y.YDoc()
+        Y.apply_update(caught_up, base)
+        for call in there.send.await_args_list:
+            Y.apply_update(caught_up, read_message(call.kwargs["bytes_data"][2:]))
+        self.assertEqual(str(caught_up.get_text("t")), "server lost kept")
+
+    def test_a_joining_process_catches_up_on_unflushed_updates(self):
+        layer = InMemoryChannelLayer()
+        one, two = RoomFanout(), RoomFanout()
+        other_rooms = consumers.YjsRoomRegistry()
+        consumers._yjs_rooms.attach(one)
+        other_rooms.attach(two)
+        group = consumers.room_group_name("page:a")
+
+        async def scenario():
+            here = await self._consumer()
+            here.room_name, here.channel_layer = group, layer
+            del here.group_send_message
+            await one.join(group, here)
+            client = Y.YDoc()
+            Y.apply_update(client, Y.encode_state_as_update(here.ydoc))
+            _, update = _text_update(" + early", client)
+            # no other process known yet: nothing is published, nothing flushed
+            with mock.patch.object(consumers, "_fanout", one):
+                await here._handle_sync(create_update_message(update))
+            there = consumers.YjsDocumentConsumer()
+            there._raw_room, there.room_name, there.channel_layer = "page:a", group, layer
+            there.ydoc = await other_rooms.acquire("page:a")
+            hydrated = str(there.ydoc.get_text("t"))
+            there.send = mock.AsyncMock()
+            await two.join(group, there)
+            await asyncio.sleep(0.1)
+            one.stop()
+            two.stop()
+            return there, hydrated, str(there.ydoc.get_text("t"))
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=60):
+            there, hydrated, text = asyncio.run(scenario())
+        self.assertEqual(hydrated, "server")
+        self.assertEqual(text, "server + early")
+        there.send.assert_awaited_once()
+        self.assertEqual(one.stats["publish_skipped"], 1)
+
+    def test_updates_from_another_process_reach_the_room_doc(self):
+        layer = InMemoryChannelLayer()
+        one, two = RoomFanout(), RoomFanout()
+        other_rooms = consumers.YjsRoomRegistry()
+        consumers._yjs_rooms.attach(one)
+        other_rooms.attach(two)
+        group = consumers.room_group_name("page:a")
+
+        async def scenario():
+            here = await self._consumer()
+            here.channel_layer = layer
+            await one.join(group, here)
+            there = consumers.YjsDocumentConsumer()
+            there._raw_room, there.room_name, there.channel_layer = "page:a", group, layer
+            there.ydoc = await other_rooms.acquire("page:a")
+            there.send = mock.AsyncMock()
+            await two.join(group, there)
+            await asyncio.sleep(0.05)
+
+            client = Y.YDoc()
+            Y.apply_update(client, Y.encode_state_as_update(there.ydoc))
+            _, update = _text_update(" + remote", client)
+            with mock.patch.object(consumers, "_yjs_rooms", other_rooms), mock.patch.object(consumers, "_fanout", two):
+                await there._handle_sync(create_update_message(update))
+            await asyncio.sleep(0.1)
+            one.stop()
+            two.stop()
+            return here, str(here.ydoc.get_text("t"))
+
+        with self.settings(YJS_STORE_PATH=self.store, YJS_FLUSH_INTERVAL=0.01):
+            here, text = asyncio.run(scenario())
+        # the room doc here is current, so later joiners here sync the edit
+        self.assertEqual(text, "server + remote")
+        here.send.assert_awaited_once()
+        # ...and only the process that received the edit wrote it
+        self.assertEqual(_room_text(self.store, "page:a"), ("server + remote", 2))
+
+
+def _orm_room_text(room):
+    state, rows, _ = yjs_orm.load_room(room)
+    ydoc = Y.YDoc()
+    if state:
+        Y.apply_update(ydoc, state)
+    return str(ydoc.get_text("t")), rows
+
+
+@override_settings(YJS_STORE_BACKEND="orm")
+class YjsOrmStoreTests(APITestCase):
+    def _edit(self, room, words, age=0):
+        ydoc = None
+        for word in words:
+            ydoc, update = _text_update(word, ydoc)
+            yjs_store.append_updates([(room, update)])
+        YjsUpdate.objects.filter(room=room).update(timestamp=time.time() - age)
+        return ydoc
+
+    def test_append_load_and_ttl_squash(self):
+        self._edit("page:a", ("hello", " big"), age=3600)
+        self.assertEqual(_orm_room_text("page:a"), ("hello big", 2))
+        ydoc, update = _text_update(" world", self._edit("page:b", ("x",)))
+        yjs_store.append_updates([("page:a", _text_update("!", None)[1]), ("page:b", update)], document_ttl=60)
+        self.assertEqual(YjsUpdate.objects.filter(room="page:a").count(), 2)
+        self.assertEqual(_orm_room_text("page:b"), ("x world", 2))
+
+    def test_compaction_keeps_later_updates_last(self):
+        ydoc = self._edit("page:a", ("hello", " big"))
+        stale = YjsUpdate.objects.filter(room="page:a").order_by("id").first()
+        self.assertTrue(yjs_store.compact_room("page:a"))
+        _, update = _text_update(" world", ydoc)
+        yjs_store.append_updates([("page:a", update)])
+        self.assertEqual(_orm_room_text("page:a"), ("hello big world", 2))
+        self.assertFalse(YjsUpdate.objects.filter(pk=stale.pk).exists())
+
+    def test_command_compacts_idle_rooms(self):
+        for i in range(3):
+            self._edit(f"page:{i}", ("hello", " big", " world"), age=0 if i == 0 else 3600)
+        out = StringIO()
+        call_command("compact_yjs", older_than=600, stdout=out)
+        self.assertIn("Compacted rooms: 2/2", out.getvalue())
+        self.assertEqual(_orm_room_text("page:1"), ("hello big world", 1))
+        self.assertEqual(_orm_room_text("page:0"), ("hello big world", 3))
+
+    def test_snapshot_restore_marks_reset(self):
+        ydoc = self._edit("page:a", ("hello",))
+        snapshot_id = yjs_store.take_snapshot("page:a")
+        _, update = _text_update(" world", ydoc)
+        yjs_store.append_updates([("page:a", update)])
+        self.assertTrue(yjs_store.restore_snapshot("page:a", snapshot_id))
+        self.assertEqual(_orm_room_text("page:a"), ("hello", 1))
+        self.assertIsNotNone(yjs_store.last_reset("page:a"))
+        reasons = [s["reason"] for s in yjs_store.list_snapshots("page:a")]
+        self.assertEqual(reasons, ["pre-restore", "manual"])
+        self.assertEqual(yjs_orm.prune_snapshots(-1), 1)
+
+
+class YjsGarbageCollectionTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+        self.user = User.objects.create_user(username="gc", password="pw")
+        self.live = f"page:{Page.objects.create(owner=self.user, title='live').id}"
+        self.idle = f"page:{Page.objects.create(owner=self.user, title='idle').id}"
+        gone = Page.objects.create(owner=self.user, title="gone")
+        self.gone = f"page:{gone.id}"
+        gone.delete()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _edit(self, room, words, age=0):
+        ydoc = None
+        for word in words:
+            ydoc, update = _text_update(word, ydoc)
+            yjs_compact.append_updates(self.store, [(room, update)])
+        conn = sqlite3.connect(self.store)
+        conn.execute("UPDATE yupdates SET timestamp = ? WHERE path = ?", (time.time() - age, room))
+        conn.commit()
+        conn.close()
+        return ydoc
+
+    def _text(self, room):
+        state, _, _ = yjs_compact.load_room(room, self.store)
+        ydoc = Y.YDoc()
+        if state:
+            Y.apply_update(ydoc, state)
+        return str(ydoc.get_text("t"))
+
+    def test_deletes_orphans_and_archives_idle_rooms(self):
+        self._edit(self.live, ("hello",))
+        idle = self._edit(self.idle, ("old", " doc"), age=3600)
+        self._edit(self.gone, ("bye",) * 50)
+        yjs_snapshots.take_snapshot(self.store, self.gone)
+
+        report = yjs_gc.collect_garbage(False, self.store, idle_ttl=600)
+        self.assertEqual((report["rooms"], report["orphaned"], report["archived"]), (3, 1, 1))
+        self.assertGreater(report["bytes_freed"], 0)
+        self.assertLessEqual(report["file_bytes_after"], report["file_bytes_before"])
+        self.assertEqual(_room_text(self.store, self.gone), ("", 0))
+        self.assertEqual(yjs_snapshots.list_snapshots(self.store, self.gone), [])
+        self.assertEqual(_room_text(self.store, self.idle), ("", 0))
+
+        # an update appended while archived lands after the archived state
+        _, update = _text_update("!", idle)
+        yjs_compact.append_updates(self.store, [(self.idle, update)])
+        self.assertEqual(self._text(self.idle), "old doc!")
+        self.assertEqual(_room_text(self.store, self.idle), ("old doc!", 1))
+        self.assertEqual(self._text(self.live), "hello")
+
+    def test_dry_run_changes_nothing(self):
+        self._edit(self.idle, ("old",), age=3600)
+        self._edit(self.gone, ("bye",))
+        out = StringIO()
+        call_command("gc_yjs", db=self.store, backend="sqlite", idle_ttl=600, dry_run=True, stdout=out)
+        self.assertIn("would delete orphaned: 1", out.getvalue())
+        self.assertIn("would archive: 1", out.getvalue())
+        self.assertEqual(_room_text(self.store, self.gone), ("bye", 1))
+        self.assertEqual(_room_text(self.store, self.idle), ("old", 1))
+
+    @override_settings(YJS_STORE_BACKEND="orm")
+    def test_orm_backend(self):
+        for room, age in ((self.live, 0), (self.idle, 3600), (self.gone, 0)):
+            ydoc = None
+            for word in ("a", "b"):
+                ydoc, update = _text_update(word, ydoc)
+                yjs_store.append_updates([(room, update)])
+            YjsUpdate.objects.filter(room=room).update(timestamp=time.time() - age)
+        out = StringIO()
+        call_command("gc_yjs", idle_ttl=600, stdout=out)
+        self.assertIn("deleted orphaned: 1, archived: 1", out.getvalue())
+        self.assertFalse(YjsUpdate.objects.filter(room__in=[self.gone, self.idle]).exists())
+        self.assertTrue(YjsArchivedRoom.objects.filter(room=self.idle).exists())
+        self.assertEqual(_orm_room_text(self.idle), ("ab", 1))
+        self.assertFalse(YjsArchivedRoom.objects.exists())
+
+    def test_periodic_runs_survive_a_failed_pass(self):
+        class Stop(Exception):
+            pass
+
+        report = yjs_gc.collect_garbage(False, self.store, idle_ttl=None, dry_run=True)
+        failure = sqlite3.OperationalError("database is locked")
+        with mock.patch.object(gc_yjs, "collect_garbage", side_effect=[failure, report]) as collect, \
+                mock.patch.object(gc_yjs.time, "sleep", side_effect=[None, Stop]), \
+                self.assertLogs("core.yjs", "ERROR") as logs, self.assertRaises(Stop):
+            call_command("gc_yjs", db=self.store, backend="sqlite", every=60, stdout=StringIO())
+        self.assertEqual(collect.call_count, 2)
+        self.assertEqual(logs.records[0].getMessage(), "Yjs garbage collection pass failed")
+
+
+class YjsCompressionTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, "yjs.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_codec_round_trip(self):
+        _, update = _text_update("lorem ipsum " * 200)
+        for name in yjs_codec.CODECS:
+            packed = yjs_codec.encode_update(update, name)
+            self.assertTrue(packed.startswith(yjs_codec.MAGIC))
+            self.assertLess(len(packed), len(update))
+            self.assertEqual(yjs_codec.decode_update(packed), update)
+        small = _text_update("hi")[1]
+        self.assertEqual(yjs_codec.encode_update(small, "zlib"), small)
+        self.assertEqual(yjs_codec.decode_update(update), update)
+        # a raw blob that merely starts with the marker is left alone
+        self.assertEqual(yjs_codec.decode_update(yjs_codec.MAGIC + b"z-not-zlib"), yjs_codec.MAGIC + b"z-not-zlib")
+
+    def test_compressed_and_raw_rows_coexist(self):
+        ydoc, update = _text_update("lorem ipsum " * 100)
+        yjs_compact.append_updates(self.store, [("page:a", update)])
+        with override_settings(YJS_COMPRESSION="zlib"):
+            ydoc, update = _text_update(" dolor" * 100, ydoc)
+            yjs_compact.append_updates(self.store, [("page:a", update)])
+        conn = sqlite3.connect(self.store)
+        blobs = [r[0] for r in conn.execute("SELECT yupdate FROM yupdates ORDER BY timestamp, rowid")]
+        conn.close()
+        self.assertEqual([b.startswith(yjs_codec.MAGIC) for b in blobs], [False, True])
+
+        expected = "lorem ipsum " * 100 + " dolor" * 100
+        state, rows, _ = yjs_compact.load_room("page:a", self.store)
+        self.assertEqual(rows, 2)
+        with override_settings(YJS_COMPRESSION="lzma"):
+            self.assertTrue(yjs_compact.compact_room("page:a", self.store))
+            snapshot_id = yjs_snapshots.take_snapshot(self.store, "page:a")
+        for blob in (yjs_compact.load_room("page:a", self.store)[0], state):
+            loaded = Y.YDoc()
+            Y.apply_update(loaded, blob)
+            self.assertEqual(str(loaded.get_text("t")), expected)
+        snapshot, _ = yjs_snapshots.get_snapshot(self.store, "page:a", snapshot_id)
+        self.assertEqual(snapshot, yjs_compact.load_room("page:a", self.store)[0])
+
+    @override_settings(YJS_STORE_BACKEND="orm", YJS_COMPRESSION="zlib")
+    def test_orm_rows_are_compressed(self):
+        ydoc, update = _text_update("lorem ipsum " * 100)
+        yjs_store.append_updates([("page:a", update)])
+        stored = bytes(YjsUpdate.objects.get(room="page:a").update)
+        self.assertTrue(stored.startswith(yjs_codec.MAGIC))
+        self.assertEqual(yjs_orm.load_room("page:a")[0], update)
+        self.assertEqual(_orm_room_text("page:a"), ("lorem ipsum " * 100, 1))
+
+
+class _FanoutMember:
+    def __init__(self, layer):
+        self.channel_layer = layer
+        self.received = []
+
+    async def send_message(self, event):
+        self.received.append(event["message"])
+
+
+class RoomFanoutTests(APITestCase):
+    def setUp(self):
+        self.layer = InMemoryChannelLayer()
+
+    def test_single_process_room_skips_the_layer(self):
+        fanout = RoomFanout()
+        alice, bob = _FanoutMember(self.layer), _FanoutMember(self.layer)
+
+        async def scenario():
+            await fanout.join("room", alice)
+            await fanout.join("room", bob)
+            ops = fanout.stats["layer_ops"]
+            await fanout.send("room", {"type": "send_message", "message": b"x"}, self.layer)
+            fanout.stop()
+            return fanout.stats["layer_ops"] - ops
+
+        self.assertEqual(asyncio.run(scenario()), 0)
+        self.assertEqual((alice.received, bob.received), ([b"x"], [b"x"]))
+        self.assertEqual(fanout.stats["publish_skipped"], 1)
+
+    def test_remote_members_get_messages_through_the_layer(self):
+        one, two = RoomFanout(), RoomFanout()
+        local, remote = _FanoutMember(self.layer), _FanoutMember(self.layer)
+
+        async def scenario():
+            await one.join("room", local)
+            await two.join("room", remote)
+            await asyncio.sleep(0.05)
+            await one.send("room", {"type": "send_message", "message": b"a"}, self.layer)
+            await asyncio.sleep(0.05)
+            await two.leave("room", remote)
+            await asyncio.sleep(0.05)
+            await one.send("room", {"type": "send_message", "message": b"b"}, self.layer)
+            # a sender with no members in the room (the HTTP views) always publishes
+            await two.send("room", {"type": "send_message", "message": b"c"}, self.layer)
+            await asyncio.sleep(0.05)
+            one.stop()
+            two.stop()
+
+        asyncio.run(scenario())
+        self.assertEqual(local.received, [b"a", b"b", b"c"])
+        self.assertEqual(remote.received, [b"a"])
+        self.assertEqual(one.stats["published"], 1)
+        self.assertEqual(one.stats["publish_skipped"], 1)
+
+    def test_lost_messages_are_counted_and_resynced(self):
+        layer = self.layer
+        one, two = RoomFanout(), RoomFanout()
+        local, remote = _FanoutMember(layer), _FanoutMember(layer)
+        peers = []
+
+        async def peer(group, origin):
+            peers.append((group, origin))
+
+        two.on_peer(peer)
+
+        async def scenario():
+            await one.join("room", local)
+            await two.join("room", remote)
+            await asyncio.sleep(0.05)
+            discovered = list(peers)
+            await one.send("room", {"type": "send_message", "message": b"a"}, layer)
+            # two messages published, then dropped by the layer (full channel)
+            one._sequence["room"] += 2
+            await one.send("room", {"type": "send_message", "message": b"d"}, layer)
+            await asyncio.sleep(0.05)
+            one.stop()
+            two.stop()
+            return discovered
+
+        with self.assertLogs("core.yjs", "WARNING"):
+            discovered = asyncio.run(scenario())
+        self.assertEqual(discovered, [("room", one.channel_name)])
+        self.assertEqual(remote.received, [b"a", b"d"])
+        self.assertEqual(two.stats["dropped"], 2)
+        # one more resync once the gap showed up
+        self.assertEqual(peers, [("room", one.channel_name)] * 2)
+
+    def test_a_slow_room_does_not_hold_up_the_others(self):
+        one, two = RoomFanout(), RoomFanout()
+
+        class _Slow(_FanoutMember):
+            async def send_message(self, event):
+                await self.gate.wait()
+                await super().send_message(event)
+
+        async def scenario():
+            slow, fast = _Slow(self.layer), _FanoutMember(self.layer)
+            slow.gate = asyncio.Event()
+            await one.join("slow", _FanoutMember(self.layer))
+            await one.join("fast", _FanoutMember(self.layer))
+            await two.join("slow", slow)
+            await two.join("fast", fast)
+            await asyncio.sleep(0.05)
+            await one.send("slow", {"type": "send_message", "message": b"s"}, self.layer)
+            await one.send("fast", {"type": "send_message", "message": b"f"}, self.layer)
+            await asyncio.sleep(0.05)
+            before = (list(slow.received), list(fast.received))
+            slow.gate.set()
+            await asyncio.sleep(0.05)
+            one.stop()
+            two.stop()
+            return before, slow.received
+
+        before, after = asyncio.run(scenario())
+        self.assertEqual(before, ([], [b"f"]))
+        self.assertEqual(after, [b"s"])
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class WsTicketTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pw")
+        self.viewer = User.objects.create_user(username="viewer", password="pw")
+        self.outsider = User.objects.create_user(username="outsider", password="pw")
+        self.page = Page.objects.create(owner=self.user, title="Page")
+        PageCollaborator.objects.create(page=self.page, user=self.viewer, role=CollaborationRole.VIEWER)
+        self.url = f"/api/pages/{self.page.id}/ws-ticket/"
+
+    def _ticket(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post(self.url)
+
+    def test_ticket_carries_user_room_and_role(self):
+        res = self._ticket(self.viewer)
+        self.assertEqual(res.status_code, 200)
+        grant = ws_tickets.read_ticket(res.data["ticket"], f"page:{self.page.id}")
+        self.assertEqual(grant, {"u": str(self.viewer.id), "r": f"page:{self.page.id}", "role": "viewer"})
+        self.assertIsNone(ws_tickets.read_ticket(res.data["ticket"], "page:other"))
+        self.assertIsNone(ws_tickets.read_ticket(res.data["ticket"] + "x", f"page:{self.page.id}"))
+        with self.settings(WS_TICKET_TTL=-1):
+            self.assertIsNone(ws_tickets.read_ticket(res.data["ticket"], f"page:{self.page.id}"))
+        self.assertIn(self._ticket(self.outsider).status_code, (403, 404))
+
+    def _connect(self, query):
+        from .routing import websocket_urlpatterns
+
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f"/ws/comments/{self.page.id}?{query}"
+            )
+            connected, code = await communicator.connect()
+            if connected:
+                await communicator.disconnect()
+            return connected, code
+
+        return async_to_sync(scenario)()
+
+    def test_connect_with_ticket_skips_database_checks(self):
+        ticket = self._ticket(self.user).data["ticket"]
+        with mock.patch.object(consumers, "_get_user_from_token", new=mock.AsyncMock()) as lookup, \
+                mock.patch.object(consumers, "_user_has_page_access", new=mock.AsyncMock()) as access:
+            connected, _ = self._connect(f"ticket={ticket}")
+        self.assertTrue(connected)
+        lookup.assert_not_awaited()
+        access.assert_not_awaited()
+
+    def test_invalid_ticket_falls_back_to_token(self):
+        self.assertEqual(self._connect("ticket=forged"), (False, 4001))
+        token = Token.objects.create(user=self.user)
+        connected, _ = self._connect(f"ticket=forged&token={token.key}")
+        self.assertTrue(connected)
+
+
+class ConnectAdmissionTests(APITestCase):
+    def test_queue_limits_and_deadline(self):
+        admission = consumers.ConnectAdmission()
+
+        async def scenario():
+            self.assertTrue(await admission.acquire("page:a"))
+            # the room is full but another room still gets a slot
+            self.assertTrue(await admission.acquire("page:b"))
+            waiting = asyncio.create_task(admission.acquire("page:a"))
+            await asyncio.sleep(0)
+            self.assertEqual(admission.stats()["waiting"], 1)
+            admission.release("page:a")
+            self.assertTrue(await waiting)
+            # nobody releases in time: shed at the deadline
+            self.assertFalse(await admission.acquire("page:a"))
+
+        with self.settings(WS_CONNECT_MAX_CONCURRENT=3, WS_CONNECT_MAX_PER_ROOM=1, WS_CONNECT_QUEUE_TIMEOUT=0.05):
+            asyncio.run(scenario())
+        self.assertEqual(
+            admission.stats(), {"active": 2, "waiting": 0, "admitted": 3, "queued": 2, "shed": 1}
+        )
+
+    def test_cancelled_waiter_returns_a_granted_slot(self):
+        admission = consumers.ConnectAdmission()
+
+        async def cancelled_after_grant(future, timeout):
+            # the connect goes away right after release() handed it the slot
+            await future
+            raise asyncio.CancelledError
+
+        async def scenario():
+            self.assertTrue(await admission.acquire("page:a"))
+            waiting = asyncio.create_task(admission.acquire("page:a"))
+            await asyncio.sleep(0)
+            admission.release("page:a")
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+
+        with self.settings(WS_CONNECT_MAX_CONCURRENT=1, WS_CONNECT_MAX_PER_ROOM=1), \
+                mock.patch.object(consumers.asyncio, "wait_for", cancelled_after_grant):
+            asyncio.run(scenario())
+        self.assertEqual(admission.stats()["active"], 0)
+        self.assertEqual(admission._rooms, {})
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        WS_CONNECT_MAX_CONCURRENT=0,
+        WS_CONNECT_MAX_QUEUE=0,
+    )
+    def test_shed_connect_closes_with_retry_after(self):
+        from .routing import websocket_urlpatterns
+
+        async def scenario():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/comments/x")
+            connected, _ = await communicator.connect()
+            closed = await communicator.receive_output()
+            return connected, closed
+
+        with mock.patch.object(consumers, "_connect_admission", consumers.ConnectAdmission()) as admission, \
+                self.assertLogs("core.yjs", "WARNING"):
+            connected, closed = async_to_sync(scenario)()
+        self.assertTrue(connected)
+        self.assertEqual(closed["code"], consumers.CONNECT_SHED_CLOSE_CODE)
+        self.assertRegex(closed["reason"], r"^retry-after=\d+(\.\d)?$")
+        self.assertEqual(admission.stats()["shed"], 1)
+
+
+class ClientFrameLimitTests(APITestCase):
+    def test_token_bucket_debt(self):
+        now = [0.0]
+        bucket = TokenBucket(10, 2, clock=lambda: now[0])
+        self.assertEqual((bucket.take(), bucket.take()), (0.0, 0.0))
+        self.assertAlmostEqual(bucket.take(), 0.1)
+        now[0] = 1.0
+        self.assertEqual(bucket.take(), 0.0)
+
+    def _consumer(self):
+        consumer = consumers.YjsDocumentConsumer()
+        consumer.scope = {"url_route": {"kwargs": {"room": "page:a"}}}
+        consumer._raw_room = "page:a"
+        consumer.user_id = "7"
+        consumer.ydoc = Y.YDoc()
+        consumer._websocket_shim = object()
+        consumer._handle_sync = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        return consumer
+
+    def _receive(self, consumer, frames):
+        async def scenario():
+            for frame in frames:
+                await consumer.receive(bytes_data=frame)
+
+        asyncio.run(scenario())
+
+    def test_oversize_frame_closes_the_socket(self):
+        consumer = self._consumer()
+        stats = consumers.ClientLimitStats()
+        with self.settings(YJS_MAX_FRAME_BYTES=100), mock.patch.object(consumers, "_client_limits", stats), \
+                self.assertLogs("core.yjs", "WARNING"):
+            self._receive(consumer, [b"\x00\x02" + b"x" * 200, b"\x00\x02x"])
+        consumer._handle_sync.assert_not_awaited()
+        consumer.close.assert_awaited_once_with(code=consumers.FRAME_TOO_BIG_CLOSE_CODE)
+        self.assertEqual(stats.stats()["offenders"][0]["oversize"], 1)
+
+    def test_bursts_are_throttled_then_disconnected(self):
+        stats = consumers.ClientLimitStats()
+        frames = [b"\x00\x02x"] * 3
+        with self.settings(YJS_RATE_MESSAGES=10, YJS_RATE_MESSAGES_BURST=2, YJS_RATE_MAX_DELAY=0.5), \
+                mock.patch.object(consumers, "_client_limits", stats):
+            consumer = self._consumer()
+            started = time.monotonic()
+            self._receive(consumer, frames)
+            self.assertGreaterEqual(time.monotonic() - started, 0.08)
+            self.assertEqual(consumer._handle_sync.await_count, 3)
+            consumer.close.assert_not_awaited()
+
+            with self.settings(YJS_RATE_MAX_DELAY=0.05), self.assertLogs("core.yjs", "WARNING"):
+                consumer = self._consumer()
+                self._receive(consumer, frames)
+            self.assertEqual(consumer._handle_sync.await_count, 2)
+            consumer.close.assert_awaited_once_with(code=consumers.RATE_LIMIT_CLOSE_CODE)
+        [offender] = stats.stats()["offenders"]
+        self.assertEqual(
+            (offender["user_id"], offender["room"], offender["throttled"], offender["disconnected"]),
+            ("7", "page:a", 1, 1),
+        )
@@ -6,6 +6,7 @@ from .views import (
     UserLookupViewSet,
     PageInviteViewSet,
     PageAuditLogViewSet,
+    RealtimeStatsViewSet,
 )
 
 router = DefaultRouter()
@@ -14,6 +15,7 @@ router.register(r"tiptap-docs", TiptapDocumentViewSet, basename="tiptap-docs")
 router.register(r"users", UserLookupViewSet, basename="users")
 router.register(r"invites", PageInviteViewSet, basename="invites")
 router.register(r"audit-logs", PageAuditLogViewSet, basename="audit-logs")
+router.register(r"realtime-stats", RealtimeStatsViewSet, basename="realtime-stats")
 
 urlpatterns = [
     path("", include(router.urls)),
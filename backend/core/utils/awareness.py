@@ -0,0 +1,24 @@
+from ypy_websocket.yutils import Decoder, YMessageType, write_var_uint
+
+# y-protocols drops remote awareness states that were not renewed for 30s
+AWARENESS_TIMEOUT = 30
+
+
+def decode_awareness(message: bytes) -> list[tuple[int, int, str]]:
+    """(client id, clock, JSON state) entries of an awareness frame."""
+    update = Decoder(message[1:]).read_message()
+    decoder = Decoder(update)
+    entries = []
+    for _ in range(decoder.read_var_uint()):
+        client = decoder.read_var_uint()
+        clock = decoder.read_var_uint()
+        entries.append((client, clock, decoder.read_var_string()))
+    return entries
+
+
+def encode_awareness(entries) -> bytes:
+    update = bytearray(write_var_uint(len(entries)))
+    for client, clock, state in entries:
+        data = state.encode("utf-8")
+        update += write_var_uint(client) + write_var_uint(clock) + write_var_uint(len(data)) + data
+    return bytes([YMessageType.AWARENESS]) + write_var_uint(len(update)) + bytes(update)
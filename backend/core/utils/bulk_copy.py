@@ -0,0 +1,49 @@
+from django.db import connection, models
+
+
+def _adapter(field):
+    # UUIDField.get_db_prep_value is costly per call; the adaptation is trivial.
+    if isinstance(field, models.UUIDField):
+        if connection.features.has_native_uuid_field:
+            return lambda value: value
+        return lambda value: value.hex if value is not None else None
+    return lambda value: field.get_db_prep_value(value, connection)
+
+
+def copy_rows(model, key, mapping, mapping_fields, columns, params=(), batch_size=300) -> int:
+    """
+    Copy rows of `model` with one INSERT ... SELECT per batch, so the copied
+    column values never travel through Python.
+
+    Each `mapping` tuple starts with the source value of the `key` column and
+    is joined as a VALUES row; `mapping_fields` are the model fields used to
+    adapt each tuple position for the database. In `columns` (target column
+    name -> SQL expression) the source row is `s` and the mapping values are
+    `m.column1`, `m.column2`, ... (the default VALUES names on both SQLite and
+    PostgreSQL). `params` fill the %s placeholders of the expressions.
+    """
+    if not mapping:
+        return 0
+    table = model._meta.db_table
+    quote = connection.ops.quote_name
+    targets = ", ".join(quote(col) for col in columns)
+    exprs = ", ".join(columns.values())
+    key_col = quote(model._meta.get_field(key).column)
+
+    adapters = [_adapter(field) for field in mapping_fields]
+    copied = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(mapping), batch_size):
+            chunk = mapping[start:start + batch_size]
+            row_sql = "(" + ", ".join("%s" for _ in mapping_fields) + ")"
+            values = ", ".join(row_sql for _ in chunk)
+            chunk_params = list(params)
+            for row in chunk:
+                chunk_params += [adapt(value) for adapt, value in zip(adapters, row)]
+            cursor.execute(
+                f"INSERT INTO {quote(table)} ({targets}) SELECT {exprs} "
+                f"FROM {quote(table)} s JOIN (VALUES {values}) m ON s.{key_col} = m.column1",
+                chunk_params,
+            )
+            copied += cursor.rowcount
+    return copied
@@ -0,0 +1,78 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from ..models import Page, PageChange, PageChangeHorizon, PageCollaborator
+
+PRUNE_BATCH_SIZE = 5000
+
+
+def record_page_changes(page_ids, users=None) -> int:
+    """
+    Append a PageChange row for every (page, affected user) pair.
+
+    When `users` is omitted the page owner and all collaborators are affected.
+    Call this before deleting pages or collaborators so they are still found.
+    """
+    page_ids = set(page_ids)
+    if not page_ids:
+        return 0
+
+    if users is None:
+        pairs = set(Page.objects.filter(id__in=page_ids).values_list("id", "owner_id"))
+        pairs |= set(
+            PageCollaborator.objects.filter(page_id__in=page_ids).values_list("page_id", "user_id")
+        )
+    else:
+        user_ids = {getattr(u, "pk", u) for u in users}
+        pairs = {(pid, uid) for pid in page_ids for uid in user_ids}
+
+    PageChange.objects.bulk_create(
+        [PageChange(page_id=pid, user_id=uid) for pid, uid in pairs],
+        batch_size=500,
+    )
+    return len(pairs)
+
+
+def latest_change_id(user) -> int:
+    last = PageChange.objects.filter(user=user).order_by("-id").values_list("id", flat=True).first()
+    # a fully pruned log keeps its cursor instead of going back to 0
+    return max(last or 0, change_horizon(user))
+
+
+def change_horizon(user) -> int:
+    """Newest change id pruned from `user`'s log (0: nothing pruned)."""
+    horizon = PageChangeHorizon.objects.filter(user=user).values_list("pruned_through", flat=True).first()
+    return horizon or 0
+
+
+def prune_page_changes(max_age: float, dry_run: bool = False) -> int:
+    """
+    Delete PageChange rows older than `max_age` seconds and move each
+    affected user's horizon past them. Returns the number of rows pruned.
+    """
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    # ids grow with time, so everything up to the newest old row goes
+    through = PageChange.objects.filter(created_at__lt=cutoff).aggregate(last=Max("id"))["last"]
+    if through is None:
+        return 0
+    pruned = PageChange.objects.filter(id__lte=through)
+    if dry_run:
+        return pruned.count()
+    with transaction.atomic():
+        horizons = pruned.values("user_id").annotate(last=Max("id")).values_list("user_id", "last")
+        PageChangeHorizon.objects.bulk_create(
+            [PageChangeHorizon(user_id=user_id, pruned_through=last) for user_id, last in horizons],
+            update_conflicts=True,
+            unique_fields=["user"],
+            update_fields=["pruned_through"],
+            batch_size=500,
+        )
+    deleted = 0
+    while True:
+        ids = list(pruned.order_by("id").values_list("id", flat=True)[:PRUNE_BATCH_SIZE])
+        if not ids:
+            return deleted
+        deleted += PageChange.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,153 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from fractional_indexing import generate_key_between, generate_n_keys_between
+
+from ..models import Page, PageFavorite
+from .changes import record_page_changes
+
+logger = logging.getLogger("core.positions")
+
+# Page.position, Page.favorite_position and PageFavorite.position columns
+POSITION_MAX_LENGTH = 32
+
+
+def rebalance_length() -> int:
+    return getattr(settings, "POSITION_REBALANCE_LENGTH", 24)
+
+
+def key_after(prev: str | None) -> str:
+    return generate_key_between(prev or None, None)
+
+
+def keys_between(prev: str | None, next_: str | None, n: int) -> list[str]:
+    """n keys strictly between prev and next_, bisected so they stay short."""
+    if n <= 0:
+        return []
+    return generate_n_keys_between(prev or None, next_ or None, n)
+
+
+def evenly_spaced_keys(n: int) -> list[str]:
+    """Fresh keys for a whole sibling set (a0, a1, ...), used by rebalancing."""
+    return keys_between(None, None, n)
+
+
+def needs_rebalance(key: str | None) -> bool:
+    return bool(key) and len(key) > rebalance_length()
+
+
+# ===========================
+# REBALANCING
+# ===========================
+
+def rebalance_page_siblings(owner_id, parent_id) -> int:
+    """Rewrite the positions of one sibling set with short keys, keeping order."""
+    with transaction.atomic():
+        pages = list(
+            Page.objects.select_for_update()
+            .filter(owner_id=owner_id, parent_id=parent_id, deleted_at__isnull=True)
+            .order_by("position", "created_at")
+            .only("id", "position")
+        )
+        changed = []
+        for page, key in zip(pages, evenly_spaced_keys(len(pages))):
+            if page.position != key:
+                page.position = key
+                changed.append(page)
+        Page.objects.bulk_update(changed, ["position"], batch_size=500)
+        record_page_changes([p.id for p in changed])
+    return len(changed)
+
+
+def rebalance_favorites(user_id) -> int:
+    """Rewrite one user's favorite positions with short keys, keeping order."""
+    with transaction.atomic():
+        favs = list(
+            PageFavorite.objects.select_for_update()
+            .filter(user_id=user_id)
+            .exclude(position__isnull=True)
+            .order_by("position", "created_at")
+        )
+        now = timezone.now()
+        changed = []
+        for fav, key in zip(favs, evenly_spaced_keys(len(favs))):
+            if fav.position != key:
+                fav.position = key
+                fav.updated_at = now
+                changed.append(fav)
+        PageFavorite.objects.bulk_update(changed, ["position", "updated_at"], batch_size=500)
+        record_page_changes([f.page_id for f in changed], users=[user_id])
+    return len(changed)
+
+
+def rebalance_legacy_favorites(owner_id) -> int:
+    """Rewrite the legacy Page.favorite_position keys of one owner with short keys, keeping order."""
+    with transaction.atomic():
+        pages = list(
+            Page.objects.select_for_update()
+            .filter(owner_id=owner_id, favorite_position__isnull=False)
+            .order_by("favorite_position", "created_at")
+            .only("id", "favorite_position")
+        )
+        changed = []
+        for page, key in zip(pages, evenly_spaced_keys(len(pages))):
+            if page.favorite_position != key:
+                page.favorite_position = key
+                changed.append(page)
+        Page.objects.bulk_update(changed, ["favorite_position"], batch_size=500)
+        record_page_changes([p.id for p in changed])
+    return len(changed)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="positions")
+_pending: set[tuple] = set()
+_pending_lock = threading.Lock()
+
+
+def _run_rebalance(job: tuple):
+    kind, *args = job
+    try:
+        if kind == "pages":
+            rebalance_page_siblings(*args)
+        elif kind == "legacy_favorites":
+            rebalance_legacy_favorites(*args)
+        else:
+            rebalance_favorites(*args)
+    except Exception:
+        logger.exception("Position rebalance failed", extra={"job": job})
+    finally:
+        with _pending_lock:
+            _pending.discard(job)
+        connection.close()
+
+
+def _schedule(job: tuple):
+    def submit():
+        with _pending_lock:
+            if job in _pending:
+                return
+            _pending.add(job)
+        _executor.submit(_run_rebalance, job)
+
+    transaction.on_commit(submit)
+
+
+def maybe_rebalance_pages(pages):
+    """Queue a background rebalance for every sibling set holding an overlong key."""
+    for owner_id, parent_id in {(p.owner_id, p.parent_id) for p in pages if needs_rebalance(p.position)}:
+        _schedule(("pages", owner_id, parent_id))
+
+
+def maybe_rebalance_favorites(user_id, positions):
+    if any(needs_rebalance(pos) for pos in positions):
+        _schedule(("favorites", user_id))
+
+
+def maybe_rebalance_legacy_favorites(pages):
+    """Queue a rebalance of Page.favorite_position for every owner holding an overlong key."""
+    for owner_id in {p.owner_id for p in pages if needs_rebalance(p.favorite_position)}:
+        _schedule(("legacy_favorites", owner_id))
@@ -0,0 +1,27 @@
+import time
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, holding at most `burst`.
+
+    take() always succeeds but may leave the bucket in debt; it returns how
+    many seconds the caller should wait for the debt to be paid back
+    (0 when the tokens were there).
+    """
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    def take(self, amount: float = 1) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
@@ -0,0 +1,91 @@
+import uuid
+
+import pycrdt
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from ..models import Page, TiptapDocument
+
+# Name of the XmlFragment the editor binds to (Collaboration extension).
+TIPTAP_FRAGMENT = "prosemirror"
+
+
+def _plain(value):
+    # Yjs numbers come back as floats: 2.0 -> 2, as ProseMirror wrote them
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _text_nodes(text: pycrdt.XmlText) -> list[dict]:
+    nodes = []
+    for chunk, attrs in text.diff():
+        if not isinstance(chunk, str) or not chunk:
+            continue
+        node = {"type": "text", "text": chunk}
+        if attrs:
+            marks = []
+            for key, value in attrs.items():
+                # y-prosemirror stores overlapping marks as "<mark>--<hash>"
+                mark = {"type": key.split("--", 1)[0]}
+                if value:
+                    mark["attrs"] = _plain(value)
+                marks.append(mark)
+            node["marks"] = marks
+        nodes.append(node)
+    return nodes
+
+
+def _children(parent) -> list[dict]:
+    content = []
+    for child in parent.children:
+        if isinstance(child, pycrdt.XmlText):
+            content.extend(_text_nodes(child))
+        elif isinstance(child, pycrdt.XmlElement):
+            node = {"type": child.tag}
+            attrs = {k: _plain(v) for k, v in dict(child.attributes).items() if v is not None}
+            if attrs:
+                node["attrs"] = attrs
+            inner = _children(child)
+            if inner:
+                node["content"] = inner
+            content.append(node)
+    return content
+
+
+def yjs_to_tiptap(state: bytes, fragment: str = TIPTAP_FRAGMENT) -> dict:
+    """Tiptap JSON for the ProseMirror fragment of an encoded Yjs state."""
+    doc = pycrdt.Doc()
+    doc.apply_update(state)
+    content = _children(doc.get(fragment, type=pycrdt.XmlFragment))
+    return {"type": "doc", "content": content}
+
+
+def materialize_page_doc(page_id: uuid.UUID | str, state: bytes) -> bool:
+    """
+    Store the Tiptap JSON of a page's Yjs state in its TiptapDocument,
+    bumping `version`. Returns False when nothing was written: the content
+    did not change, the page is gone, or the fragment is still empty (the
+    editor seeds it from the REST copy, which must not be blanked first).
+    """
+    content = yjs_to_tiptap(state)
+    if not content["content"]:
+        return False
+    with transaction.atomic():
+        doc = TiptapDocument.objects.select_for_update().filter(page_id=page_id).first()
+        if doc is None:
+            if not Page.objects.filter(pk=page_id).exists():
+                return False
+            TiptapDocument.objects.create(page_id=page_id, content=content)
+            return True
+        if doc.content == content:
+            return False
+        TiptapDocument.objects.filter(pk=doc.pk).update(
+            content=content, version=F("version") + 1, updated_at=timezone.now()
+        )
+    return True
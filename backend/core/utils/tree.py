@@ -12,4 +12,41 @@ def flatten_tree(items, parent_temp=None, out=None):
 
         flatten_tree(children, it.get("tempId"), out)
 
-    return out
\ No newline at end of file
+    return out
+
+# Materialized page paths: "/<root hex>/<child hex>/.../<self hex>/".
+# A page's subtree is every page whose path starts with its own path.
+
+PATH_SEP = "/"
+
+
+def page_path(parent_path, page_id) -> str:
+    return f"{parent_path or PATH_SEP}{page_id.hex}{PATH_SEP}"
+
+
+def path_ancestor_hexes(path: str) -> list[str]:
+    """Ancestor id hexes, root first, excluding the page itself."""
+    return [seg for seg in path.split(PATH_SEP) if seg][:-1]
+
+
+def compute_paths(rows):
+    """
+    Expected paths for every (id, parent_id) row, walking from the roots down.
+
+    Returns (paths, unreachable): pages caught in a parent cycle have no
+    well-defined path and are reported in `unreachable` instead.
+    """
+    children = {}
+    ids = set()
+    for pid, parent_id in rows:
+        ids.add(pid)
+        children.setdefault(parent_id, []).append(pid)
+
+    paths = {}
+    stack = [(pid, None) for pid in children.get(None, [])]
+    while stack:
+        pid, parent = stack.pop()
+        paths[pid] = page_path(paths.get(parent), pid)
+        stack.extend((ch, pid) for ch in children.get(pid, []))
+
+    return paths, ids - set(paths)
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core import signing
+
+# Short-lived, HMAC-signed (SECRET_KEY) proof that a user may join a room,
+# so WebSocket connects can be authorised without touching the database.
+TICKET_SALT = "core.ws-ticket"
+
+
+def ticket_ttl() -> int:
+    return getattr(settings, "WS_TICKET_TTL", 60)
+
+
+def issue_ticket(user_id, room: str, role: str) -> str:
+    return signing.dumps({"u": str(user_id), "r": room, "role": role}, salt=TICKET_SALT, compress=True)
+
+
+def read_ticket(ticket: str | None, room: str) -> dict | None:
+    """{"u": user id, "r": room, "role": role} of a valid ticket for `room`, else None."""
+    if not ticket:
+        return None
+    try:
+        data = signing.loads(ticket, salt=TICKET_SALT, max_age=ticket_ttl())
+    except signing.BadSignature:
+        # also covers SignatureExpired
+        return None
+    if not isinstance(data, dict) or data.get("r") != room or not data.get("u"):
+        return None
+    return data
@@ -1,49 +1,293 @@
 import sqlite3
 import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
 from typing import Iterable
 
 import y_py as Y
 
+from .yjs_codec import decode_update, encode_update
+
 
 def _apply_updates(rows: Iterable[bytes]) -> bytes:
     ydoc = Y.YDoc()
     for update in rows:
         if update:
-            Y.apply_update(ydoc, update)
+            Y.apply_update(ydoc, decode_update(update))
     return Y.encode_state_as_update(ydoc)
 
 
-def compact_room(room_name: str, db_path: str) -> bool:
+# ypy_websocket's SQLiteYStore schema (store format version 2)
+STORE_VERSION = 2
+
+
+def ensure_store(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS yupdates "
+        "(path TEXT NOT NULL, yupdate BLOB, metadata BLOB, timestamp REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_yupdates_path_timestamp ON yupdates (path, timestamp)")
+    if not conn.execute("PRAGMA user_version").fetchone()[0]:
+        conn.execute(f"PRAGMA user_version = {STORE_VERSION}")
+    # squashed state of rooms idle past the GC TTL, moved out of yupdates
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS yarchive (path TEXT PRIMARY KEY, state BLOB NOT NULL, archived_at REAL NOT NULL)"
+    )
+
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    row = conn.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+    return bool(row[0])
+
+
+def _unarchive(conn: sqlite3.Connection, room_name: str):
+    """
+    Move an archived room back into yupdates, merged with anything appended
+    since it was archived, as a single row. Must run outside a transaction.
+    """
+    if not _has_table(conn, "yarchive"):
+        return
+    if conn.execute("SELECT 1 FROM yarchive WHERE path = ?", (room_name,)).fetchone() is None:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute("SELECT state FROM yarchive WHERE path = ?", (room_name,)).fetchone()
+    if row is None:
+        conn.rollback()
+        return
+    # the archived state goes first: it predates every row still in yupdates
+    history = conn.execute("SELECT yupdate FROM yupdates WHERE path = ? ORDER BY timestamp", (room_name,))
+    merged = _apply_updates([row[0], *(r[0] for r in history)])
+    conn.execute("DELETE FROM yupdates WHERE path = ?", (room_name,))
+    conn.execute("DELETE FROM yarchive WHERE path = ?", (room_name,))
+    conn.execute(
+        "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
+        (room_name, sqlite3.Binary(encode_update(merged)), b"", time.time()),
+    )
+    conn.commit()
+
+
+def append_updates(db_path: str, rows: list[tuple[str, bytes]], document_ttl: int | None = None) -> int:
+    """
+    Append one update per (room, update) row in a single transaction.
+
+    Like SQLiteYStore.write, a room whose last update is older than
+    `document_ttl` seconds has its history squashed before the append.
+    """
+    if not rows:
+        return 0
     conn = sqlite3.connect(db_path)
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT yupdate FROM yupdates WHERE path = ? ORDER BY timestamp", (room_name,))
-        rows = cur.fetchall()
-        if not rows:
-            return False
-        squashed = _apply_updates([r[0] for r in rows])
-        cur.execute("DELETE FROM yupdates WHERE path = ?", (room_name,))
-        cur.execute(
+        ensure_store(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        if document_ttl is not None:
+            for room in {room for room, _ in rows}:
+                last = conn.execute("SELECT max(timestamp) FROM yupdates WHERE path = ?", (room,)).fetchone()[0]
+                if last is not None and now - last > document_ttl:
+                    history = conn.execute(
+                        "SELECT yupdate FROM yupdates WHERE path = ? ORDER BY timestamp", (room,)
+                    )
+                    squashed = _apply_updates(r[0] for r in history)
+                    conn.execute("DELETE FROM yupdates WHERE path = ?", (room,))
+                    conn.execute(
+                        "INSERT INTO yupdates VALUES (?, ?, ?, ?)", (room, encode_update(squashed), b"", last)
+                    )
+        conn.executemany(
             "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
-            (room_name, sqlite3.Binary(squashed), b"", time.time()),
+            [(room, sqlite3.Binary(encode_update(update)), b"", now) for room, update in rows],
         )
         conn.commit()
-        return True
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def load_room(room_name: str, db_path: str) -> tuple[bytes | None, int, int]:
+    """
+    The stored state of one room as a single update (None if it has none),
+    with the number of rows and bytes it was rebuilt from.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='yupdates'")
+        if not cur.fetchone()[0]:
+            return None, 0, 0
+        _unarchive(conn, room_name)
+        cur.execute("SELECT yupdate FROM yupdates WHERE path = ? ORDER BY timestamp", (room_name,))
+        rows = [r[0] for r in cur]
+        if not rows:
+            return None, 0, 0
+        return _apply_updates(rows), len(rows), sum(len(r) for r in rows if r)
+    finally:
+        conn.close()
+
+
+def last_update_at(room_name: str, db_path: str) -> float | None:
+    """Timestamp of the newest stored update of a room."""
+    conn = sqlite3.connect(db_path)
+    try:
+        if not _has_table(conn, "yupdates"):
+            return None
+        return conn.execute("SELECT max(timestamp) FROM yupdates WHERE path = ?", (room_name,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _compact(conn: sqlite3.Connection, room_name: str) -> tuple[int, int, int]:
+    """
+    Squash one room, streaming its updates from a cursor.
+
+    The rows are read and merged without holding the write lock; only rows
+    up to the highest rowid read are then deleted, so updates appended
+    meanwhile survive. If the room changed underneath (another compaction
+    removed some of the rows read), nothing is written.
+    Returns (rows, bytes before, bytes after); rows < 2 means untouched.
+    """
+    ydoc = Y.YDoc()
+    rows = size = 0
+    max_rowid = None
+    cur = conn.execute(
+        "SELECT rowid, yupdate FROM yupdates WHERE path = ? ORDER BY timestamp", (room_name,)
+    )
+    for rowid, update in cur:
+        rows += 1
+        if update:
+            size += len(update)
+            Y.apply_update(ydoc, decode_update(update))
+        max_rowid = rowid if max_rowid is None else max(max_rowid, rowid)
+    if rows < 2:
+        return rows, size, size
+    squashed = encode_update(Y.encode_state_as_update(ydoc))
+
+    conn.execute("BEGIN IMMEDIATE")
+    still_there = conn.execute(
+        "SELECT count(*) FROM yupdates WHERE path = ? AND rowid <= ?", (room_name, max_rowid)
+    ).fetchone()[0]
+    if still_there != rows:
+        conn.rollback()
+        return 0, size, size
+    conn.execute("DELETE FROM yupdates WHERE path = ? AND rowid <= ?", (room_name, max_rowid))
+    conn.execute(
+        "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
+        (room_name, sqlite3.Binary(squashed), b"", time.time()),
+    )
+    conn.commit()
+    return rows, size, len(squashed)
+
+
+def compact_room(room_name: str, db_path: str) -> bool:
+    conn = sqlite3.connect(db_path)
+    try:
+        rows, _, _ = _compact(conn, room_name)
+        return rows > 0
     finally:
         conn.close()
 
 
-def compact_all_rooms(db_path: str) -> int:
+def select_rooms(db_path: str, min_updates: int = 2, older_than: float | None = None) -> list[tuple[str, int, int]]:
+    """(room, rows, bytes) for rooms with at least `min_updates` rows whose last
+    update is more than `older_than` seconds old."""
     conn = sqlite3.connect(db_path)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT DISTINCT path FROM yupdates")
-        rooms = [r[0] for r in cur.fetchall()]
+        cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='yupdates'")
+        if not cur.fetchone()[0]:
+            return []
+        sql = (
+            "SELECT path, count(*), coalesce(sum(length(yupdate)), 0) FROM yupdates "
+            "GROUP BY path HAVING count(*) >= ?"
+        )
+        params: list = [max(min_updates, 1)]
+        if older_than is not None:
+            sql += " AND max(timestamp) <= ?"
+            params.append(time.time() - older_than)
+        return [tuple(row) for row in cur.execute(sql, params)]
     finally:
         conn.close()
 
-    count = 0
-    for room in rooms:
-        if compact_room(room, db_path):
-            count += 1
-    return count
+
+def _compact_chunk(db_path: str, rooms: list[str]) -> list[tuple[int, int, int]]:
+    conn = sqlite3.connect(db_path)
+    try:
+        return [_compact(conn, room) for room in rooms]
+    finally:
+        conn.close()
+
+
+def compact_all_rooms(
+    db_path: str,
+    jobs: int = 1,
+    min_updates: int = 2,
+    older_than: float | None = None,
+    dry_run: bool = False,
+    chunk_size: int = 200,
+) -> dict:
+    """
+    Compact every selected room, `chunk_size` rooms per connection, spread
+    over `jobs` processes. Returns counts of rooms and bytes before/after.
+    """
+    selected = select_rooms(db_path, min_updates, older_than)
+    report = {
+        "rooms": len(selected),
+        "compacted": 0,
+        "bytes_before": sum(size for _, _, size in selected),
+        "bytes_after": 0,
+    }
+    if dry_run or not selected:
+        report["bytes_after"] = report["bytes_before"]
+        return report
+
+    rooms = [room for room, _, _ in selected]
+    chunks = [rooms[i:i + chunk_size] for i in range(0, len(rooms), chunk_size)]
+    if jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(_compact_chunk, [db_path] * len(chunks), chunks)
+            results = [r for chunk in results for r in chunk]
+    else:
+        results = [r for chunk in chunks for r in _compact_chunk(db_path, chunk)]
+
+    report["compacted"] = sum(1 for rows, _, _ in results if rows > 1)
+    report["bytes_after"] = sum(after for _, _, after in results)
+    return report
+
+
+def copy_rooms(room_map: dict[str, str], db_path: str, batch_size: int = 500) -> int:
+    """
+    Copy each source room into its target room as a single compacted update.
+
+    `room_map` maps source room names to target room names. Rows are streamed
+    in `batch_size` rooms at a time and all inserts share one transaction.
+    """
+    if not room_map:
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='yupdates'")
+        if not cur.fetchone()[0]:
+            return 0
+
+        sources = list(room_map)
+        for room in sources:
+            _unarchive(conn, room)
+        now = time.time()
+        copied = 0
+        for start in range(0, len(sources), batch_size):
+            chunk = sources[start:start + batch_size]
+            placeholders = ", ".join("?" for _ in chunk)
+            read = conn.execute(
+                f"SELECT path, yupdate FROM yupdates WHERE path IN ({placeholders}) "
+                "ORDER BY path, timestamp",
+                chunk,
+            )
+            snapshots = [
+                (room_map[room], sqlite3.Binary(encode_update(_apply_updates(u for _, u in rows))), b"", now)
+                for room, rows in groupby(read, key=lambda r: r[0])
+            ]
+            cur.executemany("INSERT INTO yupdates VALUES (?, ?, ?, ?)", snapshots)
+            copied += len(snapshots)
+        conn.commit()
+        return copied
+    finally:
+        conn.close()
@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import time
+import uuid
+
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.db.models.functions import Coalesce, Length
+
+from ..models import Page, YjsArchivedRoom, YjsRoomReset, YjsSnapshot, YjsUpdate
+from .yjs_codec import encode_update
+from .yjs_compact import _apply_updates
+from .yjs_orm import _updates
+from .yjs_snapshots import _connect
+
+# Garbage collection of the Yjs store: rooms of pages that no longer exist
+# lose their updates, snapshots and archive; rooms idle past a TTL are
+# squashed into the archive table (yarchive / YjsArchivedRoom), out of the
+# update log that compaction and the GROUP BY queries scan. An archived room
+# is moved back on its next load, so archiving never changes what a client
+# sees.
+
+BATCH_SIZE = 500
+
+
+def orphaned_rooms(rooms) -> list[str]:
+    """The "page:<id>" rooms among `rooms` whose page no longer exists."""
+    page_rooms, orphans = {}, []
+    for room in rooms:
+        kind, _, raw = room.partition(":")
+        if kind != "page":
+            continue
+        try:
+            page_rooms[uuid.UUID(raw)] = room
+        except ValueError:
+            # no page can ever match it
+            orphans.append(room)
+    ids = list(page_rooms)
+    for start in range(0, len(ids), BATCH_SIZE):
+        for page_id in Page.objects.filter(id__in=ids[start:start + BATCH_SIZE]).values_list("id", flat=True):
+            page_rooms.pop(page_id, None)
+    return sorted(orphans + list(page_rooms.values()))
+
+
+# -------------------------
+# sqlite backend
+# -------------------------
+
+
+def _sqlite_rooms(conn: sqlite3.Connection, idle_before: float) -> tuple[set[str], list[str]]:
+    rooms = {
+        room
+        for (room,) in conn.execute(
+            "SELECT path FROM yupdates UNION SELECT path FROM yarchive "
+            "UNION SELECT path FROM ysnapshots UNION SELECT path FROM yresets"
+        )
+    }
+    idle = [
+        room
+        for (room,) in conn.execute(
+            "SELECT path FROM yupdates GROUP BY path HAVING max(timestamp) < ?", (idle_before,)
+        )
+    ]
+    return rooms, idle
+
+
+def _sqlite_delete(conn: sqlite3.Connection, rooms: list[str], dry_run: bool) -> int:
+    freed = 0
+    for start in range(0, len(rooms), BATCH_SIZE):
+        chunk = rooms[start:start + BATCH_SIZE]
+        placeholders = ", ".join("?" for _ in chunk)
+        for table, column in (("yupdates", "yupdate"), ("yarchive", "state"), ("ysnapshots", "state")):
+            freed += conn.execute(
+                f"SELECT coalesce(sum(length({column})), 0) FROM {table} WHERE path IN ({placeholders})", chunk
+            ).fetchone()[0]
+            if not dry_run:
+                conn.execute(f"DELETE FROM {table} WHERE path IN ({placeholders})", chunk)
+        if not dry_run:
+            conn.execute(f"DELETE FROM yresets WHERE path IN ({placeholders})", chunk)
+    conn.commit()
+    return freed
+
+
+def _sqlite_archive(conn: sqlite3.Connection, room: str, idle_before: float) -> tuple[int, int] | None:
+    conn.execute("BEGIN IMMEDIATE")
+    history = conn.execute(
+        "SELECT yupdate, timestamp FROM yupdates WHERE path = ? ORDER BY timestamp", (room,)
+    ).fetchall()
+    if not history or max(ts for _, ts in history) >= idle_before:
+        # written to since it was selected
+        conn.rollback()
+        return None
+    archived = conn.execute("SELECT state FROM yarchive WHERE path = ?", (room,)).fetchone()
+    states = ([archived[0]] if archived else []) + [update for update, _ in history]
+    merged = encode_update(_apply_updates(states))
+    conn.execute("DELETE FROM yupdates WHERE path = ?", (room,))
+    conn.execute(
+        "INSERT OR REPLACE INTO yarchive (path, state, archived_at) VALUES (?, ?, ?)",
+        (room, sqlite3.Binary(merged), time.time()),
+    )
+    conn.commit()
+    return sum(len(s) for s in states if s), len(merged)
+
+
+def _sqlite_size(db_path: str) -> int:
+    return os.path.getsize(db_path) if os.path.exists(db_path) else 0
+
+
+# -------------------------
+# orm backend
+# -------------------------
+
+
+def _orm_rooms(idle_before: float) -> tuple[set[str], list[str]]:
+    rooms = set(YjsUpdate.objects.values_list("room", flat=True).distinct())
+    rooms.update(YjsArchivedRoom.objects.values_list("room", flat=True))
+    rooms.update(YjsSnapshot.objects.values_list("room", flat=True).distinct())
+    rooms.update(YjsRoomReset.objects.values_list("room", flat=True))
+    idle = list(
+        YjsUpdate.objects.values("room")
+        .annotate(last=Max("timestamp"))
+        .filter(last__lt=idle_before)
+        .values_list("room", flat=True)
+    )
+    return rooms, idle
+
+
+def _orm_delete(rooms: list[str], dry_run: bool) -> int:
+    freed = 0
+    for start in range(0, len(rooms), BATCH_SIZE):
+        chunk = rooms[start:start + BATCH_SIZE]
+        with transaction.atomic():
+            for model, field in ((YjsUpdate, "update"), (YjsArchivedRoom, "state"), (YjsSnapshot, "state")):
+                rows = model.objects.filter(room__in=chunk)
+                freed += rows.aggregate(size=Coalesce(Sum(Length(field)), 0))["size"]
+                if not dry_run:
+                    rows.delete()
+            if not dry_run:
+                YjsRoomReset.objects.filter(room__in=chunk).delete()
+    return freed
+
+
+def _orm_archive(room: str, idle_before: float) -> tuple[int, int] | None:
+    with transaction.atomic():
+        history = list(_updates(room).select_for_update().values_list("update", "timestamp"))
+        if not history or max(ts for _, ts in history) >= idle_before:
+            return None
+        archived = YjsArchivedRoom.objects.select_for_update().filter(room=room).values_list("state", flat=True).first()
+        states = ([bytes(archived)] if archived is not None else []) + [bytes(u) for u, _ in history]
+        merged = encode_update(_apply_updates(states))
+        YjsUpdate.objects.filter(room=room).delete()
+        YjsArchivedRoom.objects.update_or_create(room=room, defaults={"state": merged, "archived_at": time.time()})
+    return sum(len(s) for s in states), len(merged)
+
+
+def collect_garbage(
+    use_orm: bool,
+    db_path: str,
+    idle_ttl: float | None,
+    dry_run: bool = False,
+    vacuum: bool = True,
+) -> dict:
+    """
+    Delete the rooms of missing pages, archive rooms whose last update is
+    more than `idle_ttl` seconds old (None: don't archive), then VACUUM the
+    sqlite file. Returns room counts and bytes: `bytes_freed` counts the
+    stored updates/snapshots removed or squashed away, `file_bytes_*` the
+    size of the sqlite file (None on the orm backend, where the database
+    reclaims space with its own vacuum).
+    """
+    idle_before = time.time() - idle_ttl if idle_ttl is not None else float("-inf")
+    report = {
+        "rooms": 0,
+        "orphaned": 0,
+        "orphaned_bytes": 0,
+        "archived": 0,
+        "archive_bytes_before": 0,
+        "archive_bytes_after": 0,
+        "bytes_freed": 0,
+        "file_bytes_before": None,
+        "file_bytes_after": None,
+    }
+
+    conn = None if use_orm else _connect(db_path)
+    try:
+        if conn is None:
+            rooms, idle = _orm_rooms(idle_before)
+        else:
+            conn.commit()
+            report["file_bytes_before"] = _sqlite_size(db_path)
+            rooms, idle = _sqlite_rooms(conn, idle_before)
+        orphans = orphaned_rooms(rooms)
+        report["rooms"] = len(rooms)
+        report["orphaned"] = len(orphans)
+        if orphans:
+            if conn is None:
+                report["orphaned_bytes"] = _orm_delete(orphans, dry_run)
+            else:
+                report["orphaned_bytes"] = _sqlite_delete(conn, orphans, dry_run)
+
+        skip = set(orphans)
+        idle = [room for room in idle if room not in skip]
+        if dry_run:
+            report["archived"] = len(idle)
+        else:
+            for room in idle:
+                moved = _orm_archive(room, idle_before) if conn is None else _sqlite_archive(conn, room, idle_before)
+                if moved is None:
+                    continue
+                report["archived"] += 1
+                report["archive_bytes_before"] += moved[0]
+                report["archive_bytes_after"] += moved[1]
+        report["bytes_freed"] = (
+            report["orphaned_bytes"] + report["archive_bytes_before"] - report["archive_bytes_after"]
+        )
+
+        if conn is not None:
+            if vacuum and not dry_run:
+                conn.execute("VACUUM")
+            report["file_bytes_after"] = _sqlite_size(db_path)
+    finally:
+        if conn is not None:
+            conn.close()
+    return report
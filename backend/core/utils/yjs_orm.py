@@ -0,0 +1,298 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+import y_py as Y
+from django.db import connections, transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Length
+
+from ..models import YjsArchivedRoom, YjsRoomReset, YjsSnapshot, YjsUpdate
+from .yjs_codec import decode_update, encode_update
+from .yjs_compact import _apply_updates
+
+# Same operations as yjs_compact / yjs_snapshots, on the main database
+# (YJS_STORE_BACKEND = "orm"). Rows replay in id order, which is also the
+# order they were written in.
+
+
+def _updates(room_name: str):
+    return YjsUpdate.objects.filter(room=room_name).order_by("id")
+
+
+def _unarchive(room_name: str):
+    """Move an archived room back into YjsUpdate (see yjs_compact._unarchive)."""
+    if not YjsArchivedRoom.objects.filter(room=room_name).exists():
+        return
+    with transaction.atomic():
+        archived = YjsArchivedRoom.objects.select_for_update().filter(room=room_name).first()
+        if archived is None:
+            return
+        history = [bytes(u) for u in _updates(room_name).select_for_update().values_list("update", flat=True)]
+        merged = encode_update(_apply_updates([bytes(archived.state), *history]))
+        YjsUpdate.objects.filter(room=room_name).delete()
+        archived.delete()
+        YjsUpdate.objects.create(room=room_name, update=merged, timestamp=time.time())
+
+
+def append_updates(rows: list[tuple[str, bytes]], document_ttl: int | None = None) -> int:
+    """
+    Append one update per (room, update) row with a single bulk insert.
+
+    Like SQLiteYStore.write, a room whose last update is older than
+    `document_ttl` seconds has its history squashed before the append.
+    """
+    if not rows:
+        return 0
+    now = time.time()
+    with transaction.atomic():
+        if document_ttl is not None:
+            rooms = {room for room, _ in rows}
+            last_seen = (
+                YjsUpdate.objects.filter(room__in=rooms)
+                .values("room")
+                .annotate(last=Max("timestamp"))
+                .filter(last__lt=now - document_ttl)
+            )
+            for entry in last_seen:
+                room, last = entry["room"], entry["last"]
+                history = _updates(room).select_for_update()
+                squashed = encode_update(_apply_updates(bytes(u) for u in history.values_list("update", flat=True)))
+                YjsUpdate.objects.filter(room=room).delete()
+                YjsUpdate.objects.create(room=room, update=squashed, timestamp=last)
+        YjsUpdate.objects.bulk_create(
+            [YjsUpdate(room=room, update=encode_update(update), timestamp=now) for room, update in rows]
+        )
+    return len(rows)
+
+
+def load_room(room_name: str) -> tuple[bytes | None, int, int]:
+    """
+    The stored state of one room as a single update (None if it has none),
+    with the number of rows and bytes it was rebuilt from.
+    """
+    _unarchive(room_name)
+    rows = [bytes(u) for u in _updates(room_name).values_list("update", flat=True)]
+    if not rows:
+        return None, 0, 0
+    return _apply_updates(rows), len(rows), sum(len(r) for r in rows)
+
+
+def last_update_at(room_name: str) -> float | None:
+    return YjsUpdate.objects.filter(room=room_name).aggregate(last=Max("timestamp"))["last"]
+
+
+def _compact(room_name: str) -> tuple[int, int, int]:
+    """
+    Squash one room, reading its updates outside any transaction and then
+    deleting only the ids that were merged (see yjs_compact._compact).
+    Returns (rows, bytes before, bytes after); rows < 2 means untouched.
+    """
+    ydoc = Y.YDoc()
+    rows = size = 0
+    max_id = None
+    for row_id, update in _updates(room_name).values_list("id", "update").iterator(chunk_size=500):
+        rows += 1
+        if update:
+            size += len(update)
+            Y.apply_update(ydoc, decode_update(update))
+        max_id = row_id
+    if rows < 2:
+        return rows, size, size
+    squashed = encode_update(Y.encode_state_as_update(ydoc))
+
+    with transaction.atomic():
+        merged = YjsUpdate.objects.select_for_update().filter(room=room_name, id__lte=max_id)
+        if len(list(merged.values_list("id", flat=True))) != rows:
+            # another compaction got there first
+            return 0, size, size
+        merged.delete()
+        # the squashed row takes the place of the rows it replaces, so it
+        # still replays before anything appended meanwhile
+        YjsUpdate.objects.create(id=max_id, room=room_name, update=squashed, timestamp=time.time())
+    return rows, size, len(squashed)
+
+
+def compact_room(room_name: str) -> bool:
+    rows, _, _ = _compact(room_name)
+    return rows > 0
+
+
+def select_rooms(min_updates: int = 2, older_than: float | None = None) -> list[tuple[str, int, int]]:
+    """(room, rows, bytes) for rooms with at least `min_updates` rows whose last
+    update is more than `older_than` seconds old."""
+    rooms = (
+        YjsUpdate.objects.values("room")
+        .annotate(rows=Count("id"), size=Coalesce(Sum(Length("update")), 0), last=Max("timestamp"))
+        .filter(rows__gte=max(min_updates, 1))
+    )
+    if older_than is not None:
+        rooms = rooms.filter(last__lte=time.time() - older_than)
+    return [(r["room"], r["rows"], r["size"]) for r in rooms.order_by("room")]
+
+
+def _compact_chunk(rooms: list[str]) -> list[tuple[int, int, int]]:
+    try:
+        return [_compact(room) for room in rooms]
+    finally:
+        # worker threads get their own connections; don't leave them open
+        connections.close_all()
+
+
+def compact_all_rooms(
+    jobs: int = 1,
+    min_updates: int = 2,
+    older_than: float | None = None,
+    dry_run: bool = False,
+    chunk_size: int = 200,
+) -> dict:
+    """
+    Compact every selected room, `chunk_size` rooms at a time over `jobs`
+    threads (the work is mostly database round trips). Same report as
+    yjs_compact.compact_all_rooms.
+    """
+    selected = select_rooms(min_updates, older_than)
+    report = {
+        "rooms": len(selected),
+        "compacted": 0,
+        "bytes_before": sum(size for _, _, size in selected),
+        "bytes_after": 0,
+    }
+    if dry_run or not selected:
+        report["bytes_after"] = report["bytes_before"]
+        return report
+
+    rooms = [room for room, _, _ in selected]
+    chunks = [rooms[i:i + chunk_size] for i in range(0, len(rooms), chunk_size)]
+    if jobs > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = [r for chunk in pool.map(_compact_chunk, chunks) for r in chunk]
+    else:
+        results = [_compact(room) for room in rooms]
+
+    report["compacted"] = sum(1 for rows, _, _ in results if rows > 1)
+    report["bytes_after"] = sum(after for _, _, after in results)
+    return report
+
+
+def copy_rooms(room_map: dict[str, str], batch_size: int = 500) -> int:
+    """Copy each source room into its target room as a single compacted update."""
+    if not room_map:
+        return 0
+    sources = list(room_map)
+    for room in sources:
+        _unarchive(room)
+    now = time.time()
+    copied = 0
+    with transaction.atomic():
+        for start in range(0, len(sources), batch_size):
+            chunk = sources[start:start + batch_size]
+            read = (
+                YjsUpdate.objects.filter(room__in=chunk)
+                .order_by("room", "id")
+                .values_list("room", "update")
+            )
+            snapshots = [
+                YjsUpdate(
+                    room=room_map[room], update=encode_update(_apply_updates(bytes(u) for _, u in rows)), timestamp=now
+                )
+                for room, rows in groupby(read, key=lambda r: r[0])
+            ]
+            YjsUpdate.objects.bulk_create(snapshots)
+            copied += len(snapshots)
+    return copied
+
+
+# -------------------------
+# snapshots
+# -------------------------
+
+
+def _room_state(room_name: str) -> bytes | None:
+    rows = [bytes(u) for u in _updates(room_name).values_list("update", flat=True)]
+    return _apply_updates(rows) if rows else None
+
+
+def take_snapshot(room_name: str, reason: str = "manual", state: bytes | None = None) -> int | None:
+    """Store the current state of a room (or `state`); None if the room is empty."""
+    if state is None:
+        _unarchive(room_name)
+        state = _room_state(room_name)
+        if state is None:
+            return None
+    return YjsSnapshot.objects.create(
+        room=room_name, state=encode_update(state), created_at=time.time(), reason=reason
+    ).id
+
+
+def snapshot_if_due(states: list[tuple[str, bytes]], interval: float) -> int:
+    """Snapshot each (room, state) whose latest snapshot is older than `interval` seconds."""
+    if not states:
+        return 0
+    now = time.time()
+    latest = dict(
+        YjsSnapshot.objects.filter(room__in=[room for room, _ in states])
+        .values("room")
+        .annotate(last=Max("created_at"))
+        .values_list("room", "last")
+    )
+    due = [
+        YjsSnapshot(room=room, state=encode_update(state), created_at=now, reason="periodic")
+        for room, state in states
+        if room not in latest or now - latest[room] >= interval
+    ]
+    YjsSnapshot.objects.bulk_create(due)
+    return len(due)
+
+
+def list_snapshots(room_name: str) -> list[dict]:
+    rows = (
+        YjsSnapshot.objects.filter(room=room_name)
+        .annotate(size=Length("state"))
+        .order_by("-created_at", "-id")
+        .values("id", "created_at", "size", "reason")
+    )
+    return list(rows)
+
+
+def get_snapshot(room_name: str, snapshot_id: int) -> tuple[bytes, float] | None:
+    row = YjsSnapshot.objects.filter(room=room_name, id=snapshot_id).values_list("state", "created_at").first()
+    return (decode_update(row[0]), row[1]) if row else None
+
+
+def restore_snapshot(room_name: str, snapshot_id: int) -> bool:
+    """
+    Replace the room's update log with one snapshot, keeping the current
+    state as a "pre-restore" snapshot and marking the room as reset.
+    """
+    _unarchive(room_name)
+    with transaction.atomic():
+        state = YjsSnapshot.objects.filter(room=room_name, id=snapshot_id).values_list("state", flat=True).first()
+        if state is None:
+            return False
+        now = time.time()
+        history = _updates(room_name).select_for_update()
+        current = [bytes(u) for u in history.values_list("update", flat=True)]
+        if current:
+            YjsSnapshot.objects.create(
+                room=room_name, state=encode_update(_apply_updates(current)), created_at=now, reason="pre-restore"
+            )
+        YjsUpdate.objects.filter(room=room_name).delete()
+        YjsUpdate.objects.create(room=room_name, update=bytes(state), timestamp=now)
+        YjsRoomReset.objects.update_or_create(room=room_name, defaults={"reset_at": now})
+    return True
+
+
+def last_reset(room_name: str) -> float | None:
+    return YjsRoomReset.objects.filter(room=room_name).values_list("reset_at", flat=True).first()
+
+
+def prune_snapshots(retention: float) -> int:
+    """Delete snapshots older than `retention` seconds, keeping each room's newest one."""
+    newest = YjsSnapshot.objects.filter(room=OuterRef("room")).order_by("-created_at").values("created_at")[:1]
+    deleted, _ = (
+        YjsSnapshot.objects.filter(created_at__lt=time.time() - retention)
+        .exclude(created_at=Subquery(newest))
+        .delete()
+    )
+    return deleted
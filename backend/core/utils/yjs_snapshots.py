@@ -0,0 +1,175 @@
+import sqlite3
+import time
+
+import y_py as Y
+
+from .yjs_codec import decode_update, encode_update
+from .yjs_compact import _unarchive, ensure_store
+
+
+def ensure_snapshots(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS ysnapshots (id INTEGER PRIMARY KEY, path TEXT NOT NULL, "
+        "state BLOB NOT NULL, created_at REAL NOT NULL, reason TEXT NOT NULL DEFAULT '')"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ysnapshots_path_created ON ysnapshots (path, created_at)")
+    # last restore of each room, so processes can tell their cached copy is stale
+    conn.execute("CREATE TABLE IF NOT EXISTS yresets (path TEXT PRIMARY KEY, reset_at REAL NOT NULL)")
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    ensure_store(conn)
+    ensure_snapshots(conn)
+    return conn
+
+
+def _room_state(conn: sqlite3.Connection, room_name: str) -> bytes | None:
+    ydoc = Y.YDoc()
+    found = False
+    for (update,) in conn.execute(
+        "SELECT yupdate FROM yupdates WHERE path = ? ORDER BY timestamp", (room_name,)
+    ):
+        found = True
+        if update:
+            Y.apply_update(ydoc, decode_update(update))
+    return Y.encode_state_as_update(ydoc) if found else None
+
+
+def _insert(conn, room_name: str, state: bytes, reason: str, now: float) -> int:
+    cur = conn.execute(
+        "INSERT INTO ysnapshots (path, state, created_at, reason) VALUES (?, ?, ?, ?)",
+        (room_name, sqlite3.Binary(encode_update(state)), now, reason),
+    )
+    return cur.lastrowid
+
+
+def take_snapshot(db_path: str, room_name: str, reason: str = "manual", state: bytes | None = None) -> int | None:
+    """Store the current state of a room (or `state`); None if the room is empty."""
+    conn = _connect(db_path)
+    try:
+        if state is None:
+            _unarchive(conn, room_name)
+            state = _room_state(conn, room_name)
+            if state is None:
+                return None
+        snapshot_id = _insert(conn, room_name, state, reason, time.time())
+        conn.commit()
+        return snapshot_id
+    finally:
+        conn.close()
+
+
+def snapshot_if_due(db_path: str, states: list[tuple[str, bytes]], interval: float) -> int:
+    """Snapshot each (room, state) whose latest snapshot is older than `interval` seconds."""
+    if not states:
+        return 0
+    conn = _connect(db_path)
+    try:
+        now = time.time()
+        taken = 0
+        for room_name, state in states:
+            last = conn.execute(
+                "SELECT max(created_at) FROM ysnapshots WHERE path = ?", (room_name,)
+            ).fetchone()[0]
+            if last is None or now - last >= interval:
+                _insert(conn, room_name, state, "periodic", now)
+                taken += 1
+        conn.commit()
+        return taken
+    finally:
+        conn.close()
+
+
+def list_snapshots(db_path: str, room_name: str) -> list[dict]:
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT id, created_at, length(state), reason FROM ysnapshots "
+            "WHERE path = ? ORDER BY created_at DESC, id DESC",
+            (room_name,),
+        )
+        return [
+            {"id": sid, "created_at": created_at, "size": size, "reason": reason}
+            for sid, created_at, size, reason in rows
+        ]
+    finally:
+        conn.close()
+
+
+def get_snapshot(db_path: str, room_name: str, snapshot_id: int) -> tuple[bytes, float] | None:
+    conn = _connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT state, created_at FROM ysnapshots WHERE path = ? AND id = ?",
+            (room_name, snapshot_id),
+        ).fetchone()
+        return (decode_update(row[0]), row[1]) if row else None
+    finally:
+        conn.close()
+
+
+def restore_snapshot(db_path: str, room_name: str, snapshot_id: int) -> bool:
+    """
+    Replace the room's update log with one snapshot.
+
+    The current state is kept first as a "pre-restore" snapshot, so a
+    restore can itself be undone. The room is marked as reset so processes
+    holding it in memory reload it.
+    """
+    conn = _connect(db_path)
+    try:
+        _unarchive(conn, room_name)
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT state FROM ysnapshots WHERE path = ? AND id = ?", (room_name, snapshot_id)
+        ).fetchone()
+        if row is None:
+            conn.rollback()
+            return False
+        now = time.time()
+        current = _room_state(conn, room_name)
+        if current is not None:
+            _insert(conn, room_name, current, "pre-restore", now)
+        conn.execute("DELETE FROM yupdates WHERE path = ?", (room_name,))
+        conn.execute(
+            "INSERT INTO yupdates VALUES (?, ?, ?, ?)", (room_name, row[0], b"", now)
+        )
+        conn.execute(
+            "INSERT INTO yresets (path, reset_at) VALUES (?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET reset_at = excluded.reset_at",
+            (room_name, now),
+        )
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+
+def last_reset(db_path: str, room_name: str) -> float | None:
+    conn = sqlite3.connect(db_path)
+    try:
+        try:
+            row = conn.execute("SELECT reset_at FROM yresets WHERE path = ?", (room_name,)).fetchone()
+        except sqlite3.OperationalError:
+            # store without snapshots yet
+            return None
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def prune_snapshots(db_path: str, retention: float) -> int:
+    """Delete snapshots older than `retention` seconds, keeping each room's newest one."""
+    conn = _connect(db_path)
+    try:
+        cur = conn.execute(
+            "DELETE FROM ysnapshots WHERE created_at < ? AND id NOT IN "
+            "(SELECT s.id FROM ysnapshots s WHERE s.created_at = "
+            "(SELECT max(created_at) FROM ysnapshots WHERE path = s.path))",
+            (time.time() - retention,),
+        )
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
@@ -0,0 +1,90 @@
+from django.conf import settings
+
+from . import yjs_compact, yjs_orm, yjs_snapshots
+
+# Entry points for the Yjs update log, on the backend picked by
+# YJS_STORE_BACKEND: "sqlite" (the local YJS_STORE_PATH file) or "orm" (the
+# main database, shared by every app instance).
+
+BACKENDS = ("sqlite", "orm")
+
+
+def backend() -> str:
+    name = getattr(settings, "YJS_STORE_BACKEND", "sqlite")
+    if name not in BACKENDS:
+        raise ValueError(f"unknown YJS_STORE_BACKEND {name!r}, expected one of {BACKENDS}")
+    return name
+
+
+def use_orm() -> bool:
+    return backend() == "orm"
+
+
+def store_path() -> str:
+    return str(settings.YJS_STORE_PATH)
+
+
+def append_updates(rows: list[tuple[str, bytes]], document_ttl: int | None = None) -> int:
+    if use_orm():
+        return yjs_orm.append_updates(rows, document_ttl)
+    return yjs_compact.append_updates(store_path(), rows, document_ttl)
+
+
+def load_room(room_name: str) -> tuple[bytes | None, int, int]:
+    if use_orm():
+        return yjs_orm.load_room(room_name)
+    return yjs_compact.load_room(room_name, store_path())
+
+
+def last_update_at(room_name: str) -> float | None:
+    if use_orm():
+        return yjs_orm.last_update_at(room_name)
+    return yjs_compact.last_update_at(room_name, store_path())
+
+
+def compact_room(room_name: str) -> bool:
+    if use_orm():
+        return yjs_orm.compact_room(room_name)
+    return yjs_compact.compact_room(room_name, store_path())
+
+
+def copy_rooms(room_map: dict[str, str]) -> int:
+    if use_orm():
+        return yjs_orm.copy_rooms(room_map)
+    return yjs_compact.copy_rooms(room_map, store_path())
+
+
+def take_snapshot(room_name: str, reason: str = "manual", state: bytes | None = None) -> int | None:
+    if use_orm():
+        return yjs_orm.take_snapshot(room_name, reason, state)
+    return yjs_snapshots.take_snapshot(store_path(), room_name, reason, state)
+
+
+def snapshot_if_due(states: list[tuple[str, bytes]], interval: float) -> int:
+    if use_orm():
+        return yjs_orm.snapshot_if_due(states, interval)
+    return yjs_snapshots.snapshot_if_due(store_path(), states, interval)
+
+
+def list_snapshots(room_name: str) -> list[dict]:
+    if use_orm():
+        return yjs_orm.list_snapshots(room_name)
+    return yjs_snapshots.list_snapshots(store_path(), room_name)
+
+
+def get_snapshot(room_name: str, snapshot_id: int) -> tuple[bytes, float] | None:
+    if use_orm():
+        return yjs_orm.get_snapshot(room_name, snapshot_id)
+    return yjs_snapshots.get_snapshot(store_path(), room_name, snapshot_id)
+
+
+def restore_snapshot(room_name: str, snapshot_id: int) -> bool:
+    if use_orm():
+        return yjs_orm.restore_snapshot(room_name, snapshot_id)
+    return yjs_snapshots.restore_snapshot(store_path(), room_name, snapshot_id)
+
+
+def last_reset(room_name: str) -> float | None:
+    if use_orm():
+        return yjs_orm.last_reset(room_name)
+    return yjs_snapshots.last_reset(store_path(), room_name)
@@ -1,20 +1,22 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.exceptions import PermissionDenied
-from django.db.models import Q
+from rest_framework.exceptions import PermissionDenied, APIException
+from django.db.models import Q, Exists, OuterRef, Subquery, Case, When, Value, CharField, Count, Max
 from rest_framework.exceptions import ValidationError
 from .serializers import DuplicatePageDeepSerializer
-from django.db import transaction, IntegrityError
-from fractional_indexing import generate_key_between
+from django.db import connection, transaction, IntegrityError
 from collections import defaultdict
 from django.utils import timezone
-from datetime import timedelta
-from django.http import Http404
+from django.utils.http import parse_etags, quote_etag
+import hashlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+import base64
+import logging
+from django.http import Http404, StreamingHttpResponse
 from django.contrib.auth import get_user_model
 import json
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 
 
 import uuid
@@ -24,6 +26,7 @@ from .models import (
     TiptapDocument,
     PageCollaborator,
     PageFavorite,
+    PageChange,
     PageInvite,
     PageAuditLog,
     CollaborationRole,
@@ -44,20 +47,74 @@ from .serializers import (
     UserSummarySerializer,
     CommentThreadSerializer,
     CommentSerializer,
+    BulkMovePagesSerializer,
+    FavoriteReorderSerializer,
 )
 from django.conf import settings
-from .utils.yjs_compact import compact_room
+from django.core.cache import cache
+from .pagination import PageKeysetPagination, serves_async, stream_json_list
+from .utils.yjs_store import (
+    compact_room,
+    copy_rooms,
+    get_snapshot,
+    list_snapshots,
+    restore_snapshot,
+    take_snapshot,
+)
+from .consumers import realtime_stats, room_group_name
+from .fanout import broadcast
+from .utils.ws_tickets import issue_ticket, ticket_ttl
+from .utils.changes import change_horizon, record_page_changes, latest_change_id
+from .utils.tree import page_path, path_ancestor_hexes
+from .utils.bulk_copy import copy_rows
+from .utils.positions import (
+    keys_between,
+    key_after,
+    maybe_rebalance_pages,
+    maybe_rebalance_favorites,
+    maybe_rebalance_legacy_favorites,
+)
 
 User = get_user_model()
 
 
+def _page_role_cache_key(page_id, user_id) -> str:
+    return f"page-role:{page_id}:{user_id}"
+
+
 def get_page_role(page: Page, user) -> str | None:
     if not user or not user.is_authenticated:
         return None
     if page.owner_id == user.id:
         return CollaborationRole.OWNER
-    collab = PageCollaborator.objects.filter(page=page, user=user).only("role").first()
-    return collab.role if collab else None
+
+    # per-request memo: lives on the page instance the view passes around
+    memo = page.__dict__.setdefault("_role_memo", {})
+    if user.id in memo:
+        return memo[user.id]
+
+    timeout = getattr(settings, "PAGE_ROLE_CACHE_TIMEOUT", 0)
+    key = _page_role_cache_key(page.pk, user.id)
+    role = cache.get(key) if timeout else None
+    if role is None:
+        collab = PageCollaborator.objects.filter(page=page, user=user).only("role").first()
+        role = collab.role if collab else ""  # "" caches "no access" too
+        if timeout:
+            cache.set(key, role, timeout)
+
+    memo[user.id] = role or None
+    return memo[user.id]
+
+
+def invalidate_page_roles(page_ids, user_ids=None):
+    """Drop shared-cache roles; without user_ids, for every collaborator of the pages."""
+    if not getattr(settings, "PAGE_ROLE_CACHE_TIMEOUT", 0):
+        return
+    if user_ids is None:
+        pairs = PageCollaborator.objects.filter(page_id__in=page_ids).values_list("page_id", "user_id")
+    else:
+        pairs = [(pid, uid) for pid in page_ids for uid in user_ids]
+    cache.delete_many([_page_role_cache_key(pid, uid) for pid, uid in pairs])
 
 
 def require_page_role(page: Page, user, allowed_roles: set[str]) -> str:
@@ -67,6 +124,103 @@ def require_page_role(page: Page, user, allowed_roles: set[str]) -> str:
     return role
 
 
+def annotate_page_user_fields(qs, user):
+    """Precompute the per-user fields read by PageSerializer in the same query."""
+    collab_role = PageCollaborator.objects.filter(page=OuterRef("pk"), user=user).values("role")[:1]
+    user_fav = PageFavorite.objects.filter(page=OuterRef("pk"), user=user)
+    return qs.select_related("tiptap_doc").annotate(
+        user_role=Case(
+            When(owner=user, then=Value(CollaborationRole.OWNER)),
+            default=Subquery(collab_role),
+            output_field=CharField(),
+        ),
+        user_is_shared=Exists(PageCollaborator.objects.filter(page=OuterRef("pk"))),
+        user_favorite=Exists(user_fav),
+        user_favorite_position=Subquery(user_fav.values("position")[:1]),
+    )
+
+
+def _move_creates_cycle(page_id, new_parents, paths) -> bool:
+    """
+    Whether moving `page_id` under new_parents[page_id] puts it inside itself,
+    given every other move in `new_parents` and the current `paths` of the
+    pages involved.
+    """
+    seen = set()
+    cur = new_parents[page_id]
+    while cur is not None:
+        if cur == page_id or cur in seen:
+            return True
+        seen.add(cur)
+        if cur in new_parents:
+            cur = new_parents[cur]
+            continue
+        # unmoved page: climb its current ancestors up to the nearest moved one
+        nearest_moved = None
+        for hex_id in reversed(path_ancestor_hexes(paths[cur])):
+            ancestor = uuid.UUID(hex_id)
+            if ancestor in new_parents:
+                nearest_moved = ancestor
+                break
+        cur = nearest_moved
+    return False
+
+logger = logging.getLogger("core.yjs")
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = "resource has changed"
+    default_code = "precondition_failed"
+
+
+def make_etag(*parts) -> str:
+    raw = "|".join("" if p is None else str(p) for p in parts)
+    return quote_etag(hashlib.sha1(raw.encode("utf-8")).hexdigest())
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = parse_etags(header or "")
+    return "*" in tags or etag in tags
+
+
+def not_modified(request, etag: str):
+    """304 response when If-None-Match already holds `etag`, else None."""
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response["ETag"] = etag
+        return response
+    return None
+
+
+def require_if_match(request, etag: str):
+    header = request.headers.get("If-Match")
+    if header and not _etag_matches(header, etag):
+        raise PreconditionFailed()
+
+
+def document_etag(doc: TiptapDocument) -> str:
+    return make_etag("doc", doc.id, doc.version, doc.updated_at.isoformat())
+
+
+def page_etag(page: Page) -> str:
+    """Covers everything PageDetailSerializer renders, from the annotated page row."""
+    try:
+        doc = page.tiptap_doc
+    except TiptapDocument.DoesNotExist:
+        doc = None
+    return make_etag(
+        "page",
+        page.id,
+        page.updated_at.isoformat(),
+        getattr(page, "user_role", None),
+        getattr(page, "user_is_shared", None),
+        getattr(page, "user_favorite", None),
+        getattr(page, "user_favorite_position", None),
+        document_etag(doc) if doc else None,
+    )
+
+
 def log_audit(page: Page, actor, action: str, target_user=None, role_before=None, role_after=None, meta=None):
     PageAuditLog.objects.create(
         page=page,
@@ -82,11 +236,21 @@ class PageViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
+        # update() and perform_update() both ask for the object: fetch it once per request
+        cached = getattr(self, "_page_object", None)
+        if cached is not None:
+            return cached
+
         lookup_value = self.kwargs.get(self.lookup_field or "pk")
-        page = Page.objects.filter(pk=lookup_value).first()
+        page = annotate_page_user_fields(
+            Page.objects.filter(pk=lookup_value), self.request.user
+        ).first()
         if not page:
             raise Http404
 
+        # the annotation already resolved the role: seed the memo so later
+        # get_page_role/require_page_role calls in this request are free
+        page._role_memo = {self.request.user.id: page.user_role}
         role = get_page_role(page, self.request.user)
         if role is None:
             raise PermissionDenied("access denied")
@@ -103,18 +267,22 @@ class PageViewSet(viewsets.ModelViewSet):
         ):
             raise PermissionDenied("access denied")
 
+        self._page_object = page
         return page
 
     def get_queryset(self):
         if not getattr(self.request, "user", None) or not self.request.user.is_authenticated:
             return Page.objects.none()
 
+        qs = annotate_page_user_fields(self._visible_pages(), self.request.user)
+        return qs.order_by('-created_at', '-id')
+
+    def _visible_pages(self):
         if self.action == "trash_list":
             qs = Page.objects.filter(owner=self.request.user)
         else:
-            qs = Page.objects.filter(
-                Q(owner=self.request.user) | Q(collaborators__user=self.request.user)
-            ).distinct()
+            shared_ids = PageCollaborator.objects.filter(user=self.request.user).values("page_id")
+            qs = Page.objects.filter(Q(owner=self.request.user) | Q(id__in=shared_ids))
 
         include_trashed = self.request.query_params.get("include_trashed") in {
             "1",
@@ -124,29 +292,74 @@ class PageViewSet(viewsets.ModelViewSet):
 
         if not include_trashed and self.action not in {"restore", "purge", "trash_list"}:
             qs = qs.filter(deleted_at__isnull=True)
+        return qs
 
-        return qs.order_by('-created_at')
-
-    def _collect_descendant_ids(self, root_id):
-        rows = list(
-            Page.objects.filter(owner=self.request.user)
-            .values_list("id", "parent_id")
+    def _list_etag(self, request) -> str:
+        # Page rows only say when a page itself changed; the change log also
+        # covers favorites, sharing and role changes that show up in the list.
+        agg = self._visible_pages().aggregate(
+            last=Max("updated_at"), pages=Count("id"), docs=Max("tiptap_doc__updated_at")
+        )
+        return make_etag(
+            "pages",
+            request.user.id,
+            request.get_full_path(),
+            agg["last"].isoformat() if agg["last"] else None,
+            agg["pages"],
+            agg["docs"].isoformat() if agg["docs"] else None,
+            latest_change_id(request.user),
         )
 
-        children = {}
-        for pid, parent_id in rows:
-            children.setdefault(parent_id, []).append(pid)
+    def retrieve(self, request, *args, **kwargs):
+        page = self.get_object()
+        etag = page_etag(page)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        response = Response(self.get_serializer(page).data)
+        response["ETag"] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        etag = self._list_etag(request)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        response = self._list_response(request)
+        response["ETag"] = etag
+        return response
+
+    def _list_response(self, request):
+        qs = self.filter_queryset(self.get_queryset())
+        stream = request.query_params.get("stream") in {"1", "true", "yes"}
+        asynchronous = serves_async(request)
+        paginator = PageKeysetPagination()
+
+        def serialize(rows):
+            return self.get_serializer(rows, many=True).data
+
+        if paginator.is_requested(request):
+            if stream:
+                return StreamingHttpResponse(
+                    paginator.stream_paginated(qs, request, serialize, asynchronous=asynchronous),
+                    content_type="application/json",
+                )
+            rows = paginator.paginate_queryset(qs, request, view=self)
+            return paginator.get_paginated_response(serialize(rows))
+
+        if stream:
+            return StreamingHttpResponse(
+                stream_json_list(qs, serialize, asynchronous=asynchronous),
+                content_type="application/json",
+            )
+        return Response(serialize(qs))
 
-        out = set()
-        stack = [root_id]
-        while stack:
-            cur = stack.pop()
-            if cur in out:
-                continue
-            out.add(cur)
-            for ch in children.get(cur, []):
-                stack.append(ch)
-        return out
+    def _collect_descendant_ids(self, root):
+        return set(
+            root.subtree()
+            .filter(owner=self.request.user)
+            .values_list("id", flat=True)
+        )
 
     def _soft_delete_pages(self, page_ids, user):
         pages = list(
@@ -186,6 +399,7 @@ class PageViewSet(viewsets.ModelViewSet):
             ],
             batch_size=500,
         )
+        Page.sync_paths(pages)
         return len(pages)
 
     def _restore_pages(self, page_ids, user):
@@ -199,6 +413,14 @@ class PageViewSet(viewsets.ModelViewSet):
         ids_set = {p.id for p in pages}
         trashed_parent_ids = {p.trashed_parent_id for p in pages if p.trashed_parent_id}
 
+        # one call for every favorite that needs a fresh key, not one per page
+        missing_fav = sum(
+            1 for p in pages if p.deleted_at and p.trashed_favorite and not p.trashed_favorite_position
+        )
+        fav_keys = iter(
+            keys_between(self._last_favorite_position(user), None, missing_fav) if missing_fav else []
+        )
+
         valid_external_parents = set(
             Page.objects.filter(
                 owner=user,
@@ -226,7 +448,7 @@ class PageViewSet(viewsets.ModelViewSet):
                 if p.trashed_favorite_position:
                     p.favorite_position = p.trashed_favorite_position
                 else:
-                    p.favorite_position = self._append_favorite_position(owner=user)
+                    p.favorite_position = next(fav_keys)
             else:
                 p.favorite_position = None
 
@@ -253,10 +475,14 @@ class PageViewSet(viewsets.ModelViewSet):
             ],
             batch_size=500,
         )
+        Page.sync_paths(pages)
+        maybe_rebalance_legacy_favorites(pages)
         return len(pages)
 
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        page = serializer.save(owner=self.request.user)
+        record_page_changes([page.id], users=[self.request.user])
+        maybe_rebalance_pages([page])
 
     def update(self, request, *args, **kwargs):
         page = self.get_object()
@@ -276,21 +502,181 @@ class PageViewSet(viewsets.ModelViewSet):
         include_children = ser.validated_data.get("include_children", True)
 
         ids = (
-            self._collect_descendant_ids(page.id)
+            self._collect_descendant_ids(page)
             if include_children
             else {page.id}
         )
 
         with transaction.atomic():
             self._soft_delete_pages(ids, request.user)
+            record_page_changes(ids)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=["get"], url_path="trash")
     def trash_list(self, request):
         qs = Page.objects.filter(owner=request.user, deleted_at__isnull=False)
-        qs = qs.order_by("-deleted_at")
-        return Response(PageSerializer(qs, many=True).data, status=status.HTTP_200_OK)
+        qs = annotate_page_user_fields(qs, request.user).order_by("-deleted_at")
+        return Response(self.get_serializer(qs, many=True).data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["get"], url_path="changes")
+    def changes(self, request):
+        """
+        Incremental sync of the page list.
+
+        Without `since` returns every visible page plus the current cursor;
+        with `since` returns only pages changed after it and tombstones for
+        pages that were trashed, purged or are no longer shared. A `since`
+        older than the pruned part of the log gets the full list again, with
+        `full` set so the client replaces its copy instead of merging.
+        """
+        raw_since = request.query_params.get("since")
+        try:
+            since = int(raw_since) if raw_since else None
+        except ValueError:
+            raise ValidationError({"since": "invalid cursor"})
+
+        # Read the cursor first: anything written after it is replayed next time.
+        cursor = latest_change_id(request.user)
+        qs = self.get_queryset()
+
+        if since is None or since < change_horizon(request.user):
+            return Response(
+                {
+                    "cursor": str(cursor),
+                    "full": True,
+                    "pages": self.get_serializer(qs, many=True).data,
+                    "deleted": [],
+                },
+                status=status.HTTP_200_OK,
+            )
+
+        changed_ids = set(
+            PageChange.objects.filter(user=request.user, id__gt=since, id__lte=cursor)
+            .values_list("page_id", flat=True)
+        )
+        pages = list(qs.filter(id__in=changed_ids)) if changed_ids else []
+        gone_ids = changed_ids - {p.id for p in pages}
+        trashed_ids = set(
+            Page.objects.filter(id__in=gone_ids, deleted_at__isnull=False).values_list("id", flat=True)
+        ) if gone_ids else set()
+        deleted = [
+            {"id": str(pid), "reason": "trashed" if pid in trashed_ids else "removed"}
+            for pid in gone_ids
+        ]
+        return Response(
+            {
+                "cursor": str(cursor),
+                "full": False,
+                "pages": self.get_serializer(pages, many=True).data,
+                "deleted": deleted,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=False, methods=["post"], url_path="bulk-move")
+    def bulk_move(self, request):
+        ser = BulkMovePagesSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        items = ser.validated_data["items"]
+        moves = {it["id"]: it for it in items}
+        if len(moves) != len(items):
+            raise ValidationError({"items": "duplicate page id"})
+
+        editor_roles = {CollaborationRole.OWNER, CollaborationRole.EDITOR}
+        with transaction.atomic():
+            pages = list(
+                annotate_page_user_fields(
+                    Page.objects.select_for_update().filter(id__in=moves, deleted_at__isnull=True),
+                    request.user,
+                )
+            )
+            if len(pages) != len(moves):
+                raise ValidationError({"items": "page not found"})
+            if any(p.user_role not in editor_roles for p in pages):
+                raise PermissionDenied("access denied")
+
+            target_ids = {it["parent"] for it in items if it["parent"]} - set(moves)
+            targets = list(
+                annotate_page_user_fields(
+                    Page.objects.filter(id__in=target_ids, deleted_at__isnull=True),
+                    request.user,
+                )
+            )
+            if len(targets) != len(target_ids):
+                raise ValidationError({"parent": "parent not found"})
+            if any(t.user_role is None for t in targets):
+                raise PermissionDenied("access denied")
+
+            new_parents = {pid: it["parent"] for pid, it in moves.items()}
+            paths = {p.id: p.path for p in [*pages, *targets]}
+            cyclic = [str(pid) for pid in moves if _move_creates_cycle(pid, new_parents, paths)]
+            if cyclic:
+                raise ValidationError({"items": f"a page cannot be moved under itself: {', '.join(cyclic)}"})
+
+            now = timezone.now()
+            for p in pages:
+                p.parent_id = moves[p.id]["parent"]
+                p.position = moves[p.id]["position"]
+                p.updated_at = now
+            Page.objects.bulk_update(pages, ["parent", "position", "updated_at"], batch_size=500)
+            Page.sync_paths(pages)
+            record_page_changes(moves)
+            maybe_rebalance_pages(pages)
+
+        return Response(
+            {"ok": True, "pages": self.get_serializer(pages, many=True).data},
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=False, methods=["post"], url_path="favorites/reorder")
+    def favorites_reorder(self, request):
+        ser = FavoriteReorderSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        items = ser.validated_data["items"]
+        positions = {it["id"]: it["favorite_position"] for it in items}
+        if len(positions) != len(items):
+            raise ValidationError({"items": "duplicate page id"})
+
+        with transaction.atomic():
+            favs = list(
+                PageFavorite.objects.select_for_update()
+                .filter(user=request.user, page_id__in=positions)
+            )
+            if len(favs) != len(positions):
+                raise ValidationError({"items": "favorite not found"})
+
+            now = timezone.now()
+            for fav in favs:
+                fav.position = positions[fav.page_id]
+                fav.updated_at = now
+            PageFavorite.objects.bulk_update(favs, ["position", "updated_at"], batch_size=500)
+            record_page_changes(positions, users=[request.user])
+            maybe_rebalance_favorites(request.user.id, positions.values())
+
+        return Response(
+            {
+                "ok": True,
+                "favorites": [
+                    {"id": str(fav.page_id), "favorite_position": fav.position} for fav in favs
+                ],
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=True, methods=["get"], url_path="breadcrumbs")
+    def breadcrumbs(self, request, pk=None):
+        page = self.get_object()
+        ancestor_ids = page.ancestor_ids()
+        visible = {p.id: p for p in self.get_queryset().filter(id__in=ancestor_ids)}
+        ancestors = [visible[pid] for pid in ancestor_ids if pid in visible]
+        return Response(
+            {
+                "ancestors": self.get_serializer(ancestors, many=True).data,
+                "descendant_count": page.subtree().exclude(pk=page.pk).count(),
+            },
+            status=status.HTTP_200_OK,
+        )
 
     @action(detail=True, methods=["post"], url_path="trash")
     def trash(self, request, pk=None):
@@ -301,13 +687,14 @@ class PageViewSet(viewsets.ModelViewSet):
         include_children = ser.validated_data.get("include_children", True)
 
         ids = (
-            self._collect_descendant_ids(page.id)
+            self._collect_descendant_ids(page)
             if include_children
             else {page.id}
         )
 
         with transaction.atomic():
             count = self._soft_delete_pages(ids, request.user)
+            record_page_changes(ids)
 
         return Response({"ok": True, "trashed_count": count}, status=status.HTTP_200_OK)
 
@@ -320,13 +707,14 @@ class PageViewSet(viewsets.ModelViewSet):
         include_children = ser.validated_data.get("include_children", True)
 
         ids = (
-            self._collect_descendant_ids(page.id)
+            self._collect_descendant_ids(page)
             if include_children
             else {page.id}
         )
 
         with transaction.atomic():
             count = self._restore_pages(ids, request.user)
+            record_page_changes(ids)
 
         return Response({"ok": True, "restored_count": count}, status=status.HTTP_200_OK)
 
@@ -339,12 +727,15 @@ class PageViewSet(viewsets.ModelViewSet):
         include_children = ser.validated_data.get("include_children", True)
 
         ids = (
-            self._collect_descendant_ids(page.id)
+            self._collect_descendant_ids(page)
             if include_children
             else {page.id}
         )
 
-        Page.objects.filter(owner=request.user, id__in=ids).delete()
+        with transaction.atomic():
+            record_page_changes(ids)
+            invalidate_page_roles(ids)
+            Page.objects.filter(owner=request.user, id__in=ids).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=["post"], url_path="duplicate-deep")
@@ -370,7 +761,7 @@ class PageViewSet(viewsets.ModelViewSet):
             )
             idx = next((i for i, (pid, _) in enumerate(sibs) if pid == src.id), -1)
             next_pos = sibs[idx + 1][1] if idx != -1 and idx + 1 < len(sibs) else None
-            new_page_pos = generate_key_between(src.position or None, next_pos)
+            new_page_pos = keys_between(src.position, next_pos, 1)[0]
 
             # -------------------------
             # 2) duplica root page
@@ -392,60 +783,80 @@ class PageViewSet(viewsets.ModelViewSet):
             # 3) se include_children, duplica anche subtree pages
             # -------------------------
             page_id_map = {src.id: new_root.id}  # old_page_id -> new_page_id
-            src_pages = [src]  # lista delle pagine sorgenti incluse (root + disc)
             if include_children:
-                # BFS su pages (tutte dello stesso owner)
-                q = [src.id]
-                while q:
-                    cur = q.pop(0)
-                    kids = list(
-                        Page.objects.select_for_update()
-                        .filter(owner=owner, parent_id=cur)
-                        .order_by("position", "created_at")
-                    )
-                    for k in kids:
-                        src_pages.append(k)
-                        q.append(k.id)
-
-                # crea tutte le pagine discendenti (escludi src già fatto)
-                to_create = []
-                for p in src_pages[1:]:
+                # tutto il subtree in una query: ordinando per path i parent precedono i figli
+                rows = (
+                    src.subtree()
+                    .select_for_update()
+                    .filter(owner=owner)
+                    .exclude(pk=src.pk)
+                    .order_by("path")
+                    .values_list("id", "parent_id")
+                )
+                new_paths = {new_root.id: new_root.path}
+                mapping = []  # (old_id, new_id, new_parent_id, new_path)
+                for old_id, old_parent_id in rows:
+                    new_parent_id = page_id_map.get(old_parent_id)
+                    if new_parent_id is None:
+                        continue  # sotto una pagina di un altro owner: fuori dalla copia
                     new_id = uuid.uuid4()
-                    page_id_map[p.id] = new_id
-                    to_create.append(Page(
-                        id=new_id,
-                        owner=owner,
-                        title=(p.title or "Untitled"),
-                        icon=p.icon,
-                        favorite=False,
-                        parent_id=page_id_map.get(p.parent_id),   # parent rimappato dentro la copia
-                        position=p.position,                      # copia position: ordine identico nel subtree
-                    ))
-                if to_create:
-                    Page.objects.bulk_create(to_create, batch_size=500)
+                    page_id_map[old_id] = new_id
+                    new_paths[new_id] = page_path(new_paths[new_parent_id], new_id)
+                    mapping.append((old_id, new_id, new_parent_id, new_paths[new_id]))
+
+                # crea tutte le pagine discendenti con INSERT ... SELECT (title, icon,
+                # position copiati dal sorgente: ordine identico nel subtree)
+                now = connection.ops.adapt_datetimefield_value(timezone.now())
+                copy_rows(
+                    Page,
+                    key="id",
+                    mapping=mapping,
+                    mapping_fields=[Page._meta.pk, Page._meta.pk, Page._meta.pk, Page._meta.get_field("path")],
+                    columns={
+                        "id": "m.column2",
+                        "owner_id": "%s",
+                        "title": "COALESCE(NULLIF(s.title, ''), 'Untitled')",
+                        "icon": "s.icon",
+                        "parent_id": "m.column3",
+                        "position": "s.position",
+                        "path": "m.column4",
+                        "favorite": "%s",
+                        "trashed_favorite": "%s",
+                        "created_at": "%s",
+                        "updated_at": "%s",
+                    },
+                    params=[owner.pk, False, False, now, now],
+                )
 
             # -------------------------
             # 4) duplica i tiptap docs per tutte le pagine copiate (root + eventualmente disc)
             # -------------------------
-            src_page_ids = [p.id for p in src_pages]
-            docs = list(
-                TiptapDocument.objects.select_for_update()
-                .filter(page_id__in=src_page_ids)
-                .values("page_id", "content", "version")
+            doc_pk = TiptapDocument._meta.pk
+            now = connection.ops.adapt_datetimefield_value(timezone.now())
+            copy_rows(
+                TiptapDocument,
+                key="page",
+                mapping=[(old, new, uuid.uuid4()) for old, new in page_id_map.items()],
+                mapping_fields=[Page._meta.pk, Page._meta.pk, doc_pk],
+                columns={
+                    "id": "m.column3",
+                    "page_id": "m.column2",
+                    "content": "s.content",
+                    "version": "COALESCE(s.version, 1)",
+                    "created_at": "%s",
+                    "updated_at": "%s",
+                },
+                params=[now, now],
             )
-            new_docs = []
-            for doc in docs:
-                new_page_id = page_id_map.get(doc["page_id"])
-                if not new_page_id:
-                    continue
-                new_docs.append(TiptapDocument(
-                    id=uuid.uuid4(),
-                    page_id=new_page_id,
-                    content=doc["content"] or {},
-                    version=doc["version"] or 1,
-                ))
-            if new_docs:
-                TiptapDocument.objects.bulk_create(new_docs, batch_size=500)
+
+            # -------------------------
+            # 5) copia lo stato Yjs live di ogni room in un unico snapshot per la nuova room
+            # -------------------------
+            room_map = {f"page:{old}": f"page:{new}" for old, new in page_id_map.items()}
+            transaction.on_commit(lambda: copy_rooms(room_map))
+
+            record_page_changes(page_id_map.values(), users=[owner])
+            maybe_rebalance_pages([new_root])
 
             return Response(
                 {
@@ -457,15 +868,16 @@ class PageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_201_CREATED
             )
 
-    
-    def _append_favorite_position(self, user):
+    def _last_favorite_position(self, user):
         qs = PageFavorite.objects.select_for_update().filter(
             user=user,
         ).exclude(position__isnull=True).order_by("position")
 
         last = qs.last()
-        prev_pos = last.position if last else None
-        return generate_key_between(prev_pos, None)
+        return last.position if last else None
+
+    def _append_favorite_position(self, user):
+        return key_after(self._last_favorite_position(user))
 
     def perform_update(self, serializer):
         with transaction.atomic():
@@ -487,6 +899,10 @@ class PageViewSet(viewsets.ModelViewSet):
                     updated.favorite_position = self._append_favorite_position(user=self.request.user)
                     updated.save(update_fields=["favorite_position"])
 
+            record_page_changes([updated.id])
+            maybe_rebalance_pages([updated])
+            maybe_rebalance_legacy_favorites([updated])
+
     @action(detail=True, methods=["post", "delete", "patch"], url_path="favorite")
     def favorite(self, request, pk=None):
         page = self.get_object()
@@ -500,6 +916,7 @@ class PageViewSet(viewsets.ModelViewSet):
 
         if request.method == "DELETE" or favorite is False:
             PageFavorite.objects.filter(page=page, user=user).delete()
+            record_page_changes([page.id], users=[user])
             return Response(
                 {"favorite": False, "favorite_position": None},
                 status=status.HTTP_200_OK,
@@ -514,6 +931,8 @@ class PageViewSet(viewsets.ModelViewSet):
             if position is not None:
                 fav.position = position
                 fav.save(update_fields=["position"])
+        record_page_changes([page.id], users=[user])
+        maybe_rebalance_favorites(user.id, [fav.position])
 
         return Response(
             {"favorite": True, "favorite_position": fav.position},
@@ -531,19 +950,32 @@ class PageViewSet(viewsets.ModelViewSet):
             if role not in {CollaborationRole.OWNER, CollaborationRole.EDITOR}:
                 raise PermissionDenied("access denied")
 
-        doc, _ = TiptapDocument.objects.get_or_create(page=page)
-
         if request.method == "GET":
-            return Response(TiptapDocumentSerializer(doc).data, status=status.HTTP_200_OK)
+            try:
+                doc = page.tiptap_doc  # già caricato da get_object (select_related)
+            except TiptapDocument.DoesNotExist:
+                doc, _ = TiptapDocument.objects.get_or_create(page=page)
+            etag = document_etag(doc)
+            cached = not_modified(request, etag)
+            if cached:
+                return cached
+            response = Response(TiptapDocumentSerializer(doc).data, status=status.HTTP_200_OK)
+            response["ETag"] = etag
+            return response
 
-        serializer = TiptapDocumentSerializer(
-            doc,
-            data=request.data,
-            partial=(request.method == "PATCH"),
-        )
-        serializer.is_valid(raise_exception=True)
-        serializer.save(page=page)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        with transaction.atomic():
+            doc, _ = TiptapDocument.objects.select_for_update().get_or_create(page=page)
+            require_if_match(request, document_etag(doc))
+            serializer = TiptapDocumentSerializer(
+                doc,
+                data=request.data,
+                partial=(request.method == "PATCH"),
+            )
+            serializer.is_valid(raise_exception=True)
+            serializer.save(page=page)
+        response = Response(serializer.data, status=status.HTTP_200_OK)
+        response["ETag"] = document_etag(doc)
+        return response
 
     @action(detail=True, methods=["post"], url_path="doc/compact")
     def doc_compact(self, request, pk=None):
@@ -553,9 +985,78 @@ class PageViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("access denied")
 
         room_name = f"page:{page.id}"
-        ok = compact_room(room_name, str(settings.YJS_STORE_PATH))
+        ok = compact_room(room_name)
         return Response({"compacted": ok}, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=["post"], url_path="ws-ticket")
+    def ws_ticket(self, request, pk=None):
+        """Signed ticket for the page's Yjs and comments sockets (no DB work on connect)."""
+        page = self.get_object()
+        role = require_page_role(page, request.user, set(CollaborationRole.values))
+        ticket = issue_ticket(request.user.id, f"page:{page.id}", role)
+        return Response({"ticket": ticket, "expires_in": ticket_ttl()}, status=status.HTTP_200_OK)
+
+    # ===========================
+    # SNAPSHOTS
+    # ===========================
+
+    @staticmethod
+    def _snapshot_time(ts: float) -> str:
+        return datetime.fromtimestamp(ts, tz=dt_timezone.utc).isoformat()
+
+    @action(detail=True, methods=["get", "post"], url_path="doc/snapshots")
+    def doc_snapshots(self, request, pk=None):
+        page = self.get_object()
+        room_name = f"page:{page.id}"
+
+        if request.method == "GET":
+            require_page_role(page, request.user, set(CollaborationRole.values))
+            snapshots = list_snapshots(room_name)
+            for snap in snapshots:
+                snap["created_at"] = self._snapshot_time(snap["created_at"])
+            return Response(snapshots, status=status.HTTP_200_OK)
+
+        require_page_role(page, request.user, {CollaborationRole.OWNER, CollaborationRole.EDITOR})
+        snapshot_id = take_snapshot(room_name, reason="manual")
+        if snapshot_id is None:
+            raise ValidationError({"detail": "document has no content yet"})
+        return Response({"id": snapshot_id}, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["get"], url_path=r"doc/snapshots/(?P<snapshot_id>\d+)")
+    def doc_snapshot_preview(self, request, pk=None, snapshot_id=None):
+        page = self.get_object()
+        require_page_role(page, request.user, set(CollaborationRole.values))
+        found = get_snapshot(f"page:{page.id}", int(snapshot_id))
+        if found is None:
+            raise Http404
+        state, created_at = found
+        # stato Yjs codificato: il client lo carica in un Y.Doc di sola lettura
+        return Response(
+            {
+                "id": int(snapshot_id),
+                "created_at": self._snapshot_time(created_at),
+                "state": base64.b64encode(state).decode("ascii"),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=True, methods=["post"], url_path=r"doc/snapshots/(?P<snapshot_id>\d+)/restore")
+    def doc_snapshot_restore(self, request, pk=None, snapshot_id=None):
+        page = self.get_object()
+        require_page_role(page, request.user, {CollaborationRole.OWNER, CollaborationRole.EDITOR})
+        room_name = f"page:{page.id}"
+        if not restore_snapshot(room_name, int(snapshot_id)):
+            raise Http404
+
+        channel_layer = get_channel_layer()
+        if channel_layer:
+            try:
+                broadcast(room_group_name(room_name), {"type": "room.reset"})
+            except Exception:
+                # i processi ricaricano comunque la stanza al prossimo join
+                logger.exception("Room reset broadcast failed", extra={"room": room_name})
+        return Response({"restored": int(snapshot_id)}, status=status.HTTP_200_OK)
+
     # ===========================
     # COMMENTS
     # ===========================
@@ -605,7 +1106,7 @@ class PageViewSet(viewsets.ModelViewSet):
                 "thread": CommentThreadSerializer(thread).data,
             }
             payload = json.loads(json.dumps(payload, default=str))
-            async_to_sync(channel_layer.group_send)(
+            broadcast(
                 f"comments_page_{page.id}",
                 {"type": "comments.event", "payload": payload},
             )
@@ -646,7 +1147,7 @@ class PageViewSet(viewsets.ModelViewSet):
                 "comment": CommentSerializer(comment).data,
             }
             payload = json.loads(json.dumps(payload, default=str))
-            async_to_sync(channel_layer.group_send)(
+            broadcast(
                 f"comments_page_{page.id}",
                 {"type": "comments.event", "payload": payload},
             )
@@ -678,7 +1179,7 @@ class PageViewSet(viewsets.ModelViewSet):
                 "page_id": str(page.id),
             }
             payload = json.loads(json.dumps(payload, default=str))
-            async_to_sync(channel_layer.group_send)(
+            broadcast(
                 f"comments_page_{page.id}",
                 {"type": "comments.event", "payload": payload},
             )
@@ -736,6 +1237,9 @@ class PageViewSet(viewsets.ModelViewSet):
 
         collab.role = next_role
         collab.save(update_fields=["role", "updated_at"])
+        invalidate_page_roles([page.id], [collab.user_id])
+        # every user of the page sees the new role in its collaborator info
+        record_page_changes([page.id])
 
         log_audit(
             page,
@@ -766,7 +1270,11 @@ class PageViewSet(viewsets.ModelViewSet):
 
         prev_role = collab.role
         target_user = collab.user
+        # before the delete, so the removed user still gets a change row;
+        # is_shared may change for the owner and the other collaborators too
+        record_page_changes([page.id])
         collab.delete()
+        invalidate_page_roles([page.id], [target_user.id])
 
         log_audit(
             page,
@@ -925,6 +1433,9 @@ class PageInviteViewSet(viewsets.ViewSet):
         if not created and collab.role != invite.role:
             collab.role = invite.role
             collab.save(update_fields=["role", "updated_at"])
+        invalidate_page_roles([invite.page_id], [request.user.id])
+        # the page becomes shared for its owner and other collaborators too
+        record_page_changes([invite.page_id])
 
         invite.status = InviteStatus.ACCEPTED
         invite.responded_at = timezone.now()
@@ -1012,6 +1523,15 @@ class PageAuditLogViewSet(viewsets.ViewSet):
         logs = PageAuditLog.objects.filter(page=page).select_related("actor", "target_user").order_by("-created_at")[:200]
         return Response(PageAuditLogSerializer(logs, many=True).data, status=status.HTTP_200_OK)
 
+class RealtimeStatsViewSet(viewsets.ViewSet):
+    """Realtime counters of the process serving the request (staff only)."""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def list(self, request):
+        return Response(realtime_stats(), status=status.HTTP_200_OK)
+
+
 class TiptapDocumentViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = TiptapDocumentSerializer
@@ -30,4 +30,17 @@ api.interceptors.request.use((config: InternalAxiosRequestConfig) => {
   return config;
 });
 
+/**
+ * Short-lived signed ticket for a page's WebSockets. Null when it cannot be
+ * fetched: the sockets then authenticate with the token as before.
+ */
+export async function fetchWsTicket(pageId: string | number): Promise<string | null> {
+  try {
+    const res = await api.post(`/pages/${pageId}/ws-ticket/`);
+    return (res.data?.ticket as string) ?? null;
+  } catch {
+    return null;
+  }
+}
+
 export default api;
@@ -111,13 +111,14 @@ export const useCommentsStore = defineStore("commentsStore", {
       }
     },
 
-    connectRealtime(pageId: string | number, token?: string | null) {
+    connectRealtime(pageId: string | number, token?: string | null, ticket?: string | null) {
       const pageKey = String(pageId);
       if (this.realtimePageId === pageKey && this.realtimeSocket) return;
       this.disconnectRealtime();
 
       const url = new URL(`${COMMENTS_WS_URL}/${pageKey}`);
       if (token) url.searchParams.set("token", token);
+      if (ticket) url.searchParams.set("ticket", ticket);
 
       const ws = new WebSocket(url.toString());
       ws.onmessage = (event) => {
@@ -150,10 +151,18 @@ export const useCommentsStore = defineStore("commentsStore", {
           // ignore
         }
       };
-      ws.onclose = () => {
+      ws.onclose = (event) => {
         if (this.realtimeSocket === ws) {
           this.realtimeSocket = null;
           this.realtimePageId = null;
+          // 4029: shed by the server's admission control, retry when told to
+          if (event.code === 4029) {
+            const match = /retry-after=([\d.]+)/.exec(event.reason || "");
+            const delay = match ? Number(match[1]) * 1000 : 2000 + Math.random() * 2000;
+            setTimeout(() => {
+              if (!this.realtimeSocket) this.connectRealtime(pageId, token, ticket);
+            }, delay);
+          }
         }
       };
       this.realtimeSocket = ws;